@@ -23,6 +23,10 @@ if __name__ == '__main__' and not getattr(sys, 'frozen', False):
 		print('Support library not found on RAYPATH'); sys.exit(-1)
 
 from pyradlib.pyrad_proc import PIPE, Error, ProcMixin
+from pyradlib.pyrad_proc import ResourceError, RESOURCE_EXIT
+from pyradlib.pyrad_pipe import Pipeline, PICTURE
+from pyradlib.pyrad_trace import traced
+from pyradlib.pyrad_index import open_index, HISTO_STAT
 
 SHORTPROGN = os.path.splitext(os.path.basename(sys.argv[0]))[0]
 
@@ -145,9 +149,12 @@ class Falsecolor(ProcMixin):
 		self.params = defaults.copy()
 		self.params.update(params)
 		self.donothing = params.get('donothing', False)
-		self.verbose = params.get('verbose', False)
+		self.verbose = params.get('verbose', False) or self.donothing
 		self.tmpdir = None
 		self.picfn = None
+		# a dry run shows all commands, so no shortcuts through the index
+		self.index = None if self.donothing else open_index()
+		self.pipe = Pipeline(self)
 		self.make_tempfnames()
 		self.autoscale()
 		self.gen_pcargs()
@@ -159,10 +166,12 @@ class Falsecolor(ProcMixin):
 						os.unlink(os.path.join(self.tmpdir, fn))
 					os.rmdir(self.tmpdir)
 
+	@traced
 	def run(self):
 		self.create_calfiles()
 		if self.params['showpal']:
 			self.create_palettes()
+			self.pipe.run()
 			return
 		extrema = False
 		legend = True
@@ -180,17 +189,27 @@ class Falsecolor(ProcMixin):
 			self.compute_extrema()
 			extrema = True
 		self.combine_pictures(extrema=extrema, legend=legend)
+		self.pipe.run()
 
+	@traced
 	def compute_extrema(self):
 		pex_cmd = ['pextrem', '-o', self.params['picture']]
+		stat = ' '.join(pex_cmd[:-1])
+		stored = None
 		if self.donothing: # bogus values for demonstration purposes
 			mins = '758 475 8.045565e-02 6.217769e-02 6.119852e-02'
 			maxs = '550 314 4.328220e+01 4.294798e+01 4.361643e+01'
 		else:
-			pex_proc = self.call_one(pex_cmd,  'compute extrema', out=PIPE)
-			mins = pex_proc.stdout.readline()
-			maxs = pex_proc.stdout.readline()
-			pex_proc.stdout.close()
+			stored = self.indexed(stat)
+			if stored:
+				if self.verbose:
+					sys.stderr.write('### extrema from index\n')
+				mins, maxs = stored.splitlines()
+			else:
+				pex_proc = self.call_one(pex_cmd,  'compute extrema', out=PIPE)
+				mins = pex_proc.stdout.readline()
+				maxs = pex_proc.stdout.readline()
+				pex_proc.stdout.close()
 		minl = mins.split()
 		if len(minl) != 5:
 			self.raise_on_error('determine extrema',
@@ -203,15 +222,20 @@ class Falsecolor(ProcMixin):
 		if len(maxl) != 5:
 			self.raise_on_error('determine extrema',
 					'Invalid maximum data from pextrem')
+		if not (self.donothing or stored):
+			self.index_stat(stat, (mins + maxs).decode('ascii'))
 		self.params['maxposx'] = int(maxl[0]) + self.params['legwidth']
 		self.params['maxposy'] = int(maxl[1])
 		maxr, maxg, maxb = map(float, maxl[2:])
 		maxval = (maxr*0.27 + maxg*0.67 + maxb*0.06) * self.params['mult']
 		cmd = ('psign -s -0.15 -a 2 -h 16 %.4g' % minval).split()
-		self.call_one(cmd,'create minimum label',out=self.params['minvpic_fn'])
+		self.pipe.stage(cmd, 'create minimum label',
+				out=self.params['minvpic_fn'])
 		cmd = ('psign -s -0.15 -a 2 -h 16 %.4g' % maxval).split()
-		self.call_one(cmd,'create maximum label',out=self.params['maxvpic_fn'])
+		self.pipe.stage(cmd, 'create maximum label',
+				out=self.params['maxvpic_fn'])
 
+	@traced
 	def create_scolpic(self):
 		fn = self.params['scolpic_fn']
 		cmd = (['pcomb'] + self.params['pc0args']
@@ -219,8 +243,9 @@ class Falsecolor(ProcMixin):
 				'-e', 'vbelow=(y-0.5)/yres;vabove=(y+1.5)/yres',
 				'-x', str(self.params['legwidth']),
 				'-y', str(self.params['legheight']), ])
-		self.call_one(cmd, 'create scale colors', out=fn)
+		self.pipe.stage(cmd, 'create scale colors', out=fn)
 
+	@traced
 	def create_slabpics(self):
 		psign_ilines = [self.params['label']]
 		decades = self.params['decades']
@@ -234,24 +259,13 @@ class Falsecolor(ProcMixin):
 			psign_ilines.append('%.1f' % (scale * y2))
 		height = math.floor(self.params['legheight']/self.params['ndivs']+0.5)
 		psign_cmd = ('psign -s -0.15 -cf 1 1 1 -cb 0 0 0 -h %d'%height).split()
-
-		psign_proc = self.call_one(psign_cmd, 'create scale labels',
-				_in=PIPE, out=self.params['slabpic_fn'])
-		for line in psign_ilines:
-			# Py3 text is unicode, convert to ASCII
-			bline = (line + '\n').encode()
-			psign_proc.stdin.write(bline)
-		psign_proc.stdin.close()
-		# now we can wait for it
-		res = psign_proc.wait()
-		if res != 0:
-			self.raise_on_error(actstr,
-					'Nonzero exit (%d) from command [%s].'
-					% (res, self.qjoin(displ)))
+		self.pipe.stage(psign_cmd, 'create scale labels',
+				data=psign_ilines, out=self.params['slabpic_fn'])
 		invert_cmd = ['pcomb', '-e', 'lo=1-gi(1)', self.params['slabpic_fn']]
-		invert_proc = self.call_one(invert_cmd, 'create inverted label',
-			out=self.params['slabinvpic_fn'])
+		self.pipe.stage(invert_cmd, 'create inverted label',
+				out=self.params['slabinvpic_fn'])
 
+	@traced
 	def make_tempfnames(self):
 		if self.donothing:
 			self.tmpdir = tempfile.mktemp()
@@ -272,18 +286,21 @@ class Falsecolor(ProcMixin):
 					while chunk:
 						f.write(chunk)
 						chunk = os.read(infd, 10000)
-		self.params['scolpic_fn'] = os.path.join(self.tmpdir, 'scol.hdr')
-		self.params['slabpic_fn'] = os.path.join(self.tmpdir, 'slab.hdr')
-		self.params['slabinvpic_fn'] = os.path.join(self.tmpdir, 'slabinv.hdr')
-		self.params['minvpic_fn'] = os.path.join(self.tmpdir, 'minv.hdr')
-		self.params['maxvpic_fn'] = os.path.join(self.tmpdir, 'maxv.hdr')
-		self.params['combpic_fn'] = os.path.join(self.tmpdir, 'comb.hdr')
-
+		# declared for the pipeline, which may not create all of them
+		for key, fn in (('scolpic_fn', 'scol.hdr'), ('slabpic_fn', 'slab.hdr'),
+				('slabinvpic_fn', 'slabinv.hdr'), ('minvpic_fn', 'minv.hdr'),
+				('maxvpic_fn', 'maxv.hdr'), ('combpic_fn', 'comb.hdr')):
+			self.params[key] = self.pipe.temp(
+					os.path.join(self.tmpdir, fn), PICTURE)
+
+	@traced
 	def combine_pictures(self, extrema, legend):
 		pcB_cmd = (['pcomb'] + self.params['pc0args'] + self.params['pc1args']
 				+ [self.params['picture']])
 		if self.params.get('cpict'):
 			pcB_cmd.append(self.params['cpict'])
+		comb = self.params['combpic_fn']
+		self.pipe.stage(pcB_cmd, 'combine final picture', out=comb)
 		pcP_cmd = ['pcompos']
 		if legend:
 			leg_add = [
@@ -293,16 +310,16 @@ class Falsecolor(ProcMixin):
 				'-t', '0.5',
 				self.params['slabpic_fn'], '0', str(self.params['loff']),]
 			pcP_cmd.extend(leg_add)
-		pcP_cmd.extend(['-', str(self.params['legwidth']), '0',])
+		pcP_cmd.extend([comb, str(self.params['legwidth']), '0',])
 		if extrema:
 			extr_add = [self.params['minvpic_fn'],
 				str(self.params['minposx']), str(self.params['minposy']),
 				self.params['maxvpic_fn'],
 				str(self.params['maxposx']), str(self.params['maxposy']), ]
 			pcP_cmd.extend(extr_add)
-		self.call_two(pcB_cmd, pcP_cmd, 
-				'combine final picture','compose final picture')
+		self.pipe.stage(pcP_cmd, 'compose final picture')
 
+	@traced
 	def create_calfiles(self):
 		if self.donothing: return
 		try:
@@ -315,36 +332,61 @@ class Falsecolor(ProcMixin):
 		except Exception as e:
 			self.raise_on_error('create temporary cal files', str(e))
 
+	@traced
 	def autoscale(self):
 		scale = self.params.get('scale')
 		if isinstance(scale, str) and scale.strip()[0] in 'aA':
-			histo_cmd = ['phisto', self.params['picture']]
-			hi_proc = self.call_one(histo_cmd, 'create scaling histogram',
-					out=PIPE)
+			histo = self.indexed(HISTO_STAT)
+			if histo:
+				if self.verbose:
+					sys.stderr.write('### scaling histogram from index\n')
+				lines = histo.splitlines()
+			else:
+				# phisto adds the histogram to the index
+				histo_cmd = ['phisto', self.params['picture']]
+				hi_proc = self.call_one(histo_cmd, 'create scaling histogram',
+						out=PIPE)
+				lines = hi_proc.stdout.readlines()
+				hi_proc.stdout.close()
 			# apparently we want the second highest histogram value
-			histo = hi_proc.stdout.readlines()[-2]
-			hi_proc.stdout.close()
+			histo = lines[-2]
 			logmax = float(histo.split()[0])
 			self.params['scale'] = self.params['mult'] / 179 * 10** logmax
 
+	def indexed(self, name):
+		'''Return a statistic of the picture from the index, or None.'''
+		pic = self.params['picture']
+		if self.index and pic != self.picfn and os.path.isfile(pic):
+			return self.index.get_stat(pic, name)
+		return None
+
+	def index_stat(self, name, value):
+		pic = self.params['picture']
+		if self.index and pic != self.picfn and os.path.isfile(pic):
+			self.index.set_stat(pic, name, value)
+
+	@traced
 	def create_palettes(self):
 		if self.params['showpal']:
 			comb_cmdl = ['pcompos', '-a', '1']
 			for pal in PALETTES:
-				fcimg = os.path.join(self.tmpdir, '%s.hdr' % pal)
-				lbimg = os.path.join(self.tmpdir, '%s_label.hdr' % pal)
+				fcimg = self.pipe.temp(
+						os.path.join(self.tmpdir, '%s.hdr' % pal), PICTURE)
+				lbimg = self.pipe.temp(
+						os.path.join(self.tmpdir, '%s_label.hdr' % pal), PICTURE)
 				ps_cmd = ('psign -cb 0 0 0 -cf 1 1 1 -h 20 %s'% pal).split()
-				self.call_one(ps_cmd, 'create sub-label', out=lbimg)
+				self.pipe.stage(ps_cmd, 'create sub-label', out=lbimg)
 
 				pcb_cmd = ['pcomb', '-f', self.pc0fn, '-e', 'v=x/256', '-e',
 						'ro=clip(%s_red(v));'
 						'go=clip(%s_grn(v));'
 						'bo=clip(%s_blu(v));' % (pal,pal,pal),
 						'-x', '256', '-y', '30']
-				self.call_one(pcb_cmd, 'create sub-image', out=fcimg)
+				self.pipe.stage(pcb_cmd, 'create sub-image', out=fcimg)
 				comb_cmdl.extend((fcimg, lbimg))
-			self.call_one(comb_cmdl, 'compose palette image')
+			self.pipe.stage(comb_cmdl, 'compose palette image')
 
+	@traced
 	def gen_pcargs(self):
 		pc0argl = ['-f', self.pc0fn]
 		pc1argl = ['-f', self.pc1fn]
@@ -492,6 +534,9 @@ if __name__ == '__main__':
 	except KeyboardInterrupt:
 		sys.stderr.write('*cancelled*\n')
 		sys.exit(1)
+	except ResourceError as e:
+		sys.stderr.write('%s: %s\n' % (SHORTPROGN, e))
+		sys.exit(RESOURCE_EXIT)
 	except (Error) as e:
 		sys.stderr.write('%s: %s\n' % (SHORTPROGN, str(e)))
 		sys.exit(-1)
@@ -17,6 +17,11 @@ from __future__ import division, print_function, unicode_literals
 import os
 import sys
 import argparse
+import math
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import shutil
+import tempfile
 
 # __all__ = ('main')
 
@@ -33,7 +38,9 @@ if __name__ == '__main__' and not getattr(sys, 'frozen', False):
         print('Support library not found on RAYPATH');
         sys.exit(-1)
 
-from pyradlib.pyrad_proc import Error, ProcMixin, PIPE
+from pyradlib.pyrad_proc import Error, ProcMixin
+from pyradlib.pyrad_proc import ResourceError, RESOURCE_EXIT
+from pyradlib.pyrad_amb import AmbientFile
 
 SHORTPROGN = os.path.splitext(os.path.basename(sys.argv[0]))[0]
 
@@ -43,7 +50,7 @@ void glow posglow
 0
 4 ${agr} ${agg} ${agb} 0
 
-posglow sphere position${recno}
+posglow sphere position${recid}
 0
 0
 4 ${  px  } ${  py  } ${  pz  } ${ psiz }
@@ -55,7 +62,7 @@ void glow arrglow
 0
 4 ${wt*agr} ${wt*agg} ${wt*agb} 0
 
-arrglow cone pgarrow${recno}
+arrglow cone pgarrow${recid}
 0
 0
 8
@@ -78,7 +85,7 @@ void mixfunc pgeval
 0
 9 ${ px } ${ py } ${ pz } ${ux/r0} ${uy/r0} ${uz/r0} ${vx/r1} ${vy/r1} ${vz/r1}
 
-pgeval polygon pgellipse${recno}
+pgeval polygon pgellipse${recid}
 0
 0
 12
@@ -111,7 +118,7 @@ dgpat glow dgval
 0
 4 ${avr} ${avg} ${avb} 0
 
-dgval ring dgdisk${recno}a
+dgval ring dgdisk${recid}a
 0
 0
 8
@@ -119,7 +126,7 @@ dgval ring dgdisk${recno}a
 	${ dgx } ${ dgy } ${ dgz }
 	0	${  r0/2  }
 
-dgval ring dgdisk${recno}b
+dgval ring dgdisk${recid}b
 0
 0
 8
@@ -127,6 +134,38 @@ dgval ring dgdisk${recno}b
     ${ -dgx } ${ -dgy } ${ -dgz }
     0	${  r0/2  }"""
 
+# Compact output: one shared glow material per palette entry.
+paletteFormat = """
+void glow ambpal.%d
+0
+0
+4 %.5g %.5g %.5g 0
+"""
+
+compactFormat = """
+ambpal.%d sphere position%s
+0
+0
+4 %s %s %s %s
+"""
+
+meshFormat = """
+void mesh ambmarkers
+1 %s
+0
+0
+"""
+
+# Marker values computed by rcalc for the compact output.
+markerFormat = '\t'.join(['${agr}', '${agg}', '${agb}', '${px}', '${py}',
+                          '${pz}', '${psiz}', '${recid}']) + '\n'
+
+# Number of markers written to the output per block.
+BLOCKSIZE = 4096
+
+# Smallest number of records worth running a separate rcalc process for.
+MINCHUNK = 20000
+
 
 class Genambpos(ProcMixin):
     def __init__(self, args):
@@ -137,6 +176,16 @@ class Genambpos(ProcMixin):
         self.position = args.position
         self.direct = args.direct
         self.minwt = float(args.minwt)if args.minwt is not None else 0.5001 ** 6
+        self.gridCells = args.gridCells
+        self.cellMax = args.cellMax if args.cellMax is not None else 1
+        self.cellCriterion = args.cellCriterion or 'weight'
+        self.cellMerge = args.cellMerge
+        self.compact = args.compact or bool(args.meshFile)
+        self.paletteLevels = (args.paletteLevels
+                              if args.paletteLevels is not None else 16)
+        self.meshFile = args.meshFile
+        self.tempDir = None
+        self.numProc = args.numProc or multiprocessing.cpu_count()
 
         self.posGradFormat = posGradFormat
         self.posGradFormatAppend = posGradFormatAppend
@@ -147,58 +196,217 @@ class Genambpos(ProcMixin):
 
     def run(self):
         if os.path.exists(self.ambientFile):
+            self.ambFile = AmbientFile(self.ambientFile)
             ambientAccValue = self.getAmbientAccValue()
             self.scalingFactor *= ambientAccValue
 
-            lookambCmd = ['lookamb', '-h', '-d', self.ambientFile]
-
-            rcalcCmd = ['rcalc',
-                        '-e ',
-                        'LV:{0};MW:{1};SF:{2}'.format(self.level, self.minwt,
-                                                      self.scalingFactor),
-                        '-f', 'rambpos.cal', '-e','cond=acond'] + \
-                       self.radius + ['-o',  ambientFormat]
-
-            self.call_two(lookambCmd, rcalcCmd,
-                          'retrieve ambient values through lookamb',
-                          'generate rad files with rcalc',
-                          out=sys.stdout)
-
-            if self.position:
-                if self.direct:
-                    posGradFormat = self.posGradFormat + self.posGradFormatAppend
-
-                    rcalcCmdPos = rcalcCmd[:-1]+ [posGradFormat]
-
-                    self.call_two(lookambCmd, rcalcCmdPos,
-                                  'retrieve ambient values through lookamb',
-                                  'generate rad files with rcalc for position option',
-                                  out=sys.stdout)
-
-            if self.direct:
-                rcalcCmdDir = rcalcCmd[:6]+['cond=dcond','-o',dirGradFormat]
-
-                self.call_two(lookambCmd,rcalcCmdDir,
-                              'retrieve ambient values through lookamb',
-                              'generate rad files with rcalc for direct option')
+            # The records are decoded and pre-selected here, rcalc only
+            # sees the ones that can pass acond/dcond. The original record
+            # number is passed along as an extra column, so the names
+            # generated through "recid" match those of lookamb | rcalc.
+            records = self.ambFile.read().filter_level_weight(self.level,
+                                                              self.minwt)
+            if self.gridCells:
+                records = records.decimate(self.gridCells, self.cellMax,
+                                           by=self.cellCriterion,
+                                           merge=self.cellMerge)
+            self.recordFiles = []
+            try:
+                self.writeRecords(records)
+                self.runRcalc()
+            finally:
+                for recordFile in self.recordFiles:
+                    recordFile.close()
 
         else:
             self.raise_on_error('read ambient file',
                                 'Either no file was specified or the specified '
                                 'path does not exist.')
 
-    def getAmbientAccValue(self):
-        getinfoCmd = ['getinfo', self.ambientFile]
-        ambInfo = self.call_one(getinfoCmd,
-                                'retrive scene information from ambient file.',
-                                out=PIPE)
-        infoList = ambInfo.stdout.read().split()
+    def writeRecords(self, records):
+        """Write the records in lookamb -h -d format to one record file per
+        contiguous range, to be processed by rcalc in parallel."""
+        nchunks = max(1, min(self.numProc, len(records) // MINCHUNK))
+        size = -(-len(records) // nchunks)
+        for start in range(0, max(len(records), 1), size or 1):
+            recordFile = tempfile.TemporaryFile()
+            self.recordFiles.append(recordFile)
+            write = recordFile.write
+            for line in records.slice(start, start + size).lookamb_lines():
+                write(line.encode('ascii'))
+
+    def runChunks(self, rcalcCmd, actstr):
+        """Run rcalc over each record file concurrently, and return the
+        output files in record order."""
+        def runOne(recordFile):
+            outFile = tempfile.TemporaryFile()
+            recordFile.seek(0)
+            self.call_one(rcalcCmd, actstr, _in=recordFile, out=outFile)
+            outFile.seek(0)
+            return outFile
+
+        if len(self.recordFiles) == 1:
+            return [runOne(self.recordFiles[0])]
+        pool = ThreadPool(len(self.recordFiles))
+        try:
+            return pool.map(runOne, self.recordFiles)
+        finally:
+            pool.close()
+
+    def writeChunks(self, rcalcCmd, actstr):
+        """Run rcalc in parallel and copy the results to stdout in order."""
+        outFiles = self.runChunks(rcalcCmd, actstr)
+        sys.stdout.flush()
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+        for outFile in outFiles:
+            shutil.copyfileobj(outFile, out)
+            outFile.close()
+        out.flush()
+
+    def runRcalc(self):
+        rcalcCmd = ['rcalc',
+                    '-e ',
+                    'LV:{0};MW:{1};SF:{2}'.format(self.level, self.minwt,
+                                                  self.scalingFactor),
+                    '-f', 'rambpos.cal', '-e','cond=acond',
+                    '-e', 'recid=$22'] + \
+                   self.radius + ['-o',  ambientFormat]
+
+        if self.compact:
+            self.runCompact(rcalcCmd[:-1] + [markerFormat])
+        else:
+            self.writeChunks(rcalcCmd, 'generate rad files with rcalc')
 
-        if '-aa' not in infoList:
+        if self.position:
+            if self.direct:
+                posGradFormat = self.posGradFormat + self.posGradFormatAppend
+
+                rcalcCmdPos = rcalcCmd[:-1]+ [posGradFormat]
+
+                self.writeChunks(rcalcCmdPos,
+                                 'generate rad files with rcalc for position option')
+
+        if self.direct:
+            rcalcCmdDir = rcalcCmd[:6]+['cond=dcond', '-e', 'recid=$22',
+                                        '-o',dirGradFormat]
+
+            self.writeChunks(rcalcCmdDir,
+                             'generate rad files with rcalc for direct option')
+
+    def runCompact(self, rcalcCmd):
+        """Write the position markers referencing a shared palette of glow
+        materials, optionally as a single mesh."""
+        markers = []
+        for outFile in self.runChunks(rcalcCmd,
+                                      'compute marker values with rcalc'):
+            markers.extend([line.split() for line in
+                            outFile.read().decode('ascii').splitlines()])
+            outFile.close()
+        markers = [m for m in markers if len(m) == 8]
+        palette, palIndex = self.makePalette(
+            [tuple(map(float, m[:3])) for m in markers])
+
+        if self.meshFile:
+            self.writeMesh(markers, palette, palIndex)
+            return
+        write = sys.stdout.write
+        write(''.join([paletteFormat % ((i,) + col)
+                       for i, col in enumerate(palette)]))
+        for start in range(0, len(markers), BLOCKSIZE):
+            block = zip(palIndex[start:start + BLOCKSIZE],
+                        markers[start:start + BLOCKSIZE])
+            write(''.join([compactFormat % (pi, m[7], m[3], m[4], m[5], m[6])
+                           for pi, m in block]))
+        sys.stdout.flush()
+
+    def makePalette(self, colors):
+        """Quantise colors by log brightness (paletteLevels steps over the
+        range found) and by chromaticity (quarters of the brightest channel).
+        Return the mean color of each used palette entry, and the entry
+        index for each color."""
+        steps = max(self.paletteLevels - 1, 1)
+        lums = [max(c) for c in colors if max(c) > 0]
+        if lums:
+            lmin = math.log(min(lums))
+            lrange = (math.log(max(lums)) - lmin) or 1.0
+        entries = {}
+        sums = []
+        palIndex = []
+        for col in colors:
+            lum = max(col)
+            if lum > 0:
+                key = (int((math.log(lum) - lmin) / lrange * steps + .5),
+                       ) + tuple([int(c / lum * 4 + .5) for c in col])
+            else:
+                key = None
+            try:
+                i = entries[key]
+            except KeyError:
+                i = entries[key] = len(sums)
+                sums.append([0.0, 0.0, 0.0, 0])
+            acc = sums[i]
+            acc[0] += col[0]
+            acc[1] += col[1]
+            acc[2] += col[2]
+            acc[3] += 1
+            palIndex.append(i)
+        palette = [(r / n, g / n, b / n) for r, g, b, n in sums]
+        return palette, palIndex
+
+    def writeMesh(self, markers, palette, palIndex):
+        """Write the markers as octahedra into a Radiance mesh with the
+        palette materials embedded, and reference it from the output."""
+        try:
+            self.tempDir = tempfile.mkdtemp('RAD')
+        except (IOError, OSError) as e:
+            self.raise_on_error('create a temp folder', e)
+        paletteFile = os.path.join(self.tempDir, 'palette.rad')
+        objFile = os.path.join(self.tempDir, 'markers.obj')
+        try:
+            with open(paletteFile, 'w') as f:
+                f.write(''.join([paletteFormat % ((i,) + col)
+                                 for i, col in enumerate(palette)]))
+            order = sorted(range(len(markers)), key=palIndex.__getitem__)
+            with open(objFile, 'w') as f:
+                current = None
+                vno = 1
+                for start in range(0, len(order), BLOCKSIZE):
+                    lines = []
+                    for mi in order[start:start + BLOCKSIZE]:
+                        if palIndex[mi] != current:
+                            current = palIndex[mi]
+                            lines.append('usemtl ambpal.%d\n' % current)
+                        x, y, z, r = map(float, markers[mi][3:7])
+                        lines.append('v %.6g %.6g %.6g\nv %.6g %.6g %.6g\n'
+                                     'v %.6g %.6g %.6g\nv %.6g %.6g %.6g\n'
+                                     'v %.6g %.6g %.6g\nv %.6g %.6g %.6g\n'
+                                     % (x + r, y, z, x - r, y, z,
+                                        x, y + r, z, x, y - r, z,
+                                        x, y, z + r, x, y, z - r))
+                        v = [vno + i for i in range(6)]
+                        for a, b, c in ((0, 2, 4), (2, 1, 4), (1, 3, 4),
+                                        (3, 0, 4), (2, 0, 5), (1, 2, 5),
+                                        (3, 1, 5), (0, 3, 5)):
+                            lines.append('f %d %d %d\n' % (v[a], v[b], v[c]))
+                        vno += 6
+                    f.write(''.join(lines))
+        except (IOError, OSError) as e:
+            self.raise_on_error('write temporary marker files', e)
+        try:
+            self.call_one(['obj2mesh', '-a', paletteFile, objFile,
+                           self.meshFile], 'convert the markers into a mesh')
+        finally:
+            shutil.rmtree(self.tempDir)
+            self.tempDir = None
+        sys.stdout.write(meshFormat % self.meshFile)
+        sys.stdout.flush()
+
+    def getAmbientAccValue(self):
+        ambientAccValue = self.ambFile.get_option('-aa')
+        if ambientAccValue is None:
             self.raise_on_error('read ambient accuracy in ambient file header',
                                 '-aa value was missing in the header.')
-        ambientAccValLocn = infoList.index('-aa') + 1
-        ambientAccValue = float(infoList[ambientAccValLocn])
+        ambientAccValue = float(ambientAccValue)
 
         if ambientAccValue < 0.00001:
             self.raise_on_error(
@@ -224,6 +432,31 @@ def main():
                         help='position')
     parser.add_argument('-d', action='store_true', dest='direct',
                         help='direct')
+    parser.add_argument('-g', action='store', dest='gridCells', type=int,
+                        help='decimate: number of grid cells along the '
+                             'largest extent of the ambient positions')
+    parser.add_argument('-k', action='store', dest='cellMax', type=int,
+                        help='decimate: maximum number of markers per grid '
+                             'cell (default 1)')
+    parser.add_argument('-c', action='store', dest='cellCriterion',
+                        choices=('weight', 'level'),
+                        help='decimate: keep the markers with the highest '
+                             'weight (default) or the lowest ambient level')
+    parser.add_argument('-m', action='store_true', dest='cellMerge',
+                        help='decimate: merge the markers within each grid '
+                             'cell into one')
+    parser.add_argument('-C', action='store_true', dest='compact',
+                        help='compact output: position markers share a '
+                             'palette of glow materials')
+    parser.add_argument('-q', action='store', dest='paletteLevels', type=int,
+                        help='compact output: number of brightness levels '
+                             'in the palette (default 16)')
+    parser.add_argument('-M', action='store', dest='meshFile',
+                        help='compact output: write the position markers '
+                             'into this Radiance mesh file (implies -C)')
+    parser.add_argument('-n', action='store', dest='numProc', type=int,
+                        help='number of rcalc processes to run in parallel '
+                             '(default: number of cores)')
     parser.add_argument('AmbientFile', action='append',
                         help='full path of the ambient file that is to be '
                              'analyzed.')
@@ -240,6 +473,9 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         sys.stderr.write('*cancelled*\n')
         sys.exit(1)
+    except ResourceError as e:
+        sys.stderr.write('%s: %s\n' % (SHORTPROGN, e))
+        sys.exit(RESOURCE_EXIT)
     except (Error) as e:
         sys.stderr.write('%s: %s\n' % (SHORTPROGN, str(e)))
         sys.exit(-1)
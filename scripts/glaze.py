@@ -15,18 +15,30 @@ __all__ = ('main')
 __revision__ ='$Revision: 1.0 $'
 import os
 import sys
+import bisect
+import json
 import argparse
+from array import array
 
+_tk_missing = None
 try: # Py3
 	import tkinter
 	from tkinter import ttk
 	from tkinter import filedialog
 	from tkinter import messagebox
-except ImportError: # Py2.7
-	import Tkinter as tkinter
-	import ttk
-	import tkFileDialog as filedialog
-	import tkMessageBox as messagebox
+except ImportError:
+	try: # Py2.7
+		import Tkinter as tkinter
+		import ttk
+		import tkFileDialog as filedialog
+		import tkMessageBox as messagebox
+	except ImportError as e:
+		# Only the batch mode works without Tk. The GUI classes below
+		# are defined on placeholder bases, and main() refuses to use them.
+		_tk_missing = e
+		class _NoTk(object): pass
+		class tkinter(object): Text = _NoTk
+		class ttk(object): Combobox = Frame = _NoTk
 
 class Error(Exception): pass
 SHORTPROGN = os.path.splitext(os.path.basename(sys.argv[0]))[0]
@@ -88,9 +100,9 @@ void BRTDfunc glaze2_unnamed
   if(Rdot,cr(fr({s4r_rgb[0]}),ft({s34t_rgb[0]}),{s2g}*rclr),cr({s1g}*rclr,{s1g}*{s2g}*tclr,fr({s3r_rgb[0]})))
   if(Rdot,cr(fr({s4r_rgb[1]}),ft({s34t_rgb[1]}),{s2g}*rclr),cr({s1g}*rclr,{s1g}*{s2g}*tclr,fr({s3r_rgb[1]})))
   if(Rdot,cr(fr({s4r_rgb[2]}),ft({s34t_rgb[2]}),{s2g}*rclr),cr({s1g}*rclr,{s1g}*{s2g}*tclr,fr({s3r_rgb[2]})))
-  {s1g}*{s2g}*ft({s34t_rgb[0]})*tclr"
-  {s1g}*{s2g}*ft({s34t_rgb[1]})*tclr"
-  {s1g}*{s2g}*ft({s34t_rgb[2]})*tclr"
+  {s1g}*{s2g}*ft({s34t_rgb[0]})*tclr
+  {s1g}*{s2g}*ft({s34t_rgb[1]})*tclr
+  {s1g}*{s2g}*ft({s34t_rgb[2]})*tclr
   0 0 0
   glaze2.cal
 0
@@ -317,7 +329,308 @@ __v175 = Glazing('V-175 white frit', 0.33,0.33,0.33, 0.59,0.59,0.59,
 	0.21,0.21,0.21, True)
 __v933 = Glazing('V-933 warm gray frit', 0.15,0.15,0.15, 0.21,0.21,0.21,
 	0.09,0.09,0.09, True)
-_default = [_clear, __lowe, __pvb, __v175, __v933]
+
+HEADER = ['# Glazing produced by Radiance glaze.py script',
+		'# %s' % __revision__,
+		'# Material surface normal points to interior']
+
+
+class GlazingDB(object):
+	'''A glazing database in columnar form, with the clear glass in row 0.
+	Glazing objects are only created for the rows actually used.
+
+	A parsed copy is cached next to the data file ("<datafile>.cache"),
+	and used as long as the data file keeps its size and modification time.
+	The cache is a line of JSON with the stamp and the names, followed by
+	the raw arrays, so that loading it never runs any code.
+	'''
+	headpat = ['Surface','Tr','Tg','Tb','Rcr','Rcg','Rcb','Rgr','Rgg','Rgb','Part']
+	# Order of the value columns, as in the Glazing() arguments.
+	colnames = ('rg_r','rg_g','rg_b', 'rc_r','rc_g','rc_b',
+			'tn_r','tn_g','tn_b')
+	cache_format = 2
+
+	def __init__(self):
+		self.names = []
+		self.cols = [array('d') for c in self.colnames]
+		self.partial = array('b')
+		self._objs = {}
+		self._sorted = None
+
+	@classmethod
+	def from_list(cls, glazings):
+		db = cls()
+		for g in glazings:
+			db._append(g.name, [getattr(g, c) for c in cls.colnames],
+					g.partial)
+		db._objs[0] = glazings[0]
+		return db
+
+	@classmethod
+	def load(cls, fn):
+		'''Read a tab separated glazing database, or its cached copy.'''
+		db = cls()
+		st = os.stat(fn)
+		stamp = [cls.cache_format, sys.byteorder, st.st_mtime, st.st_size]
+		cachefn = fn + '.cache'
+		try:
+			with open(cachefn, 'rb') as f:
+				head = json.loads(f.readline().decode('utf-8'))
+				if head['stamp'] == stamp:
+					n = len(head['names'])
+					cols = [array('d') for c in cls.colnames]
+					partial = array('b')
+					for a in cols + [partial]:
+						a.fromfile(f, n)
+					db.names = head['names']
+					db.cols = cols
+					db.partial = partial
+		except Exception: # missing, outdated or damaged
+			pass
+		if not db.names:
+			db._parse(fn)
+			db._write_cache(cachefn, stamp)
+		global _clear
+		_clear = db[0] # everybody refers to it by that name
+		return db
+
+	def _write_cache(self, cachefn, stamp):
+		tmpfn = '%s.%d.tmp' % (cachefn, os.getpid())
+		try:
+			with open(tmpfn, 'wb') as f:
+				head = json.dumps({'stamp': stamp, 'names': self.names})
+				f.write(head.encode('utf-8') + b'\n')
+				for a in self.cols + [self.partial]:
+					a.tofile(f)
+			if os.path.exists(cachefn): # no atomic replace on Py2/Windows
+				os.remove(cachefn)
+			os.rename(tmpfn, cachefn)
+		except (IOError, OSError): # read-only location, just don't cache
+			try: os.remove(tmpfn)
+			except OSError: pass
+
+	def _append(self, name, vals, partial):
+		self.names.append(name)
+		for col, v in zip(self.cols, vals):
+			col.append(v)
+		self.partial.append(1 if partial else 0)
+
+	def _parse(self, fn):
+		with open(fn, 'r') as f:
+			head = f.readline()
+			if not head:
+				raise Error('Empty file: "%s"' % fn)
+			if head.strip().split('\t') != self.headpat:
+				raise Error('Header mismatch in file: "%s"' % fn)
+			# row 0 is the first clear glazing, if any, else the default
+			self._append(_clear.name,
+					[getattr(_clear, c) for c in self.colnames], _clear.partial)
+			clear = None
+			i = 2
+			for line in f:
+				sl = line.strip().split('\t')
+				if not len(sl) == 11:
+					raise Error('Incorrect number of elements on line %d in file "%s"'
+							% (i, fn))
+				name = sl[0]
+				try: items = [float(s) for s in sl[1:]]
+				except ValueError:
+					raise Error('Incorrect value on line %d in file "%s"' % (i, fn))
+				tr,tg,tb, rcr,rcg,rcb, rgr,rgg,rgb, partial = items
+				vals = (rgr,rgg,rgb, rcr,rcg,rcb, tr,tg,tb)
+				if ((not clear) # pick out the first clear glazing, if any
+						and ((abs(rcr-rgr)+abs(rcg-rgg)+abs(rcb-rgb)) <= 0.005)):
+					clear = name
+					self.names[0] = name
+					for col, v in zip(self.cols, vals):
+						col[0] = v
+					self.partial[0] = 1 if partial else 0
+				else:
+					self._append(name, vals, partial)
+				i += 1
+
+	def __len__(self):
+		return len(self.names)
+
+	def __getitem__(self, i):
+		if i < 0: i += len(self.names)
+		g = self._objs.get(i)
+		if g is None:
+			vals = [col[i] for col in self.cols]
+			g = Glazing(self.names[i], *(vals + [bool(self.partial[i])]))
+			self._objs[i] = g
+		return g
+
+	def __iter__(self):
+		for i in range(len(self.names)):
+			yield self[i]
+
+	def search(self, text, limit=None):
+		'''Return the row numbers of the names starting with text, followed
+		by those containing it elsewhere (case insensitive), at most limit.
+		An empty text matches all rows in their original order.'''
+		text = text.lower()
+		if not text:
+			return list(range(len(self.names) if limit is None
+					else min(limit, len(self.names))))
+		if self._sorted is None:
+			self._sorted = sorted([(n.lower(), i)
+					for i, n in enumerate(self.names)])
+			self._sorted_keys = [k for k, i in self._sorted]
+		res = []
+		pos = bisect.bisect_left(self._sorted_keys, text)
+		while (pos < len(self._sorted) and
+				self._sorted_keys[pos].startswith(text)):
+			if limit is not None and len(res) >= limit:
+				return res
+			res.append(self._sorted[pos][1])
+			pos += 1
+		for i, n in enumerate(self.names):
+			if limit is not None and len(res) >= limit:
+				break
+			ln = n.lower()
+			if text in ln and not ln.startswith(text):
+				res.append(i)
+		return res
+
+
+_default = GlazingDB.from_list([_clear, __lowe, __pvb, __v175, __v933])
+
+
+def make_material(p1_type, p1_cvg, s12_sel, p2_type=None, p2_cvg=1, s34_sel=1):
+	'''Compute the material for one pane (p2_type is None) or two panes.
+	s12_sel and s34_sel select the coated surface of each pane, 1 for the
+	exterior side and 2 for the interior side.'''
+	if s12_sel == 1:
+		s1_type, s1_cvg, s2_type, s2_cvg = p1_type, p1_cvg, _clear, 1
+	else:
+		s1_type, s1_cvg, s2_type, s2_cvg = _clear, 1, p1_type, p1_cvg
+	if p2_type is None:
+		return s1_type.make_1_mat(s1_cvg, s2_type, s2_cvg)
+	if s34_sel == 1:
+		s3_type, s3_cvg, s4_type, s4_cvg = p2_type, p2_cvg, _clear, 1
+	else:
+		s3_type, s3_cvg, s4_type, s4_cvg = _clear, 1, p2_type, p2_cvg
+	return s1_type.make_2_mat(s1_cvg, s2_type, s2_cvg,
+			s3_type, s3_cvg, s4_type, s4_cvg)
+
+
+class GlazeBatch(object):
+	'''Generate the materials for all combinations in the database,
+	without user interface.
+	Writes them into one Radiance file, plus a tab separated index with one
+	line per material.'''
+	index_head = ['Material', 'Panes', 'Outer', 'Outer surface',
+			'Outer coverage', 'Inner', 'Inner surface', 'Inner coverage',
+			'Ext refl', 'Int refl', 'Trans']
+	# Normal hemispherical values from the comments of each material
+	_nh_keys = ('# Exterior normal hemispherical reflectance: ',
+			'# Interior normal hemispherical reflectance: ',
+			'# Normal hemispherical transmittance: ')
+
+	def __init__(self, data, libfile, steps=4, panes=(1, 2)):
+		self.data = data
+		self.libfile = libfile
+		self.indexfile = os.path.splitext(libfile)[0] + '.idx'
+		if steps < 1:
+			raise Error('Number of coverage steps must be at least 1')
+		self.coverages = [(i + 1) / steps for i in range(steps)]
+		self.panes = panes
+
+	def _coverages(self, glazing):
+		if glazing.partial:
+			return self.coverages
+		return [1]
+
+	def _sides(self, glazing):
+		# the coating side of clear glass doesn't matter
+		if glazing is _clear:
+			return [1]
+		return [1, 2]
+
+	def combinations(self):
+		'''Yield (p1_type, p1_cvg, s12_sel, p2_type, p2_cvg, s34_sel) for
+		every valid single and double pane combination.'''
+		if 1 in self.panes:
+			for p1 in self.data:
+				for s12 in self._sides(p1):
+					for c1 in self._coverages(p1):
+						yield p1, c1, s12, None, 1, 1
+		if 2 in self.panes:
+			for p1 in self.data:
+				for p2 in self.data:
+					if p1.partial and p2.partial:
+						continue # only one pane may be fritted
+					for s12 in self._sides(p1):
+						for s34 in self._sides(p2):
+							for c1 in self._coverages(p1):
+								for c2 in self._coverages(p2):
+									yield p1, c1, s12, p2, c2, s34
+
+	def run(self):
+		count = 0
+		try:
+			with open(self.libfile, 'w') as lib, \
+					open(self.indexfile, 'w') as idx:
+				lib.write('\n'.join(HEADER) + '\n')
+				idx.write('\t'.join(self.index_head) + '\n')
+				for combo in self.combinations():
+					p1, c1, s12, p2, c2, s34 = combo
+					mat = make_material(*combo)
+					count += 1
+					name = 'glaze%d_%05d' % (1 if p2 is None else 2, count)
+					nh = ['']*3
+					for line in mat:
+						for i, key in enumerate(self._nh_keys):
+							if line.startswith(key):
+								nh[i] = line[len(key):]
+					text = '\n'.join(mat)
+					text = text.replace('glaze1_unnamed', name)
+					text = text.replace('glaze2_unnamed', name)
+					lib.write('\n' + text)
+					row = [name, '1' if p2 is None else '2',
+							p1.name, 's%d' % s12, '%g' % c1]
+					if p2 is None:
+						row += ['', '', '']
+					else:
+						row += [p2.name, 's%d' % (s34 + 2), '%g' % c2]
+					idx.write('\t'.join(row + nh) + '\n')
+		except (IOError, OSError) as e:
+			raise Error('Unable to write "%s" - %s'
+					% (e.filename, getattr(e, 'strerror', e)))
+		return count
+
+
+class GlazingCombo(ttk.Combobox, object):
+	'''Combobox that only lists the glazings matching the text typed into it,
+	filled in when its list is opened.'''
+	maxlist = 200
+
+	def __init__(self, parent, db, **kwargs):
+		super(GlazingCombo, self).__init__(parent, postcommand=self.fill,
+				**kwargs)
+		self.set_db(db)
+
+	def set_db(self, db):
+		self.db = db
+		self.index = 0
+		self.matches = [0]
+		self['values'] = [db.names[0]]
+		self.current(0)
+
+	def fill(self):
+		text = self.get()
+		if text == self.db.names[self.index]:
+			text = '' # show everything again
+		self.matches = self.db.search(text, self.maxlist)
+		self['values'] = [self.db.names[i] for i in self.matches]
+
+	def selection(self):
+		'''Return the selected Glazing.'''
+		i = self.current()
+		if 0 <= i < len(self.matches):
+			self.index = self.matches[i]
+		return self.db[self.index]
 
 
 class GlazeText(tkinter.Text, object):
@@ -364,7 +677,6 @@ class Glaze(ttk.Frame, object):
 		else:
 			self.data = _default
 			self.datafile = '<default data>'
-			self.dnames = [d.name for d in self.data]
 		self.initialdir = '.'
 
 		self.root = tkinter.Tk()
@@ -384,44 +696,7 @@ class Glaze(ttk.Frame, object):
 		self.root.mainloop()
 
 	def load_data(self, fn):
-		headpat = ['Surface','Tr','Tg','Tb','Rcr','Rcg','Rcb','Rgr','Rgg','Rgb','Part']
-		with open(fn, 'r') as f:
-			lines = f.readlines()
-		if not lines:
-			raise Error('Empty file: "%s"' % fn)
-		head = lines[0].strip().split('\t')
-		if head != headpat:
-			raise Error('Header mismatch in file: "%s"' % fn)
-		del lines[0]
-		data = []
-		i = 2
-		clear = None
-		for line in lines:
-			sl = line.strip().split('\t')
-			if not len(sl) == 11:
-				raise Error('Incorrect number of elements on line %d in file "%s"'
-						% (i, fn))
-			name = sl[0]
-			try: items = [float(s) for s in sl[1:]]
-			except ValueError:
-				raise Error('Incorrect value on line %d in file "%s"' % (i, fn))
-			tr,tg,tb, rcr,rcg,rcb, rgr,rgg,rgb, partial = items
-			g = Glazing(name, rgr,rgg,rgb, rcr,rcg,rcb, tr,tg,tb, bool(partial))
-			if ((not clear) # pick out the first clear glazing, if any
-					and ((abs(g.rc_r-g.rg_r)+abs(g.rc_g-g.rg_g)+abs(g.rc_b-g.rg_b))
-						<= 0.005)):
-				clear = g
-			else:
-				data.append(g)
-			i += 1
-		if clear:
-			self.data = [clear] + data
-			# everybody refers to it by that name
-			global _clear
-			_clear = clear
-		else:
-			self.data = [_clear] + data
-		self.dnames = [d.name for d in self.data]
+		self.data = GlazingDB.load(fn)
 
 	def build_dialog(self, this):
 		self.s12_sel = tkinter.IntVar()
@@ -463,9 +738,7 @@ class Glaze(ttk.Frame, object):
 				sticky='nsew')
 		type1_label = ttk.Label(self.p1, text='Type:')
 		type1_label.grid(column=1, row=1, sticky='e')
-		self.p1_type = ttk.Combobox(self.p1, values=self.dnames)
-		self.p1_type.current(0)
-		self.p1_type.state(('readonly',))
+		self.p1_type = GlazingCombo(self.p1, self.data)
 		self.p1_type.bind('<<ComboboxSelected>>', self.show_vis)
 		self.p1_type.grid(column=2, row=1, sticky='w')
 		cvg1_label = ttk.Label(self.p1, text='Coverage:')
@@ -483,10 +756,7 @@ class Glaze(ttk.Frame, object):
 				sticky='nsew')
 		type2_label = ttk.Label(self.p2, text='Type:')
 		type2_label.grid(column=1, row=1, sticky='e')
-		self.p2_type = ttk.Combobox(self.p2, values=self.dnames,
-				postcommand=self.show)
-		self.p2_type.current(0)
-		self.p2_type.state(('readonly',))
+		self.p2_type = GlazingCombo(self.p2, self.data)
 		self.p2_type.bind('<<ComboboxSelected>>', self.show_vis)
 		self.p2_type.grid(column=2, row=1, sticky='w')
 		cvg2_label = ttk.Label(self.p2, text='Coverage:')
@@ -515,10 +785,8 @@ class Glaze(ttk.Frame, object):
 				sticky='ew', pady='2px')
 
 	def update_ui(self):
-		self.p1_type['values'] = self.dnames
-		self.p1_type.current(0)
-		self.p2_type['values'] = self.dnames
-		self.p2_type.current(0)
+		self.p1_type.set_db(self.data)
+		self.p2_type.set_db(self.data)
 		self.filelabel['text']= self.datafile
 		self.show_vis()
 
@@ -564,13 +832,10 @@ class Glaze(ttk.Frame, object):
 
 	def show(self, ev=None):
 		cvg_err = ['###   Input Error', '###', '###   Coverage must be between 0.0 and 1.0']
-		head = ['# Glazing produced by Radiance glaze.py script',
-				'# %s' % __revision__,
-				'# Material surface normal points to interior']
 		self.draw()
 		panes = self.npvar.get()
 
-		p1_type = self.data[self.p1_type.current()]
+		p1_type = self.p1_type.selection()
 		if p1_type.partial:
 			try: p1_cvg = float(self.p1_cvg.get())
 			except ValueError:
@@ -581,23 +846,13 @@ class Glaze(ttk.Frame, object):
 				return
 		else:
 			p1_cvg = 1
-		if self.s12_sel.get() == 1:
-			s1_type = p1_type
-			s1_cvg = p1_cvg
-			s2_type = _clear
-			s2_cvg = 1
-		else:
-			s1_type = _clear
-			s1_cvg = 1
-			s2_type = p1_type
-			s2_cvg = p1_cvg
 
 		if panes == 1:
-			mat = s1_type.make_1_mat(s1_cvg, s2_type, s1_cvg)
-			self.output.fill(head + mat)
+			mat = make_material(p1_type, p1_cvg, self.s12_sel.get())
+			self.output.fill(HEADER + mat)
 			return
 
-		p2_type = self.data[self.p2_type.current()]
+		p2_type = self.p2_type.selection()
 		if p2_type.partial:
 			try: p2_cvg = float(self.p2_cvg.get())
 			except ValueError:
@@ -608,19 +863,9 @@ class Glaze(ttk.Frame, object):
 				return
 		else:
 			p2_cvg = 1
-		if self.s34_sel.get() == 1:
-			s3_type = p2_type
-			s3_cvg = p2_cvg
-			s4_type = _clear
-			s4_cvg = 1
-		else:
-			s3_type = _clear
-			s3_cvg = 1
-			s4_type = p2_type
-			s4_cvg = p2_cvg
-		mat = s1_type.make_2_mat(s1_cvg, s2_type, s2_cvg,
-				s3_type, s3_cvg, s4_type, s4_cvg)
-		self.output.fill(head + mat)
+		mat = make_material(p1_type, p1_cvg, self.s12_sel.get(),
+				p2_type, p2_cvg, self.s34_sel.get())
+		self.output.fill(HEADER + mat)
 
 
 	def show_vis(self, ev=None):
@@ -629,12 +874,12 @@ class Glaze(ttk.Frame, object):
 			self.p2_type.state(('disabled',))
 			self.p2_cvg.state(('disabled',))
 		else:
-			p2_type = self.data[self.p2_type.current()]
+			p2_type = self.p2_type.selection()
 			p2p = p2_type.partial
 			self.p2_type.state(('!disabled',))
 			if p2p:
 				self.p2_cvg.state(('!disabled',))
-		p1_type = self.data[self.p1_type.current()]
+		p1_type = self.p1_type.selection()
 		p1p = p1_type.partial
 		if p1p:
 			self.p1_cvg.state(('!disabled',))
@@ -686,8 +931,32 @@ def main():
 		help='Help: print this text to stderr and exit')
 	parser.add_argument('-f', action='store', nargs=1, dest='datafile',
 			metavar='datafile', help='read other glazing data')
+	parser.add_argument('-b', action='store', dest='library',
+			metavar='library',
+			help='batch mode: write the materials for all combinations to '
+			'this file, and an index to the same name with suffix ".idx"')
+	parser.add_argument('-s', action='store', type=int, dest='steps',
+			default=4, metavar='steps',
+			help='batch mode: number of frit coverage steps (default 4)')
+	parser.add_argument('-p', action='store', type=int, dest='panes',
+			choices=(1, 2), metavar='panes',
+			help='batch mode: only single (1) or double (2) panes')
 	args = parser.parse_args() 
-	Glaze(args)
+	if args.library:
+		if args.datafile:
+			datafile = args.datafile[0]
+			if not os.path.isfile(datafile):
+				raise Error('No such file: "%s"' % datafile)
+			data = GlazingDB.load(datafile)
+		else:
+			data = _default
+		panes = (args.panes,) if args.panes else (1, 2)
+		GlazeBatch(data, args.library, args.steps, panes).run()
+	else:
+		if _tk_missing:
+			raise Error('The interactive mode needs tkinter (%s), '
+					'use -b for batch mode without it' % _tk_missing)
+		Glaze(args)
 
 if __name__ == '__main__':
 	try: main()
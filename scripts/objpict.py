@@ -13,9 +13,12 @@ https://github.com/NREL/Radiance/blob/master/src/util/objpict.csh
 from __future__ import division, print_function, unicode_literals
 import os
 import sys
+import math
 import argparse
 import shutil
 import tempfile
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 # __all__ = ('main')
 
@@ -33,6 +36,11 @@ if __name__ == '__main__' and not getattr(sys, 'frozen', False):
         sys.exit(-1)
 
 from pyradlib.pyrad_proc import Error, ProcMixin, PIPE
+from pyradlib.pyrad_trace import traced
+from pyradlib.pyrad_proc import ResourceError, RESOURCE_EXIT
+from pyradlib.pyrad_cache import FileCache
+from pyradlib.pyrad_scene import scene_bbox, UnsupportedScene
+from pyradlib.pyrad_dedup import dedup_scene
 
 SHORTPROGN = os.path.splitext(os.path.basename(sys.argv[0]))[0]
 
@@ -75,21 +83,32 @@ class Objpict(ProcMixin):
         self.radFiles = args.RadFiles[0]
         self.donothing = args.N
         self.verbose = args.V or self.donothing
-
-        self.tempdir = None
+        self.numProc = args.n or multiprocessing.cpu_count()
+        self.bands = args.t
+        self.ambBounces = args.ab
+        self.overtureRes = args.ov
+        self.useCache = args.C
+        self.dedup = args.D or args.Dc
+        self.dedupCompare = args.Dc
+        self.dedupResult = None
+        self.octreeLock = None
+
+        self.tempDir = None
         try:
             self.run()
         finally:
+            if self.octreeLock:
+                self.octreeCache.unlock(self.octreeLock)
             if self.tempDir:
                 shutil.rmtree(self.tempDir)
 
     def run(self):
         if self.radFiles:
             self.createTemp()
-            self.createSingleRadFile()
             radScaleTransValues = self.runSetupCalcs()
             self.runCalcProcs(**radScaleTransValues)
 
+    @traced
     def createTemp(self):
         """Create temporary files and directories needed for objpict"""
         try:
@@ -98,36 +117,23 @@ class Objpict(ProcMixin):
             self.raise_on_error("Create a temp folder", e)
 
         createInTemp = lambda fileName: os.path.join(self.tempDir, fileName)
-        self.inputRad = createInTemp('input.rad')
         self.octree = createInTemp('octree.oct')
         self.testRoom = createInTemp('testRoom.rad')
+        self.ambFile = createInTemp('views.amb')
 
         with open(self.testRoom, 'w') as testRoom:
             testRoom.write(contextScene)
 
-    def createSingleRadFile(self):
-        """Merge all the input rad files into a single rad file."""
-        try:
-            with open(self.inputRad, 'w')as inputRadData:
-                for radFile in self.radFiles:
-                    with open(radFile) as currentRadFile:
-                        for lines in currentRadFile:
-                            inputRadData.write(lines)
-        except IOError as e:
-            self.raise_on_error(
-                'write radiance file %s to a temp file' % radFile, e)
-
+    @traced
     def runSetupCalcs(self):
-        """Launch getbbox and get dimensions, scaling values and transform
-        coordinates for creating images."""
-
-        getBboxCmd = ['getbbox', '-h', self.inputRad]
-        radDimensions = self.call_one(getBboxCmd,
-                                      'get the extents of the Rad files',
-                                      out=PIPE)
-
-        radDimensions = radDimensions.stdout.read().split()
-        xMin, xMax, yMin, yMax, zMin, zMax = map(float, radDimensions)
+        """Get dimensions, scaling values and transform coordinates for
+        creating images. The extents are computed in-process, getbbox is
+        only used for files with commands or references to other files."""
+        radDimensions = scene_bbox(self.radFiles, fallback=self.getBbox)
+        if radDimensions is None:
+            self.raise_on_error('get the extents of the Rad files',
+                                'No surfaces found.')
+        xMin, xMax, yMin, yMax, zMin, zMax = radDimensions
 
         # Get the max axis aligned dimension. Calc the transformation coords and
         # scale value for the rad files.
@@ -137,23 +143,50 @@ class Objpict(ProcMixin):
         yTr = -0.0 * (yMin + yMax)
         zTr = -0.0 * (zMin + zMax)
 
-        return {'transformCoord': map(str, (xTr, yTr, zTr)),
+        return {'transformCoord': [str(v) for v in (xTr, yTr, zTr)],
                 'scale': str(scaleSize)}
 
+    def getBbox(self, radFile):
+        """Launch getbbox for a single file and return its extents."""
+        getBboxCmd = ['getbbox', '-h', radFile]
+        proc = self.call_one(getBboxCmd,
+                             'get the extents of %s' % radFile, out=PIPE)
+        if proc is None:
+            # -N, pretend a unit cube
+            return [0.0, 1.0, 0.0, 1.0, 0.0, 1.0]
+        radDimensions = proc.stdout.read().split()
+        proc.stdout.close()
+        if proc.wait() != 0 or len(radDimensions) != 6:
+            self.raise_on_error('get the extents of %s' % radFile,
+                                'Unexpected output from getbbox.')
+        return [float(v) for v in radDimensions]
+
+    @traced
     def runCalcProcs(self, transformCoord=None, scale=None):
+        sceneFiles = self.radFiles
+        if self.dedup:
+            sceneFiles = self.dedupScene()
         xformCmd = (['xform', '-t'] + transformCoord +
-                    ['-s', scale, '-t', '0.5', '0.5', '0.5', self.inputRad])
+                    ['-s', scale, '-t', '0.5', '0.5', '0.5'] + sceneFiles)
 
         octreeCmd = ['oconv', self.testRoom, '-']
 
-        self.call_two(xformCmd, octreeCmd,
-                      'transform,scale and then combine the rad files with context',
-                      'create the octree',
-                      out=self.octree)
+        if self.useCache and not self.donothing:
+            self.octree = self.cachedOctree(xformCmd, octreeCmd)
+        else:
+            self.call_two(xformCmd, octreeCmd,
+                          'transform,scale and then combine the rad files with context',
+                          'create the octree',
+                          out=self.octree)
+        if self.dedupResult and not self.donothing:
+            origXformCmd = (xformCmd[:-len(sceneFiles)] + self.radFiles)
+            self.reportDedup(origXformCmd, octreeCmd)
 
         xRes = yRes = '1024'
-        rpictList = ['rpict', '-av', '0.2', '0.2', '0.2', '-x', xRes, '-y',
-                     yRes]
+        rpictList = ['rpict', '-av', '0.2', '0.2', '0.2']
+        if self.ambBounces:
+            rpictList += ['-ab', str(self.ambBounces), '-af', self.ambFile]
+        rpictList += ['-x', xRes, '-y', yRes]
 
         # using split because these strings were copied from the original csh script.
         view1 = '-vtl -vp 2 .5 .5 -vd -1 0 0 -vh 1 -vv 1'.split()
@@ -167,16 +200,61 @@ class Objpict(ProcMixin):
 
 
 
-        fd = {}
-        for fileKey, viewInfo in viewDict.items():
-            fileName = os.path.join(self.tempDir, fileKey)
-            rpictCmd = rpictList + viewInfo + [self.octree]
+        # Radiance only shares an ambient file safely between processes
+        # where it can lock it.
+        numProc = self.numProc
+        if self.ambBounces and os.name == 'nt':
+            numProc = 1
+
+        if self.ambBounces and self.overtureRes:
+            self.runOverture(rpictList, viewDict, numProc)
+
+        # Each view may be split into horizontal bands, rendered by
+        # separate rpict processes and put back together by pcompos.
+        nBands = self.bandCount(len(viewDict), int(yRes))
+        # lowest and one past the highest row of each band, from the bottom
+        bandRows = [(band * int(yRes) // nBands,
+                     (band + 1) * int(yRes) // nBands)
+                    for band in range(nBands)]
+
+        @traced
+        def renderBand(task):
+            fileKey, viewInfo, band = task
+            if nBands == 1:
+                fileName = os.path.join(self.tempDir, fileKey)
+                rpictCmd = rpictList + viewInfo + [self.octree]
+            else:
+                fileName = os.path.join(self.tempDir, '%s_%d.hdr'
+                                        % (os.path.splitext(fileKey)[0], band))
+                lo, hi = bandRows[band]
+                rpictCmd = (rpictList[:-1] + [str(hi - lo)] + viewInfo +
+                            self.bandView(viewInfo, lo, hi, int(yRes)) +
+                            ['-pa', '0', self.octree])
             self.call_one(rpictCmd, "create %s" % fileName, out=fileName)
-            fd[fileKey] = fileName
-        # Get the x,y,z dimensions of all the rad files (taken together.)
+            return fileKey, band, fileName
 
-        pcomposCmd = ['pcompos', fd['down.hdr'], '0', xRes, fd['oblique.hdr'],
-                      xRes, yRes,fd['right.hdr'], '0', '0',fd['front.hdr'], xRes, '0']
+        # The views and bands are independent, render them concurrently.
+        tasks = [(fileKey, viewInfo, band)
+                 for fileKey, viewInfo in viewDict.items()
+                 for band in range(nBands)]
+        pool = ThreadPool(max(1, min(numProc, len(tasks))))
+        try:
+            results = pool.map(renderBand, tasks)
+        finally:
+            pool.close()
+        fd = dict([(fileKey, [None] * nBands) for fileKey in viewDict])
+        for fileKey, band, fileName in results:
+            fd[fileKey][band] = fileName
+
+        # Lower left corner of each view in the composite.
+        positions = [('down.hdr', 0, int(yRes)),
+                     ('oblique.hdr', int(xRes), int(yRes)),
+                     ('right.hdr', 0, 0), ('front.hdr', int(xRes), 0)]
+        pcomposCmd = ['pcompos']
+        for fileKey, xPos, yPos in positions:
+            for band, fileName in enumerate(fd[fileKey]):
+                pcomposCmd.extend([fileName, str(xPos),
+                                   str(yPos + bandRows[band][0])])
 
 
         pfiltCmd = ['pfilt', '-1', '-r', '0.6', '-x', '/2', '-y', '/2']
@@ -186,6 +264,112 @@ class Objpict(ProcMixin):
                       'filter and resize the image')
 
 
+    @traced
+    def cachedOctree(self, xformCmd, octreeCmd):
+        """Return the path of the octree in the persistent cache, keyed by
+        the input files, the context scene and the transform. Only build it
+        if it isn't there yet. It is locked against eviction until the
+        rendering is done."""
+        cache = FileCache('octrees')
+        key = cache.make_key(files=self.radFiles,
+                             extra=['objpict', contextScene,
+                                    self.qjoin(xformCmd[:-len(self.radFiles)])])
+        self.octreeCache = cache
+        self.octreeLock = cache.lock(cache.path(key, '.oct'))
+        octree = cache.lookup(key, '.oct')
+        if octree:
+            if self.verbose:
+                sys.stderr.write('### use cached octree %s\n' % octree)
+            return octree
+        tmpOctree = cache.tempname('.oct')
+        try:
+            self.call_two(xformCmd, octreeCmd,
+                          'transform,scale and then combine the rad files with context',
+                          'create the octree',
+                          out=tmpOctree)
+        except:
+            cache.discard(tmpOctree)
+            raise
+        return cache.store(tmpOctree, key, '.oct')
+
+    @traced
+    def dedupScene(self):
+        """Replace repeated geometry by instances of shared octrees.
+        Return the files to use instead of the input files."""
+        try:
+            res = dedup_scene(self.radFiles, self.tempDir)
+        except UnsupportedScene as e:
+            sys.stderr.write('%s: %s, not deduplicated\n' % (SHORTPROGN, e))
+            return self.radFiles
+        for grpFile, octFile in res.groups:
+            self.call_one(['oconv', '-f', res.materials, grpFile],
+                          'create the instance octree %s' % octFile,
+                          out=octFile)
+        self.dedupResult = res
+        return [res.scene]
+
+    def reportDedup(self, xformCmd, octreeCmd):
+        """Report the reduction. Only with -Dc, compare with an octree of
+        the original scene, built only for its size."""
+        res = self.dedupResult
+        origSize = None
+        if self.dedupCompare:
+            origOctree = os.path.join(self.tempDir, 'original.oct')
+            self.call_two(xformCmd, octreeCmd,
+                          'transform,scale and then combine the original rad files',
+                          'create the octree of the original scene',
+                          out=origOctree)
+            origSize = os.path.getsize(origOctree)
+            os.remove(origOctree)
+        instSize = sum([os.path.getsize(octFile)
+                        for grpFile, octFile in res.groups])
+        sys.stderr.write('%s: %s\n' % (SHORTPROGN,
+                         res.report(os.path.getsize(self.octree), instSize,
+                                    origSize)))
+
+    @traced
+    def runOverture(self, rpictList, viewDict, numProc):
+        """Render all views at low resolution, only to populate the shared
+        ambient file with indirect values for the full renderings."""
+        ovRes = str(self.overtureRes)
+        ovList = rpictList[:-4] + ['-x', ovRes, '-y', ovRes]
+
+        @traced
+        def renderOverture(view):
+            fileKey, viewInfo = view
+            self.call_one(ovList + viewInfo + [self.octree],
+                          'compute ambient values for %s' % fileKey,
+                          out=os.devnull)
+
+        pool = ThreadPool(max(1, min(numProc, len(viewDict))))
+        try:
+            pool.map(renderOverture, viewDict.items())
+        finally:
+            pool.close()
+
+    def bandCount(self, nViews, yRes):
+        """Number of bands per view, either as requested or so that all
+        available cores are busy, and at most one per row."""
+        bands = self.bands or self.numProc // nViews
+        return max(1, min(bands, yRes))
+
+    def bandView(self, viewInfo, lo, hi, yRes):
+        """View options to render the rows lo to hi (exclusive, counted
+        from the bottom) of a view yRes rows high as a band of its own. The
+        vertical view size is reduced to the band, and the view lifted into
+        position."""
+        vv = float(viewInfo[viewInfo.index('-vv') + 1])
+        part = (hi - lo) / yRes
+        if '-vtl' in viewInfo:
+            vvBand = vv * part
+        else:
+            vvBand = 2 * math.degrees(math.atan(
+                math.tan(math.radians(vv / 2)) * part))
+        # in units of the band height
+        lift = ((lo + hi) / 2 - yRes / 2) / (hi - lo)
+        return ['-vv', '%.10g' % vvBand, '-vl', '%.10g' % lift]
+
+
 def main():
     parser = argparse.ArgumentParser(add_help=False,
                                      description='Make a nice multi-view picture'
@@ -196,6 +380,31 @@ def main():
                              ' are to be rendered.')
     parser.add_argument('-H', action='help', help='Help: print this text to '
                                                   'stderr and exit.')
+    parser.add_argument('-n', action='store', type=int, metavar='nproc',
+                        help='Number of views to render in parallel '
+                             '(default: number of cores)')
+    parser.add_argument('-t', action='store', type=int, metavar='nbands',
+                        help='Split each view into this many horizontal bands '
+                             'rendered in parallel (default: adapt to -n)')
+    parser.add_argument('-ab', action='store', type=int, metavar='nbounces',
+                        help='Compute indirect light with this many ambient '
+                             'bounces, shared by all views in one ambient file')
+    parser.add_argument('-ov', action='store', type=int, metavar='res',
+                        default=64,
+                        help='Resolution of the overture pass that populates '
+                             'the ambient file with -ab (default 64, 0 for '
+                             'none)')
+    cacheGroup = parser.add_mutually_exclusive_group()
+    cacheGroup.add_argument('-C', action='store_true',
+                            help='Keep the octree in a persistent cache and '
+                                 'reuse it while the input files are '
+                                 'unchanged')
+    cacheGroup.add_argument('-D', action='store_true',
+                            help='Replace repeated geometry by instances of '
+                                 'one octree each, and report the reduction')
+    cacheGroup.add_argument('-Dc', action='store_true',
+                            help='Like -D, and also build an octree of the '
+                                 'original scene to compare the sizes')
     parser.add_argument('-N', action='store_true',
                         help='Do nothing (implies -V)')
     parser.add_argument('-V', action='store_true',
@@ -209,6 +418,9 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         sys.stderr.write('*cancelled*\n')
         sys.exit(1)
+    except ResourceError as e:
+        sys.stderr.write('%s: %s\n' % (SHORTPROGN, e))
+        sys.exit(RESOURCE_EXIT)
     except (Error) as e:
         sys.stderr.write('%s: %s\n' % (SHORTPROGN, str(e)))
         sys.exit(-1)
@@ -18,6 +18,8 @@ import sys
 import argparse
 import tempfile
 import shutil
+import hashlib
+import json
 
 __all__ = ('main')
 
@@ -35,6 +37,11 @@ if __name__ == '__main__' and not getattr(sys, 'frozen', False):
         sys.exit(-1)
 
 from pyradlib.pyrad_proc import Error, ProcMixin
+from pyradlib.pyrad_proc import ResourceError, RESOURCE_EXIT
+from pyradlib.pyrad_cache import FileCache, hash_file
+from pyradlib.pyrad_scene import UnsupportedScene, SceneReader, SURFACE_BBOX
+from pyradlib.pyrad_scene import Primitive, Command
+from pyradlib.pyrad_dedup import dedup_scene, format_primitive
 
 
 SHORTPROGN = os.path.splitext(os.path.basename(sys.argv[0]))[0]
@@ -49,6 +56,9 @@ bright source sun2 0 0 4 .3 1 1 5
 bright source sun3 0 0 4 -1 -.7 1 5"""
 
 
+# Materials and surfaces that can't be frozen into an instance octree with -I
+LIGHT_TYPES = ('light', 'spotlight', 'illum', 'glow')
+DIRECT_SURFACES = ('source', 'instance', 'mesh')
 
 
 class Objview(ProcMixin):
@@ -65,9 +75,19 @@ class Objview(ProcMixin):
         self.radFiles = args.Radfiles[0]
         self.runSilently = args.runSilently
         self.printViewsStdin = args.printViewsStdin
+        self.keepAmbient = args.keepAmbient
+        self.incremental = args.incremental
+        self.dedup = args.dedup or args.dedupCompare
+        self.useCache = args.useCache or (self.keepAmbient and not
+                                          (self.incremental or self.dedup))
+        self.dedupCompare = args.dedupCompare
+        self.cacheLocks = []
+        self.cachedOctree = False
         self.tempDir = None
         try: self.run()
         finally:
+            for cache, lck in self.cacheLocks:
+                cache.unlock(lck)
             if self.tempDir:
                 shutil.rmtree(self.tempDir)
 
@@ -80,6 +100,16 @@ class Objview(ProcMixin):
         self.createTemp()
         self.radFiles.append(self.lightsFile)
         self.radOptions, self.renderOptions = self.createRadRenderOptions()
+        if self.incremental:
+            self.octreeFile = self.getIncrementalOctree()
+            self.cachedOctree = True
+        elif self.useCache:
+            self.octreeFile = self.getCachedOctree()
+            self.cachedOctree = True
+        elif self.dedup:
+            self.cachedOctree = self.createDedupOctree()
+        if self.keepAmbient:
+            self.ambFile = self.getCachedAmbient()
 
         # If the OS is Windows then make the path Rad friendly by switching
         # slashes and set the output device to qt.
@@ -119,6 +149,216 @@ class Objview(ProcMixin):
         self.rifFile = createInTemp('scene.rif')
         self.ambFile = createInTemp('scene.amb')
 
+        with open(self.lightsFile, 'w')as lightRad:
+            lightRad.write(lights)
+
+    def lockCacheEntry(self, cache, fileName):
+        """Lock a cache entry against eviction until the session ends."""
+        self.cacheLocks.append((cache, cache.lock(fileName)))
+
+    def getCachedOctree(self):
+        """Return the path of the scene octree in the persistent cache, keyed
+        by the contents of the input files (with the lights). Only run oconv
+        if it isn't there yet."""
+        cache = FileCache('octrees')
+        key = cache.make_key(files=self.radFiles, extra=['objview'])
+        self.lockCacheEntry(cache, cache.path(key, '.oct'))
+        octree = cache.lookup(key, '.oct')
+        if octree:
+            return octree
+        tmpOctree = cache.tempname('.oct')
+        try:
+            self.call_one(['oconv'] + self.radFiles, 'create the octree',
+                          out=tmpOctree)
+        except:
+            cache.discard(tmpOctree)
+            raise
+        return cache.store(tmpOctree, key, '.oct')
+
+    def getIncrementalOctree(self):
+        """Build the scene octree from one instance octree per input file,
+        kept in the persistent cache and keyed by the contents of that file
+        and the materials of all files, so that an edit only rebuilds the
+        instance octrees of the edited files (all of them if a material
+        changed). Files that can't be frozen into an instance (light
+        sources, commands, instances and meshes) go to oconv directly.
+        A manifest records the modification time, size and hash of each
+        file, so that only the edited files need to be read again.
+        Return the path of the resulting octree."""
+        cache = FileCache('scenes')
+        sceneFiles = [os.path.abspath(f) for f in self.radFiles[:-1]]
+        setKey = cache.make_key(extra=['objview'] + sceneFiles)
+        manifestFile = cache.path(setKey, '.json')
+        self.lockCacheEntry(cache, manifestFile)
+        try:
+            with open(manifestFile) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            manifest = {}
+        sigs = self.fileSignatures(sceneFiles, manifest.get('files', {}))
+        # a file only counts as edited when its contents changed
+        digests = [sigs[fn][2] for fn in sceneFiles]
+        knownScans = manifest.get('scans', {})
+        scans = {}
+        for fn, digest in zip(sceneFiles, digests):
+            scans[digest] = knownScans.get(digest) or self.scanFile(fn)
+        lightMods = set()
+        for scan in scans.values():
+            lightMods.update(scan['lightmods'])
+
+        try:
+            matFile = self.getMaterials(cache, [scans[d]['materials']
+                                                for d in digests])
+            direct, instances = [], []
+            for fn, digest in zip(sceneFiles, digests):
+                scan = scans[digest]
+                if scan['direct'] or lightMods.intersection(scan['mods']):
+                    direct.append(fn)
+                elif scan['surfaces']:
+                    instances.append(self.getFileOctree(cache, fn, digest,
+                                                        matFile))
+            instFile = os.path.join(self.tempDir, 'instances.rad')
+            with open(instFile, 'w') as f:
+                for i, octFile in enumerate(instances):
+                    if os.name == 'nt':
+                        octFile = octFile.replace('\\', '/')
+                    f.write(format_primitive(Primitive('void', 'instance',
+                            'part%d' % i, [octFile], [], [])))
+            self.call_one(['oconv', matFile] + direct +
+                          [instFile, self.lightsFile],
+                          'create the octree', out=self.octreeFile)
+        except Error:
+            # eg. materials defined by a command in another file
+            self.call_one(['oconv'] + self.radFiles, 'create the octree',
+                          out=self.octreeFile)
+
+        if manifest != {'files': sigs, 'scans': scans}:
+            tmpManifest = cache.tempname('.json')
+            with open(tmpManifest, 'w') as f:
+                json.dump({'files': sigs, 'scans': scans}, f, indent=1)
+            cache.store(tmpManifest, setKey, '.json')
+        return self.octreeFile
+
+    def fileSignatures(self, files, known):
+        """Return [mtime, size, sha1] for each file, only hashing the files
+        with a different mtime or size than known."""
+        sigs = {}
+        for fn in files:
+            try:
+                st = os.stat(fn)
+            except OSError as e:
+                self.raise_on_error('read input file "%s"' % fn, e)
+            old = known.get(fn)
+            if old and old[0] == st.st_mtime and old[1] == st.st_size:
+                sigs[fn] = old
+            else:
+                h = hashlib.sha1()
+                hash_file(h, fn)
+                sigs[fn] = [st.st_mtime, st.st_size, h.hexdigest()]
+        return sigs
+
+    def scanFile(self, fileName):
+        """Return what building the octree needs to know about a file: its
+        materials as text, the number of surfaces and the modifiers they
+        use, the light materials it defines, and whether it has to go to
+        oconv directly."""
+        materials, mods, lightMods = [], set(), []
+        surfaces = 0
+        direct = False
+        for prim in SceneReader(fileName):
+            if isinstance(prim, Command):
+                direct = True
+            elif prim.otype in SURFACE_BBOX or prim.otype == 'source':
+                surfaces += 1
+                mods.add(prim.modifier)
+                direct = direct or prim.otype in DIRECT_SURFACES
+            else:
+                materials.append(format_primitive(prim))
+                if prim.otype in LIGHT_TYPES:
+                    lightMods.append(prim.ident)
+        return {'materials': ''.join(materials), 'surfaces': surfaces,
+                'mods': sorted(mods), 'lightmods': lightMods,
+                'direct': direct}
+
+    def getMaterials(self, cache, materials):
+        """Return the cache path of a file with the materials of all input
+        files, which every instance octree is built with."""
+        key = cache.make_key(extra=['objview'] + materials)
+        matFile = cache.path(key, '.mat.rad')
+        self.lockCacheEntry(cache, matFile)
+        if cache.lookup(key, '.mat.rad'):
+            return matFile
+        tmpMaterials = cache.tempname('.rad')
+        with open(tmpMaterials, 'w') as f:
+            f.write(''.join(materials))
+        return cache.store(tmpMaterials, key, '.mat.rad')
+
+    def getFileOctree(self, cache, fileName, digest, matFile):
+        """Return the cache path of the instance octree of one file."""
+        key = cache.make_key(extra=['objview', digest, matFile])
+        octree = cache.path(key, '.part.oct')
+        self.lockCacheEntry(cache, octree)
+        if cache.lookup(key, '.part.oct'):
+            return octree
+        tmpOctree = cache.tempname('.oct')
+        try:
+            self.call_one(['oconv', '-f', matFile, fileName],
+                          'create the octree of %s' % fileName,
+                          out=tmpOctree)
+        except:
+            cache.discard(tmpOctree)
+            raise
+        return cache.store(tmpOctree, key, '.part.oct')
+
+    def createDedupOctree(self):
+        """Replace repeated geometry by instances of shared octrees, build
+        the octree of the result and report the reduction. Only with -Dc,
+        also build an octree of the original scene to compare its size.
+        Return False if the scene can't be deduplicated, and rad has to
+        build the octree as usual."""
+        try:
+            res = dedup_scene(self.radFiles[:-1], self.tempDir)
+        except UnsupportedScene as e:
+            sys.stderr.write('%s: %s, not deduplicated\n' % (SHORTPROGN, e))
+            return False
+        origSize = None
+        if self.dedupCompare:
+            origOctree = os.path.join(self.tempDir, 'original.oct')
+            self.call_one(['oconv'] + self.radFiles,
+                          'create the octree of the original scene',
+                          out=origOctree)
+            origSize = os.path.getsize(origOctree)
+            os.remove(origOctree)
+        for grpFile, octFile in res.groups:
+            self.call_one(['oconv', '-f', res.materials, grpFile],
+                          'create the instance octree %s' % octFile,
+                          out=octFile)
+        self.call_one(['oconv', res.scene, self.lightsFile],
+                      'create the octree', out=self.octreeFile)
+        instSize = sum([os.path.getsize(octFile)
+                        for grpFile, octFile in res.groups])
+        sys.stderr.write('%s: %s\n' % (SHORTPROGN,
+                         res.report(os.path.getsize(self.octreeFile),
+                                    instSize, origSize)))
+        return True
+
+    def getCachedAmbient(self):
+        """Return the path of a persistent ambient file for this scene and
+        these render options, locked against eviction while we use it.
+        Concurrent sessions share the file, Radiance locks it for updates."""
+        ambCache = FileCache('ambient')
+        key = ambCache.make_key(files=self.radFiles,
+                                extra=['objview', self.renderOptions])
+        ambFile = ambCache.path(key, '.amb')
+        self.lockCacheEntry(ambCache, ambFile)
+        if ambCache.lookup(key, '.amb') is None:
+            # rad starts a new one, make room for it
+            ambCache.evict()
+        elif os.path.getsize(ambFile) == 0:
+            # left empty by an interrupted session, Radiance rejects it
+            ambCache.discard(ambFile)
+        return ambFile
+
     def createRadRenderOptions(self):
         """Based on the inputs provided, create options for running Rad/Glrad
         and also set rendering options."""
@@ -165,7 +405,12 @@ class Objview(ProcMixin):
 
     def createRifList(self):
         """Create a list of RifFile variables based on user input and defaults."""
-        rifList = ['scene= "%s"' % s for s in self.radFiles]
+        # rad would rebuild a cached octree that is older than the scene
+        # files, so it gets to see the octree only.
+        if self.cachedOctree:
+            rifList = []
+        else:
+            rifList = ['scene= "%s"' % s for s in self.radFiles]
         rifList.append('EXPOSURE= 0.5')
         rifList.append('UP= %s' % (self.upDirection or 'Z'))
         rifList.append('view= %s' % (self.viewDetials or 'XYZ'))
@@ -176,10 +421,6 @@ class Objview(ProcMixin):
         return rifList
 
     def writeFiles(self):
-        # Write lights and join to the input rad files.
-        with open(self.lightsFile, 'w')as lightRad:
-            lightRad.write(lights)
-
         with open(self.rifFile, 'w') as rifData:
             rifData.write('\n'.join(self.rifLines) + '\n')
 
@@ -229,6 +470,31 @@ def main():
                         help='Print each view on the standard output before being'
                              ' applied')
 
+    # The instance octrees of -D only live as long as the session.
+    cacheGroup = parser.add_mutually_exclusive_group()
+    cacheGroup.add_argument('-C', action='store_true', dest='useCache',
+                            help='Keep the octree in a persistent cache and '
+                                 'reuse it while the input files are '
+                                 'unchanged')
+
+    cacheGroup.add_argument('-I', action='store_true', dest='incremental',
+                            help='Keep a persistent instance octree of each '
+                                 'input file, and only rebuild those of the '
+                                 'files edited since')
+
+    cacheGroup.add_argument('-D', action='store_true', dest='dedup',
+                            help='Replace repeated geometry by instances of '
+                                 'one octree each, and report the reduction')
+
+    cacheGroup.add_argument('-Dc', action='store_true', dest='dedupCompare',
+                            help='Like -D, and also build an octree of the '
+                                 'original scene to compare the sizes')
+
+    parser.add_argument('-A', action='store_true', dest='keepAmbient',
+                        help='Keep the ambient file in a persistent cache and '
+                             'reuse it in later sessions (implies -C without '
+                             '-I or -D)')
+
     parser.add_argument('Radfiles', action='append', nargs='+',
                         help='File(s) containing radiance scene objects that'
                              ' are to be rendered interactively.')
@@ -245,6 +511,9 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         sys.stderr.write('*cancelled*\n')
         sys.exit(1)
+    except ResourceError as e:
+        sys.stderr.write('%s: %s\n' % (SHORTPROGN, e))
+        sys.exit(RESOURCE_EXIT)
     except (Error) as e:
         sys.stderr.write('%s: %s\n' % (SHORTPROGN, str(e)))
         sys.exit(-1)
@@ -22,9 +22,14 @@ if __name__ == '__main__' and not getattr(sys, 'frozen', False):
 		print('Support library not found on RAYPATH'); sys.exit(-1)
 
 from pyradlib.pyrad_proc import PIPE, Error, ProcMixin
+from pyradlib.pyrad_proc import ResourceError, RESOURCE_EXIT
+from pyradlib.pyrad_index import open_index, HISTO_STAT
 
 SHORTPROGN = os.path.splitext(os.path.basename(sys.argv[0]))[0]
 
+# the filtered values of each picture in the picture index
+VALUES_STAT = 'phisto values'
+
 class Phisto(ProcMixin):
 	def __init__(self, args):
 		self.donothing = args.N
@@ -34,6 +39,8 @@ class Phisto(ProcMixin):
 			self.tmpfile = '<tmpfile>'
 		else:
 			self.tmpfile = tempfile.TemporaryFile()
+		# a dry run shows all commands, so no shortcuts through the index
+		self.index = None if self.donothing else open_index()
 		self.run()
 
 	def run(self):
@@ -48,12 +55,36 @@ class Phisto(ProcMixin):
 				if not os.path.isfile(fname):
 					self.raise_on_error('open file "%s"' % fname,
 							'File not found.')
+			if len(self.imgfiles) == 1 and self.index:
+				histo = self.index.get_stat(self.imgfiles[0], HISTO_STAT)
+				if histo is not None:
+					if self.verbose:
+						sys.stderr.write('### histogram from index\n')
+					sys.stdout.write(histo)
+					return
 			for fname in self.imgfiles:
-				p = self.call_two(pf_cmd + [fname], pv_cmd,
-						'extract image values', 'filter image values',
-						out=self.tmpfile)
+				self.extract_values(pf_cmd + [fname], pv_cmd, fname)
 		self.run_calcprocs()
 
+	def extract_values(self, pf_cmd, pv_cmd, fname):
+		if self.index:
+			# the processes write through the descriptor, so find its end
+			self.tmpfile.seek(0, os.SEEK_END)
+			values = self.index.get_stat(fname, VALUES_STAT)
+			if values is not None:
+				if self.verbose:
+					sys.stderr.write('### values of "%s" from index\n' % fname)
+				self.tmpfile.write(values)
+				self.tmpfile.flush()
+				return
+			start = self.tmpfile.tell()
+		self.call_two(pf_cmd, pv_cmd,
+				'extract image values', 'filter image values',
+				out=self.tmpfile)
+		if self.index:
+			self.tmpfile.seek(start)
+			self.index.set_stat(fname, VALUES_STAT, self.tmpfile.read())
+
 	def run_calcprocs(self):
 		lmin_t_cmd = ['total', '-if', '-l']
 		lmin_rc_cmd = ['rcalc', '-e', 'L=$1*179;$1=if(L-1e-7,log10(L)-.01,-7)']
@@ -76,9 +107,20 @@ class Phisto(ProcMixin):
 		rc_cmd = ['rcalc', '-if', '-e', 'L=$1*179;cond=L-1e-7;$1=log10(L)']
 		hi_cmd = ['histo', lmin, lmax, '777']
 		if not self.donothing: self.tmpfile.seek(0)
+		if not (self.index and len(self.imgfiles) == 1):
+			res_proc = self.call_two(rc_cmd, hi_cmd,
+				'extract records', 'compute histogram',
+				_in=self.tmpfile)
+			return
 		res_proc = self.call_two(rc_cmd, hi_cmd,
 			'extract records', 'compute histogram',
-			_in=self.tmpfile)
+			_in=self.tmpfile, out=PIPE, universal_newlines=True)
+		histo = res_proc[1].stdout.read()
+		res_proc[1].stdout.close()
+		self.wait_chain(res_proc, ['extract records', 'compute histogram'],
+				[self.qjoin(rc_cmd), self.qjoin(hi_cmd)])
+		sys.stdout.write(histo)
+		self.index.set_stat(self.imgfiles[0], HISTO_STAT, histo)
 
 
 def main():
@@ -102,6 +144,9 @@ if __name__ == '__main__':
 	except KeyboardInterrupt:
 		sys.stderr.write('*cancelled*\n')
 		sys.exit(1)
+	except ResourceError as e:
+		sys.stderr.write('%s: %s\n' % (SHORTPROGN, e))
+		sys.exit(RESOURCE_EXIT)
 	except Error as e:
 		sys.stderr.write('%s: %s\n' % (SHORTPROGN, e))
 		sys.exit(-1)
@@ -23,6 +23,9 @@ if __name__ == '__main__' and not getattr(sys, 'frozen', False):
 		print('Support library not found on RAYPATH'); sys.exit(-1)
 
 from pyradlib.pyrad_proc import PIPE, Error, ProcMixin
+from pyradlib.pyrad_proc import ResourceError, RESOURCE_EXIT
+from pyradlib.pyrad_header import read_header, splice
+from pyradlib.pyrad_index import open_index, GLARE_STAT
 
 SHORTPROGN = os.path.splitext(os.path.basename(sys.argv[0]))[0]
 
@@ -58,20 +61,30 @@ class Pveil(ProcMixin):
 
 	def run(self):
 		fg_cmd = 'findglare -r 400 -c -p'.split() + [self.imgfile]
-		p = self.call_one(fg_cmd, 'extract glare values', out=PIPE)
-		if self.donothing:
-			fg_data = None
+		# a dry run shows all commands, so no shortcuts through the index
+		index = None if self.donothing else open_index()
+		stat = ' '.join(fg_cmd[:-1])
+		stored = index and index.get_stat(self.imgfile, stat)
+		if stored is not None:
+			if self.verbose:
+				sys.stderr.write('### glare values from index\n')
+			fg_data = stored.splitlines(True)
 		else:
-			fg_data = p.stdout.readlines()
-			p.wait()
+			p = self.call_one(fg_cmd, 'extract glare values', out=PIPE)
+			if self.donothing:
+				fg_data = None
+			else:
+				fg_data = p.stdout.readlines()
+				p.wait()
 		gv_table = self.extract_glarevals(fg_data)
+		if index and stored is None and p.returncode == 0:
+			index.set_stat(self.imgfile, stat, b''.join(fg_data))
+			index.set_stat(self.imgfile, GLARE_STAT, len(gv_table))
 		if not gv_table and not self.donothing:
-			# use the file descriptor for bytes on Py3
 			if self.verbose:
 				sys.stderr.write('### no glare, send file unchanged\n')
-			with open(self.imgfile, 'rb') as f:
-				os.write(sys.stdout.fileno(), f.read())
-				return
+			splice(self.imgfile, sys.stdout)
+			return
 		if self.donothing:
 			self.tmpfname = tempfile.mktemp()
 			tmp_fd = None
@@ -79,11 +92,8 @@ class Pveil(ProcMixin):
 			tmp_fd, self.tmpfname = tempfile.mkstemp()
 		self.write_calfile(tmp_fd, gv_table)
 		# we need to preserve the original exposure values and some other stuff
-		with open(self.imgfile, 'r') as inf:
-			line = inf.readline().strip()
-			while line:
-				if HPAT.search(line): print(line)
-				line = inf.readline().strip()
+		for line in read_header(self.imgfile).select(HPAT):
+			print(line)
 		sys.stdout.flush()
 		pc_cmd = ['pcomb', '-f', self.tmpfname, self.imgfile]
 		self.call_one(pc_cmd, 'combine image')
@@ -139,6 +149,9 @@ if __name__ == '__main__':
 	except KeyboardInterrupt:
 		sys.stderr.write('*cancelled*\n')
 		sys.exit(1)
+	except ResourceError as e:
+		sys.stderr.write('%s: %s\n' % (SHORTPROGN, e))
+		sys.exit(RESOURCE_EXIT)
 	except Error as e:
 		sys.stderr.write('%s: %s\n' % (SHORTPROGN, e))
 		sys.exit(-1)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+''' pyrad.py - Single entry point for all pyrad scripts
+
+Runs one of the scripts in this collection, chosen by the name it was
+invoked as (eg. a link or copy named "falsecolor" or "falsecolor.exe"),
+or else by the first argument:
+
+	pyrad falsecolor -i image.hdr > fc.hdr
+
+Only the chosen script is imported, so that it doesn't pay for the
+dependencies of the others (eg. tkinter for glaze). For frozen builds,
+one executable can serve all scripts, which saves the unpacking of a
+separate bundle for each of them.
+
+With -T before the script name, or with PYRAD_TIMING set in the
+environment, the time spent until the script starts running and the
+time it runs are reported on stderr.
+'''
+from __future__ import division, print_function, unicode_literals
+import time
+_T0 = time.time()
+__all__ = ('main')
+import os
+import sys
+
+if __name__ == '__main__' and not getattr(sys, 'frozen', False):
+	_rp = os.environ.get('RAYPATH')
+	if not _rp:
+		print('No RAYPATH, unable to find support library'); sys.exit(-1)
+	for _p in _rp.split(os.path.pathsep):
+		if os.path.isdir(os.path.join(_p, 'pyradlib')):
+			if _p not in sys.path: sys.path.insert(0, _p)
+			break
+	else:
+		print('Support library not found on RAYPATH'); sys.exit(-1)
+
+from pyradlib.pyrad_proc import ResourceError, RESOURCE_EXIT
+
+TOOLS = ('falsecolor', 'genambpos', 'glaze', 'objpict', 'objview',
+		'phisto', 'pveil', 'rlux')
+
+USAGE = '''usage: pyrad [-T] script [options]
+
+Run one of the pyrad scripts: %s.
+Use "pyrad script -H" for the options of each.
+
+  -T  report startup and run time on stderr
+''' % ', '.join(TOOLS)
+
+
+def load(tool):
+	'''Import and return the module of a script.'''
+	# Explicit imports, so that pyinstaller finds them all.
+	if tool == 'falsecolor': import falsecolor as mod
+	elif tool == 'genambpos': import genambpos as mod
+	elif tool == 'glaze': import glaze as mod
+	elif tool == 'objpict': import objpict as mod
+	elif tool == 'objview': import objview as mod
+	elif tool == 'phisto': import phisto as mod
+	elif tool == 'pveil': import pveil as mod
+	elif tool == 'rlux': import rlux as mod
+	else: raise ValueError(tool)
+	return mod
+
+def toolname(path):
+	name = os.path.basename(path)
+	base, ext = os.path.splitext(name)
+	if ext.lower() in ('.py', '.exe'):
+		name = base
+	return name
+
+def run(tool, args, timing=False):
+	'''Run a script with the given arguments (without the program name),
+	like its own "__main__" block would.'''
+	# The scripts take their name for messages from sys.argv[0].
+	sys.argv = [tool] + list(args)
+	mod = load(tool)
+	# may have been imported earlier under another name (pyradd)
+	mod.SHORTPROGN = tool
+	t1 = time.time()
+	try:
+		try: mod.main()
+		except KeyboardInterrupt:
+			sys.stderr.write('*cancelled*\n')
+			sys.exit(1)
+		except ResourceError as e:
+			sys.stderr.write('%s: %s\n' % (mod.SHORTPROGN, e))
+			sys.exit(RESOURCE_EXIT)
+		except mod.Error as e:
+			sys.stderr.write('%s: %s\n' % (mod.SHORTPROGN, e))
+			sys.exit(-1)
+	finally:
+		if timing:
+			sys.stderr.write('pyrad: %s: startup %.3f s, run %.3f s\n'
+					% (tool, t1 - _T0, time.time() - t1))
+
+def main():
+	timing = bool(os.environ.get('PYRAD_TIMING'))
+	args = sys.argv[1:]
+	tool = toolname(sys.argv[0])
+	if tool not in TOOLS:
+		if args and args[0] == '-T':
+			timing = True
+			args = args[1:]
+		if not args or args[0] == '-H':
+			sys.stderr.write(USAGE)
+			sys.exit(0 if args else -1)
+		if args[0] not in TOOLS:
+			sys.stderr.write('pyrad: unknown script "%s"\n' % args[0])
+			sys.exit(-1)
+		tool = args[0]
+		args = args[1:]
+	run(tool, args, timing)
+
+if __name__ == '__main__':
+	main()
+
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+''' pyradc.py - Run a pyrad script through the pyradd server
+
+Takes the same arguments as pyrad, and behaves exactly like the script
+invoked (same output, messages and exit status). If no server is
+running, or the script isn't one that the server handles, the script is
+run locally instead.
+
+	pyradc falsecolor -i image.hdr > fc.hdr
+'''
+from __future__ import division, print_function, unicode_literals
+__all__ = ('main')
+import os
+import sys
+
+if __name__ == '__main__' and not getattr(sys, 'frozen', False):
+	_rp = os.environ.get('RAYPATH')
+	if not _rp:
+		print('No RAYPATH, unable to find support library'); sys.exit(-1)
+	for _p in _rp.split(os.path.pathsep):
+		if os.path.isdir(os.path.join(_p, 'pyradlib')):
+			if _p not in sys.path: sys.path.insert(0, _p)
+			break
+	else:
+		print('Support library not found on RAYPATH'); sys.exit(-1)
+
+from pyradlib.pyrad_proc import Error
+from pyradlib.pyrad_daemon import (SERVED, socket_path, connect,
+		send_request, recv_status)
+from pyradlib.pyrad_trace import get_tracer, span
+import pyrad
+
+
+def main():
+	args = sys.argv[1:]
+	tool = pyrad.toolname(sys.argv[0])
+	if tool not in pyrad.TOOLS:
+		if not args or args[0] not in pyrad.TOOLS:
+			# pyrad knows what to say
+			pyrad.main()
+		tool = args[0]
+		args = args[1:]
+	sock = None
+	if tool in SERVED:
+		try: sock = connect(socket_path())
+		except Error as e:
+			# never hand our environment and terminal to someone else
+			sys.stderr.write('%s: %s, running locally\n' % (
+					pyrad.toolname(sys.argv[0]), e))
+	if not sock:
+		pyrad.run(tool, args)
+		return
+	# makes us the owner of the trace, which the server side merges into
+	get_tracer()
+	try:
+		with span('pyradd %s' % tool, 'wait'):
+			send_request(sock, {'tool': tool, 'args': args,
+					'cwd': os.getcwd(), 'env': dict(os.environ)}, [0, 1, 2])
+			status = recv_status(sock)
+	except KeyboardInterrupt:
+		sock.close() # interrupts the server side
+		sys.stderr.write('*cancelled*\n')
+		sys.exit(1)
+	except (IOError, OSError) as e:
+		raise Error('Lost connection to pyradd - %s' % e)
+	finally:
+		sock.close()
+	sys.exit(status)
+
+if __name__ == '__main__':
+	try: main()
+	except Error as e:
+		sys.stderr.write('%s: %s\n' % (
+				os.path.splitext(os.path.basename(sys.argv[0]))[0], e))
+		sys.exit(-1)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+''' pyradd.py - Resident server for pyrad script invocations
+
+Listens on a Unix domain socket for requests from pyradc, and runs the
+requested script (falsecolor, phisto, pveil or rlux) in a forked copy of
+itself. The scripts and pyradlib are imported once at server start, so
+each invocation starts with everything loaded, and only pays for a fork
+instead of a new interpreter.
+
+The client passes its stdin, stdout and stderr, its working directory
+and its environment, and the script runs on those exactly as if it had
+been started by the client. Closing the client (eg. with Ctrl-C)
+interrupts the script.
+
+Requires a Unix system and Python 3.3 or later.
+'''
+from __future__ import division, print_function, unicode_literals
+__all__ = ('main')
+import os
+import sys
+import errno
+import signal
+import socket
+import argparse
+import threading
+import traceback
+
+if __name__ == '__main__' and not getattr(sys, 'frozen', False):
+	_rp = os.environ.get('RAYPATH')
+	if not _rp:
+		print('No RAYPATH, unable to find support library'); sys.exit(-1)
+	for _p in _rp.split(os.path.pathsep):
+		if os.path.isdir(os.path.join(_p, 'pyradlib')):
+			if _p not in sys.path: sys.path.insert(0, _p)
+			break
+	else:
+		print('Support library not found on RAYPATH'); sys.exit(-1)
+
+from pyradlib.pyrad_proc import Error
+from pyradlib.pyrad_daemon import (SERVED, available, socket_path, connect,
+		check_peer, recv_request, send_status)
+from pyradlib import pyrad_trace
+import pyrad
+
+SHORTPROGN = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+
+
+class Pyradd(object):
+	def __init__(self, args):
+		self.maxworkers = args.n or 8
+		self.verbose = args.V
+		self.workers = set()
+		self.sock = None
+		if not available():
+			raise Error('Needs Unix domain sockets and Python 3.3 or later')
+		self.path = args.socket or socket_path(create=True)
+		try: self.run()
+		finally:
+			if self.sock:
+				self.sock.close()
+				try: os.remove(self.path)
+				except OSError: pass
+
+	def log(self, msg):
+		if self.verbose:
+			sys.stderr.write('%s: %s\n' % (SHORTPROGN, msg))
+
+	def run(self):
+		def terminate(signum, frame):
+			sys.exit(0) # clean up the socket on the way out
+		signal.signal(signal.SIGTERM, terminate)
+		for tool in SERVED:
+			pyrad.load(tool)
+		self.listen()
+		self.log('serving %s on %s' % (', '.join(SERVED), self.path))
+		while True:
+			conn, addr = self.sock.accept()
+			try: check_peer(conn)
+			except Error as e:
+				self.log(str(e))
+				conn.close()
+				continue
+			self.reap(block=False)
+			while len(self.workers) >= self.maxworkers:
+				self.reap(block=True)
+			sys.stdout.flush()
+			sys.stderr.flush()
+			pid = os.fork()
+			if pid == 0:
+				self.sock.close()
+				status = 255
+				try: status = self.serve(conn)
+				except BaseException:
+					try: traceback.print_exc()
+					except BaseException: pass
+				finally:
+					try:
+						pyrad_trace.flush() # no atexit after os._exit()
+						sys.stdout.flush()
+						sys.stderr.flush()
+						send_status(conn, status)
+					except BaseException: pass
+					os._exit(status & 0xff)
+			conn.close()
+			self.workers.add(pid)
+
+	def listen(self):
+		if os.path.exists(self.path):
+			other = connect(self.path)
+			if other:
+				other.close()
+				raise Error('Another server is listening on "%s"' % self.path)
+			os.remove(self.path) # left over
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		# only accessible by this user, from the start
+		oldmask = os.umask(0o177)
+		try: self.sock.bind(self.path)
+		except socket.error as e:
+			raise Error('Unable to create socket "%s" - %s'
+					% (self.path, e))
+		finally: os.umask(oldmask)
+		self.sock.listen(16)
+
+	def reap(self, block):
+		while self.workers:
+			try: pid, st = os.waitpid(-1, 0 if block else os.WNOHANG)
+			except OSError as e:
+				if e.errno == errno.ECHILD:
+					self.workers.clear()
+					return
+				raise
+			if pid == 0:
+				return
+			self.workers.discard(pid)
+			if block:
+				return
+
+	def serve(self, conn):
+		'''Run one request in the forked worker, return its exit status.'''
+		signal.signal(signal.SIGINT, signal.default_int_handler)
+		signal.signal(signal.SIGTERM, signal.SIG_DFL)
+		# a process group of its own, like a shell job
+		os.setpgid(0, 0)
+		req, fds = recv_request(conn)
+		if len(fds) != 3:
+			raise Error('Expected 3 file descriptors, received %d' % len(fds))
+		for i, fd in enumerate(fds):
+			os.dup2(fd, i)
+			os.close(fd)
+		os.chdir(req['cwd'])
+		os.environ.clear()
+		os.environ.update(req['env'])
+		tool = req['tool']
+		self.log('%s %s' % (tool, ' '.join(req['args'])))
+
+		done = []
+		def watch():
+			# the client closes the connection if it is interrupted,
+			# pass that on like Ctrl-C to the script and its processes
+			try: data = conn.recv(1)
+			except socket.error: data = b''
+			if not data and not done:
+				os.killpg(os.getpgrp(), signal.SIGINT)
+		watcher = threading.Thread(target=watch)
+		watcher.daemon = True
+		watcher.start()
+
+		status = 0
+		try:
+			if tool not in SERVED:
+				raise Error('Script "%s" is not served' % tool)
+			pyrad.run(tool, req['args'])
+		except SystemExit as e:
+			if e.code is None: status = 0
+			elif isinstance(e.code, int): status = e.code
+			else:
+				sys.stderr.write('%s\n' % e.code)
+				status = 1
+		except Error as e:
+			sys.stderr.write('%s: %s\n' % (tool, e))
+			status = -1
+		finally:
+			done.append(True)
+		return status
+
+
+def main():
+	''' This is a command line script and not currently usable as a module.
+	Use the -H option for instructions.'''
+	parser = argparse.ArgumentParser(add_help=False,
+		description='Serve pyrad script invocations from pyradc clients')
+	parser.add_argument('-s', action='store', dest='socket',
+		metavar='socket', help='socket path (default: $PYRAD_SOCKET or '
+		'pyradd.sock in $XDG_RUNTIME_DIR or in pyradd-<uid> in the temp '
+		'directory)')
+	parser.add_argument('-n', action='store', type=int, metavar='nproc',
+		help='maximum number of concurrent invocations (default 8)')
+	parser.add_argument('-V', action='store_true',
+		help='Verbose: log requests to stderr')
+	parser.add_argument('-H', action='help',
+		help='Help: print this text to stderr and exit')
+	Pyradd(parser.parse_args())
+
+if __name__ == '__main__':
+	try: main()
+	except KeyboardInterrupt:
+		sys.stderr.write('*cancelled*\n')
+		sys.exit(1)
+	except Error as e:
+		sys.stderr.write('%s: %s\n' % (SHORTPROGN, e))
+		sys.exit(-1)
+
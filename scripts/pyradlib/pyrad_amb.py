@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+''' pyrad_amb.py - Read Radiance ambient files without lookamb
+
+Use as:
+	from pyradlib.pyrad_amb import AmbientFile
+
+	af = AmbientFile('scene.amb')
+	print(af.get_option('-aa'))
+	recs = af.read()
+	sel = recs.select(lambda lvl, wt: wt > 0.1)
+
+The records are decoded into a columnar store, one array.array per field,
+in the column order of "lookamb -h -d" output (see AMB_FIELDS).
+The file is memory mapped and decoded in chunks of many records at a time,
+so that the per-record work is done by struct and the builtin functions,
+and never by a Python loop over individual bytes.
+
+Only the current ambient file format (magic number 559, as written by
+Radiance 5.x with Hessian gradients) is supported.
+'''
+from __future__ import division, print_function, unicode_literals
+
+import os
+import mmap
+import math
+import heapq
+import struct
+from array import array
+
+from pyradlib.pyrad_proc import Error
+from pyradlib.pyrad_header import read_header
+
+AMBMAGIC = 559
+AMBFMT = 'Radiance_ambval'
+
+# Field order of "lookamb -h -d", which is also what rambpos.cal expects.
+AMB_FIELDS = ('px', 'py', 'pz', 'nx', 'ny', 'nz', 'ux', 'uy', 'uz',
+		'lvl', 'weight', 'r0', 'r1', 'vr', 'vg', 'vb',
+		'pg0', 'pg1', 'dg0', 'dg1', 'corral')
+
+# One binary record, as written by writambval() in ambio.c:
+# lvl(1) weight(f) pos(3f) ndir(4) udir(4) val(COLR) rad(2f) gpos(2f)
+# gdir(2f) corral(4), where every f is a 4 byte mantissa and 1 byte exponent.
+_REC_FMT = 'b' + 'ib' + 'ibibib' + 'ii' + 'BBBB' + 'ibib' * 3 + 'I'
+_REC_NFIELDS = 28
+RECSIZE = struct.calcsize('>' + _REC_FMT)
+
+# records decoded per struct call
+CHUNKSIZE = 8192
+
+_FSCALE = 1.0 / 0x7fffffff
+
+# direction encoding from dircode.c
+_DCSCALE = 11585.2
+_FXNEG = 0o1
+_FYNEG = 0o2
+_FZNEG = 0o4
+_F1X = 0o10
+_F2Z = 0o20
+_F1SFT = 5
+_F2SFT = 18
+_FMASK = 0x1fff
+
+
+def _decode_flts(mants, exps):
+	'''Decode a column of portable floats (see getflt() in portio.c)'''
+	ldexp = math.ldexp
+	return [ldexp((m + (.5 if m > 0 else -.5)) * _FSCALE, e) if m else 0.0
+			for m, e in zip(mants, exps)]
+
+def _decode_dir(dc):
+	'''Decode a 32 bit direction code into a unit vector (see dircode.c)'''
+	if not dc:
+		return 0.0, 0.0, 0.0
+	d1 = ((dc >> _F1SFT & _FMASK) + .5) * (1. / _DCSCALE)
+	d2 = ((dc >> _F2SFT & _FMASK) + .5) * (1. / _DCSCALE)
+	der = math.sqrt(max(0.0, 1. - d1*d1 - d2*d2))
+	if dc & _F1X:
+		x = d1
+		if dc & _F2Z: y, z = der, d2
+		else: y, z = d2, der
+	else:
+		y = d1
+		if dc & _F2Z: x, z = der, d2
+		else: x, z = d2, der
+	if dc & _FXNEG: x = -x
+	if dc & _FYNEG: y = -y
+	if dc & _FZNEG: z = -z
+	return x, y, z
+
+def _decode_colr(r, g, b, e):
+	'''Decode an RGBE color (see colr_color() in color.c)'''
+	if not e:
+		return 0.0, 0.0, 0.0
+	f = math.ldexp(1.0, e - (128 + 8))
+	return (r + .5) * f, (g + .5) * f, (b + .5) * f
+
+
+class AmbientRecords(object):
+	'''Columnar store of decoded ambient records.
+	Each name in AMB_FIELDS is an attribute holding an array.array of
+	the respective values, plus "recno" with the (1-based) position of each
+	record in the ambient file, which stays with the record on selection.
+	'''
+	fields = AMB_FIELDS + ('recno',)
+	_typecodes = {'lvl': 'b', 'corral': 'L', 'recno': 'L'}
+
+	def __init__(self):
+		for name in self.fields:
+			setattr(self, name, array(str(self._typecodes.get(name, 'd'))))
+
+	def __len__(self):
+		return len(self.recno)
+
+	def columns(self, names):
+		return [getattr(self, n) for n in names]
+
+	def extend(self, other):
+		for name in self.fields:
+			getattr(self, name).extend(getattr(other, name))
+
+	def take(self, indices):
+		'''Return a new instance with the records at the given indices.'''
+		res = AmbientRecords()
+		for name in self.fields:
+			col = getattr(self, name)
+			getattr(res, name).extend([col[i] for i in indices])
+		return res
+
+	def slice(self, start, stop):
+		'''Return a new instance with a contiguous range of records.'''
+		res = AmbientRecords()
+		for name in self.fields:
+			getattr(res, name).extend(getattr(self, name)[start:stop])
+		return res
+
+	def select(self, func, names=('lvl', 'weight')):
+		'''Return a new instance with the records for which func() is true.
+		func() is called with the values of the named fields as arguments.
+		'''
+		cols = self.columns(names)
+		return self.take([i for i, vals in enumerate(zip(*cols))
+				if func(*vals)])
+
+	def filter_level_weight(self, level=-1, minwt=0.0):
+		'''Keep the records at one ambient level (if level >= 0)
+		with a weight of at least minwt.
+		'''
+		if level < 0:
+			return self.select(lambda wt: wt >= minwt, names=('weight',))
+		return self.select(lambda lvl, wt: lvl == level and wt >= minwt)
+
+	def decimate(self, ncells, maxper=1, by='weight', merge=False):
+		'''Return a new instance with at most maxper records per grid cell.
+		- ncells
+		  The number of cubic cells along the largest extent of the record
+		  positions. The result will have no more than maxper*ncells**3
+		  records, independently of the number of input records.
+		- by
+		  'weight' keeps the records with the highest weights,
+		  'level' those with the lowest ambient level (then highest weight).
+		- merge
+		  Merge all records of a cell into the best ranked one, at the
+		  weighted centroid of their positions, with their weighted average
+		  value and the largest radii found (ignores maxper).
+		Records are returned in file order.
+		'''
+		if not len(self) or ncells < 1:
+			return self
+		x0, y0, z0 = min(self.px), min(self.py), min(self.pz)
+		size = max(max(self.px)-x0, max(self.py)-y0, max(self.pz)-z0)
+		f = ncells / size if size > 0 else 0.0
+		top = ncells - 1
+		cells = {}
+		for i, (x, y, z) in enumerate(zip(self.px, self.py, self.pz)):
+			key = (min(int((x-x0)*f), top), min(int((y-y0)*f), top),
+					min(int((z-z0)*f), top))
+			try: cells[key].append(i)
+			except KeyError: cells[key] = [i]
+		wt = self.weight
+		if by == 'weight':
+			rank = lambda i: -wt[i]
+		elif by == 'level':
+			lvl = self.lvl
+			rank = lambda i: (lvl[i], -wt[i])
+		else:
+			raise Error('Unknown decimation criterion "%s"' % by)
+		if merge:
+			groups = [sorted(idx, key=rank) for idx in cells.values()]
+			groups.sort(key=lambda g: g[0])
+			return self._merge(groups)
+		keep = []
+		for idx in cells.values():
+			if len(idx) <= maxper: keep.extend(idx)
+			else: keep.extend(heapq.nsmallest(maxper, idx, key=rank))
+		keep.sort()
+		return self.take(keep)
+
+	def _merge(self, groups):
+		res = self.take([g[0] for g in groups])
+		wt = self.weight
+		for j, g in enumerate(groups):
+			if len(g) < 2: continue
+			wsum = sum([wt[i] for i in g])
+			if wsum > 0: ws = [wt[i] / wsum for i in g]
+			else: ws = [1.0 / len(g)] * len(g)
+			for name in ('px', 'py', 'pz', 'vr', 'vg', 'vb'):
+				col = getattr(self, name)
+				getattr(res, name)[j] = sum([w*col[i] for w, i in zip(ws, g)])
+			for name in ('r0', 'r1'):
+				col = getattr(self, name)
+				getattr(res, name)[j] = max([col[i] for i in g])
+		return res
+
+	def lookamb_lines(self, extra=('recno',)):
+		'''Generate text lines as "lookamb -h -d" would, with the
+		fields named in extra appended.
+		'''
+		cols = self.columns(AMB_FIELDS + tuple(extra))
+		fmt = '\t'.join(['%.9g'] * 9 + ['%d'] + ['%.9g'] * 10
+				+ ['%d'] * (1 + len(extra))) + '\n'
+		for vals in zip(*cols):
+			yield fmt % vals
+
+
+class AmbientFile(object):
+	'''A Radiance ambient file, with its header parsed on opening.
+	- header
+	  The list of information header lines (as text, without newlines).
+	- nrecs
+	  The number of complete records in the file.
+	'''
+	def __init__(self, fn):
+		self.fn = fn
+		try:
+			with open(fn, 'rb') as f:
+				self.header, self.datastart = self._read_header(f)
+			size = os.path.getsize(fn)
+		except (IOError, OSError) as e:
+			raise Error('Unable to read ambient file "%s" - %s'
+					% (fn, getattr(e, 'strerror', e)))
+		self.nrecs = (size - self.datastart) // RECSIZE
+
+	def _read_header(self, f):
+		hdr = read_header(self.fn)
+		fmt = hdr.format
+		if fmt and fmt != AMBFMT:
+			raise Error('Wrong format "%s" in ambient file "%s"'
+					% (fmt, self.fn))
+		f.seek(hdr.headerend)
+		magic = f.read(2)
+		if len(magic) < 2 or struct.unpack('>h', magic)[0] != AMBMAGIC:
+			raise Error('Unsupported ambient file version in "%s"' % self.fn)
+		return [hdr.magic] + hdr.lines, f.tell()
+
+	def get_option(self, opt):
+		'''Return the string following the first occurrence of opt in the
+		header (eg. "-aa" on the rendering command line), or None.
+		'''
+		for line in self.header:
+			words = line.split()
+			if opt in words[:-1]:
+				return words[words.index(opt) + 1]
+		return None
+
+	def iter_chunks(self, start=0, stop=None, chunksize=CHUNKSIZE):
+		'''Generate AmbientRecords for consecutive ranges of records.'''
+		if stop is None or stop > self.nrecs:
+			stop = self.nrecs
+		if start >= stop:
+			return
+		with open(self.fn, 'rb') as f:
+			mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			try:
+				full = struct.Struct(str('>' + _REC_FMT * chunksize))
+				for first in range(start, stop, chunksize):
+					n = min(chunksize, stop - first)
+					if n == chunksize: st = full
+					else: st = struct.Struct(str('>' + _REC_FMT * n))
+					vals = st.unpack_from(mm, self.datastart + first*RECSIZE)
+					yield self._decode(vals, first)
+			finally:
+				mm.close()
+
+	def read(self, start=0, stop=None, chunksize=CHUNKSIZE):
+		'''Return an AmbientRecords instance for a range of records.'''
+		res = AmbientRecords()
+		for chunk in self.iter_chunks(start, stop, chunksize):
+			res.extend(chunk)
+		return res
+
+	def _decode(self, vals, first):
+		cols = [vals[i::_REC_NFIELDS] for i in range(_REC_NFIELDS)]
+		recs = AmbientRecords()
+		recs.lvl.extend(cols[0])
+		recs.weight.extend(_decode_flts(cols[1], cols[2]))
+		recs.px.extend(_decode_flts(cols[3], cols[4]))
+		recs.py.extend(_decode_flts(cols[5], cols[6]))
+		recs.pz.extend(_decode_flts(cols[7], cols[8]))
+		for dcol, names in ((cols[9], ('nx', 'ny', 'nz')),
+				(cols[10], ('ux', 'uy', 'uz'))):
+			for name, vcol in zip(names, zip(*map(_decode_dir, dcol))):
+				getattr(recs, name).extend(vcol)
+		for name, vcol in zip(('vr', 'vg', 'vb'),
+				zip(*map(_decode_colr, cols[11], cols[12], cols[13], cols[14]))):
+			getattr(recs, name).extend(vcol)
+		for i, name in zip(range(15, 27, 2),
+				('r0', 'r1', 'pg0', 'pg1', 'dg0', 'dg1')):
+			getattr(recs, name).extend(_decode_flts(cols[i], cols[i+1]))
+		recs.corral.extend(cols[27])
+		recs.recno.extend(range(first + 1, first + 1 + len(cols[0])))
+		return recs
+
+
+### end of pyrad_amb.py
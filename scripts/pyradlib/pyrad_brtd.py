@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+''' pyrad_brtd.py - Evaluate BRTDfunc materials without rendering
+
+Use as:
+	from pyradlib.pyrad_brtd import BRTDEvaluator, check_library
+
+	ev = BRTDEvaluator()
+	for mat in ev.read('glazings.rad'):
+		refl, trans = mat.evaluate([1.0, 0.5, 0.1], front=False)
+
+	for problem in check_library('glazings.rad'):
+		print(problem)
+
+The reflectance and transmittance expressions of a BRTDfunc are compiled
+once per function file and expression text (see pyrad_cal.py), and then
+evaluated for each material and incidence angle. Materials generated by
+glaze.py share a handful of distinct expressions, so checking thousands of
+them takes seconds, instead of building scenes for rtrace.
+
+Totals include the diffuse components given by the first nine real
+arguments (front reflectance, back reflectance, transmittance).
+The BRTD functions (string arguments 7-9) are not evaluated, as they
+would need to be integrated over the hemisphere.
+'''
+from __future__ import division, print_function, unicode_literals
+
+import re
+import math
+
+from pyradlib.pyrad_proc import Error
+from pyradlib.pyrad_cal import Calc, RayState
+from pyradlib.pyrad_scene import SceneReader, Command
+
+# Weights of the gray value that glaze.py writes into its comments.
+GRAY = (0.265, 0.670, 0.065)
+DEFAULT_ANGLES = (0, 10, 20, 30, 40, 50, 60, 70, 80, 89)
+
+# Comments written by glaze.py before each material.
+_NH_KEYS = (
+	('ext_refl', '# Exterior normal hemispherical reflectance:'),
+	('int_refl', '# Interior normal hemispherical reflectance:'),
+	('trans', '# Normal hemispherical transmittance:'),
+)
+_BRTD_LINE = re.compile(r'^\s*\S+\s+BRTDfunc\s+(\S+)')
+
+
+class BRTDMaterial(object):
+	'''One BRTDfunc primitive, ready for evaluation.'''
+	def __init__(self, prim, funcs):
+		self.name = prim.ident
+		self.funcs = funcs # 3 reflectance, 3 transmittance
+		if len(prim.rargs) < 9:
+			raise Error('BRTDfunc "%s" needs at least 9 real arguments'
+					% prim.ident)
+		try: self.args = [float(a) for a in prim.rargs]
+		except ValueError:
+			raise Error('Bad real argument for BRTDfunc "%s"' % prim.ident)
+		self.front_diffuse = self.args[0:3]
+		self.back_diffuse = self.args[3:6]
+		self.trans_diffuse = self.args[6:9]
+		self.comments = {}
+
+	def evaluate(self, cosines, front=True):
+		'''Return the total reflectance and transmittance as two lists of
+		three lists (r, g, b), with one value for each incidence cosine.
+		front=False means rays arriving against the surface normal, which
+		is the exterior side of glaze.py materials.'''
+		sign = 1 if front else -1
+		ray = RayState(args=self.args)
+		rdiff = self.front_diffuse if front else self.back_diffuse
+		refl = [[], [], []]
+		trans = [[], [], []]
+		for c in cosines:
+			ray.set_rdot(sign * c)
+			try:
+				for i in range(3):
+					refl[i].append(self.funcs[i](ray) + rdiff[i])
+					trans[i].append(self.funcs[i+3](ray)
+							+ self.trans_diffuse[i])
+			except (ValueError, OverflowError, ZeroDivisionError) as e:
+				raise Error('Evaluation of BRTDfunc "%s" failed at Rdot=%g'
+						' - %s' % (self.name, ray.Rdot, e))
+		return refl, trans
+
+
+class BRTDEvaluator(object):
+	'''Compiles the BRTDfunc materials of scene files, sharing one Calc
+	per function file and one compiled function per expression.'''
+	def __init__(self):
+		self._calcs = {}
+		self._funcs = {}
+
+	def _calc(self, funcfile):
+		calc = self._calcs.get(funcfile)
+		if calc is None:
+			calc = Calc()
+			if funcfile != '.':
+				calc.load(funcfile)
+			self._calcs[funcfile] = calc
+		return calc
+
+	def _func(self, funcfile, text):
+		key = (funcfile, text)
+		func = self._funcs.get(key)
+		if func is None:
+			func = self._calc(funcfile).compile_expr(text)
+			self._funcs[key] = func
+		return func
+
+	def material(self, prim):
+		'''Return a BRTDMaterial for a BRTDfunc primitive.'''
+		if len(prim.sargs) < 10:
+			raise Error('BRTDfunc "%s" needs at least 10 string arguments'
+					% prim.ident)
+		funcfile = prim.sargs[9]
+		funcs = [self._func(funcfile, s) for s in prim.sargs[0:6]]
+		return BRTDMaterial(prim, funcs)
+
+	def read(self, fn):
+		'''Return the BRTDfunc materials of a scene file, with the normal
+		hemispherical values from the glaze.py comments (if any) in
+		the "comments" dictionary of each.'''
+		comments = _read_comments(fn)
+		mats = []
+		for prim in SceneReader(fn):
+			if isinstance(prim, Command) or prim.otype != 'BRTDfunc':
+				continue
+			mat = self.material(prim)
+			mat.comments = comments.get(prim.ident, {})
+			mats.append(mat)
+		return mats
+
+
+def _read_comments(fn):
+	'''Map material names to the glaze.py comments preceding them.'''
+	res = {}
+	pending = {}
+	try:
+		with open(fn) as f:
+			for line in f:
+				for key, prefix in _NH_KEYS:
+					if line.startswith(prefix):
+						try: pending[key] = float(line[len(prefix):])
+						except ValueError: pass
+				m = _BRTD_LINE.match(line)
+				if m:
+					res[m.group(1)] = pending
+					pending = {}
+	except (IOError, OSError) as e:
+		raise Error('Unable to read "%s" - %s'
+				% (fn, getattr(e, 'strerror', e)))
+	return res
+
+def gray(rgb):
+	return sum([w * v for w, v in zip(GRAY, rgb)])
+
+
+def check_material(mat, angles=DEFAULT_ANGLES, tol=0.01):
+	'''Return a list of problems with a material: energy not conserved
+	(reflectance + transmittance outside [0, 1]) on either side at any of
+	the incidence angles (in degrees), or normal incidence values that
+	differ by more than tol from the glaze.py comments.'''
+	cosines = [math.cos(math.radians(a)) for a in angles]
+	problems = []
+	res = {}
+	for front in (True, False):
+		refl, trans = mat.evaluate(cosines, front)
+		res[front] = refl, trans
+		side = 'interior' if front else 'exterior'
+		for i, ch in enumerate('rgb'):
+			for k, a in enumerate(angles):
+				tot = refl[i][k] + trans[i][k]
+				if (tot > 1 + 1e-6 or refl[i][k] < -1e-6
+						or trans[i][k] < -1e-6):
+					problems.append('%s: %s %s refl %.4g + trans %.4g at %g'
+							' degrees' % (mat.name, side, ch, refl[i][k],
+								trans[i][k], a))
+	if mat.comments and angles and angles[0] == 0:
+		normal = {
+			'ext_refl': gray([c[0] for c in res[False][0]]),
+			'int_refl': gray([c[0] for c in res[True][0]]),
+			'trans': gray([c[0] for c in res[False][1]]),
+		}
+		for key, prefix in _NH_KEYS:
+			if key in mat.comments:
+				if abs(normal[key] - mat.comments[key]) > tol:
+					problems.append('%s: %s %.4g, computed %.4g'
+							% (mat.name, prefix[2:], mat.comments[key],
+								normal[key]))
+	return problems
+
+def check_library(fn, angles=DEFAULT_ANGLES, tol=0.01, evaluator=None):
+	'''Check all BRTDfunc materials in fn, and return the list of problems.'''
+	ev = evaluator or BRTDEvaluator()
+	problems = []
+	for mat in ev.read(fn):
+		problems.extend(check_material(mat, angles, tol))
+	return problems
+
+
+### end of pyrad_brtd.py
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+''' pyrad_cache.py - Persistent per-user cache for generated files
+
+Use as:
+	from pyradlib.pyrad_cache import FileCache
+
+	cache = FileCache('octrees')
+	key = cache.make_key(files=radfiles, extra=[context, ' '.join(xfargs)])
+	octree = cache.lookup(key, '.oct')
+	if not octree:
+		tmpname = cache.tempname('.oct')
+		... build the octree into tmpname ...
+		octree = cache.store(tmpname, key, '.oct')
+
+Entries are files named by a hash over the contents of the input files
+and any additional strings that influence the result. Only the named
+files are hashed, not what they may reference themselves (eg. through
+"!command" lines, instance octrees or pattern data files).
+The cache directory is capped in size (sum of all entries of all caches),
+and the least recently used entries are deleted first.
+
+Entries that are updated while in use (eg. ambient files) can be locked
+by any number of concurrent users. Each one gets a lock file of its own,
+and locked entries are never evicted:
+
+	lck = cache.lock(ambfile)
+	try: ...
+	finally: cache.unlock(lck)
+
+Small files that should persist (eg. the calibration table of
+pyrad_cost.py) go into the "state" subdirectory of the root, which is
+never evicted:
+
+	fn = state_file('calibration.json')
+	write_state('calibration.json', text)
+
+Environment variables:
+	PYRAD_CACHE      the cache root directory
+	                 (default: %LOCALAPPDATA%\\pyrad or $XDG_CACHE_HOME/pyrad
+	                 or ~/.cache/pyrad)
+	PYRAD_CACHESIZE  the size cap in megabytes (default: 1024)
+'''
+from __future__ import division, print_function, unicode_literals
+
+import os
+import time
+import errno
+import socket
+import hashlib
+import tempfile
+
+from pyradlib.pyrad_proc import Error
+
+DEFAULT_CACHESIZE = 1024 # MB
+# Lock files of processes we can't check are considered stale after this.
+LOCK_MAXAGE = 7 * 24 * 3600
+_BLOCKSIZE = 1 << 20
+STATE_DIR = 'state'
+
+
+def cache_root():
+	'''Return the root directory of all pyrad caches.'''
+	root = os.environ.get('PYRAD_CACHE')
+	if root:
+		return root
+	if os.name == 'nt' and os.environ.get('LOCALAPPDATA'):
+		return os.path.join(os.environ['LOCALAPPDATA'], 'pyrad')
+	base = (os.environ.get('XDG_CACHE_HOME')
+			or os.path.join(os.path.expanduser('~'), '.cache'))
+	return os.path.join(base, 'pyrad')
+
+def state_file(name):
+	'''Return the path of a persistent file in the state directory.'''
+	return os.path.join(cache_root(), STATE_DIR, name)
+
+def write_state(name, text):
+	'''Replace the contents of a persistent file in the state directory,
+	such that concurrent readers see either the old or the new text.'''
+	fn = state_file(name)
+	dirname = os.path.dirname(fn)
+	tmpname = None
+	try:
+		if not os.path.isdir(dirname):
+			os.makedirs(dirname)
+		fd, tmpname = tempfile.mkstemp(suffix='.tmp', dir=dirname)
+		with os.fdopen(fd, 'w') as f:
+			f.write(text)
+		_replace(tmpname, fn)
+	except (IOError, OSError) as e:
+		if tmpname:
+			try: os.remove(tmpname)
+			except OSError: pass
+		raise Error('Unable to write "%s" - %s'
+				% (fn, getattr(e, 'strerror', e)))
+
+def cache_size():
+	'''Return the size cap of the cache root in bytes.'''
+	try: mb = float(os.environ.get('PYRAD_CACHESIZE', DEFAULT_CACHESIZE))
+	except ValueError:
+		raise Error('Invalid value for PYRAD_CACHESIZE: "%s"'
+				% os.environ['PYRAD_CACHESIZE'])
+	return int(mb * 1024 * 1024)
+
+def hash_file(h, fn):
+	'''Feed the contents of a file into the hash object h.'''
+	try:
+		with open(fn, 'rb') as f:
+			block = f.read(_BLOCKSIZE)
+			while block:
+				h.update(block)
+				block = f.read(_BLOCKSIZE)
+	except (IOError, OSError) as e:
+		raise Error('Unable to read file "%s" - %s'
+				% (fn, getattr(e, 'strerror', e)))
+
+def _replace(src, dst):
+	'''Rename src to dst, replacing dst (os.replace() is Py3 only).'''
+	try: os.rename(src, dst)
+	except OSError:
+		# Windows refuses to rename onto an existing file
+		if os.path.exists(dst):
+			os.remove(dst)
+			os.rename(src, dst)
+		else: raise
+
+
+class FileCache(object):
+	'''A named subdirectory of the cache root.'''
+	def __init__(self, name, root=None, maxsize=None):
+		self.root = root or cache_root()
+		self.dir = os.path.join(self.root, name)
+		self.maxsize = cache_size() if maxsize is None else maxsize
+		try:
+			if not os.path.isdir(self.dir):
+				os.makedirs(self.dir)
+		except OSError as e:
+			if not os.path.isdir(self.dir):
+				raise Error('Unable to create cache directory "%s" - %s'
+						% (self.dir, e.strerror))
+
+	def make_key(self, files=(), extra=()):
+		'''Return a hex digest over the contents of files and the strings
+		in extra (in this order).'''
+		h = hashlib.sha1()
+		for fn in files:
+			hash_file(h, fn)
+			h.update(b'\0')
+		for s in extra:
+			h.update(s.encode('utf-8'))
+			h.update(b'\0')
+		return h.hexdigest()
+
+	def path(self, key, suffix=''):
+		return os.path.join(self.dir, key + suffix)
+
+	def lookup(self, key, suffix=''):
+		'''Return the path of a cached entry, or None.
+		Marks the entry as recently used.'''
+		fn = self.path(key, suffix)
+		if not os.path.isfile(fn):
+			return None
+		try: os.utime(fn, None)
+		except OSError: pass
+		return fn
+
+	def tempname(self, suffix=''):
+		'''Return the name of a new empty file inside the cache directory,
+		to build an entry in before storing it.'''
+		try:
+			fd, fn = tempfile.mkstemp(suffix=suffix + '.tmp', dir=self.dir)
+			os.close(fd)
+		except (IOError, OSError) as e:
+			raise Error('Unable to create file in cache directory "%s" - %s'
+					% (self.dir, getattr(e, 'strerror', e)))
+		return fn
+
+	def store(self, fn, key, suffix=''):
+		'''Move the file fn into the cache as the entry for key, and return
+		its new path. Evicts older entries if the cache is too big.'''
+		dst = self.path(key, suffix)
+		try: _replace(fn, dst)
+		except OSError as e:
+			raise Error('Unable to store "%s" in cache - %s'
+					% (fn, e.strerror))
+		self.evict(keep=dst)
+		return dst
+
+	def discard(self, fn):
+		'''Remove a temporary or damaged entry, ignoring errors.'''
+		try: os.remove(fn)
+		except OSError: pass
+
+	def evict(self, keep=None):
+		'''Delete the least recently used entries of all caches under the
+		root, until their total size is below the cap.
+		The entry "keep", locked entries and the state directory are spared.
+		'''
+		entries = []
+		total = 0
+		for dirpath, dirnames, filenames in os.walk(self.root):
+			if dirpath == self.root and STATE_DIR in dirnames:
+				dirnames.remove(STATE_DIR)
+			for name in filenames:
+				fn = os.path.join(dirpath, name)
+				try: st = os.stat(fn)
+				except OSError: continue
+				total += st.st_size
+				entries.append((st.st_mtime, st.st_size, fn))
+		if total <= self.maxsize:
+			return
+		entries.sort()
+		for mtime, size, fn in entries:
+			if fn == keep or fn.endswith('.lck') or self.is_locked(fn):
+				continue
+			if fn.endswith('.tmp') and mtime > time.time() - 3600:
+				continue # probably still being built
+			self.discard(fn)
+			total -= size
+			if total <= self.maxsize:
+				break
+
+	def lock(self, fn):
+		'''Create a lock file for the entry fn, and return its name.'''
+		lck = '%s.%s.%d.lck' % (fn, socket.gethostname(), os.getpid())
+		try:
+			with open(lck, 'w') as f:
+				f.write('%d\n' % os.getpid())
+		except (IOError, OSError) as e:
+			raise Error('Unable to create lock file "%s" - %s'
+					% (lck, getattr(e, 'strerror', e)))
+		return lck
+
+	def unlock(self, lck):
+		'''Remove a lock file created by lock().'''
+		self.discard(lck)
+
+	def is_locked(self, fn):
+		'''Return True if fn has at least one live lock file.
+		Stale lock files of dead processes are removed on the way.'''
+		dirname, name = os.path.split(fn)
+		prefix = name + '.'
+		try: names = os.listdir(dirname)
+		except OSError: return False
+		host = socket.gethostname()
+		locked = False
+		for lname in names:
+			if not (lname.startswith(prefix) and lname.endswith('.lck')):
+				continue
+			lck = os.path.join(dirname, lname)
+			parts = lname[len(prefix):-4].rsplit('.', 1)
+			if self._lock_alive(lck, parts, host):
+				locked = True
+			else:
+				self.discard(lck)
+		return locked
+
+	def _lock_alive(self, lck, parts, host):
+		if len(parts) == 2 and parts[0] == host and os.name == 'posix':
+			try:
+				os.kill(int(parts[1]), 0)
+			except ValueError:
+				return False
+			except OSError as e:
+				return e.errno == errno.EPERM
+			return True
+		try: return os.path.getmtime(lck) > time.time() - LOCK_MAXAGE
+		except OSError: return False
+
+
+### end of pyrad_cache.py
@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+''' pyrad_cal.py - Evaluate Radiance function files (*.cal) in Python
+
+Use as:
+	from pyradlib.pyrad_cal import Calc, RayState
+
+	calc = Calc() # with rayinit.cal from RAYPATH
+	calc.load('glaze1.cal')
+	func = calc.compile_expr('if(Rdot, A11, A14)')
+	print(func(RayState(rdot=0.7, args=reals)))
+
+The definitions of all loaded files are translated into Python lambdas
+(once, on the first compile_expr() after a load), which are then called
+with a RayState giving the ray variables (Rdot, Nx, Dx, ...) and the real
+arguments for arg(n). Calling the same compiled function for many rays
+and argument lists avoids parsing or walking the expression trees again.
+
+Supported is the subset of the calcomp language that material function
+files use: variable definitions (name = expr; or constant name : expr;),
+function definitions (name(a, b) = expr;), {nested comments}, the
+operators + - * / ^ and the builtin functions of calcomp and rtrace
+(if, select, sqrt, exp, log, log10, sin, cos, tan, asin, acos, atan,
+atan2, floor, ceil, rand, arg). Contexts (name`ctx), $N variables and
+the other rcalc extensions are not.
+'''
+from __future__ import division, print_function, unicode_literals
+
+import os
+import re
+import math
+import random
+
+from pyradlib.pyrad_proc import Error
+
+# Ray variables that rtrace provides to materials.
+RAYVARS = ('Rdot', 'RdotP', 'Nx', 'Ny', 'Nz', 'NxP', 'NyP', 'NzP',
+		'Dx', 'Dy', 'Dz', 'Px', 'Py', 'Pz', 'Ux', 'Uy', 'Uz',
+		'Vx', 'Vy', 'Vz', 'T', 'Ts', 'S', 'Lu', 'Lv')
+
+# Used if rayinit.cal can't be found.
+RAYINIT_FALLBACK = '''
+PI : 3.14159265358979323846;
+DEGREE : PI/180;
+FTINY : 1e-7;
+sq(x) : x*x;
+abs(x) : if(x, x, -x);
+sgn(x) : if(x, 1, if(-x, -1, 0));
+max(a,b) : if(a-b, a, b);
+min(a,b) : if(a-b, b, a);
+and(a,b) : if(a, b, a);
+or(a,b) : if(a, a, b);
+not(a) : if(a, -1, 1);
+''' + ''.join(['A%d = arg(%d);\n' % (i, i) for i in range(1, 100)])
+
+_TOKENS = re.compile(r'''
+	\s*(?:
+	(?P<num>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+	|(?P<name>[A-Za-z_][\w.]*)
+	|(?P<op>[-+*/^(),;=:])
+	)''', re.VERBOSE)
+
+_MATHFUNCS = ('sqrt', 'exp', 'log', 'log10', 'sin', 'cos', 'tan',
+		'asin', 'acos', 'atan', 'atan2', 'floor', 'ceil')
+
+
+def find_calfile(fn):
+	'''Return the path of a function file, looked up on RAYPATH like
+	Radiance does, or None.'''
+	if os.path.isabs(fn) or os.path.isfile(fn):
+		return fn if os.path.isfile(fn) else None
+	for d in os.environ.get('RAYPATH', '.').split(os.pathsep):
+		p = os.path.join(d, fn)
+		if os.path.isfile(p):
+			return p
+	return None
+
+def _strip_comments(text):
+	res = []
+	depth = 0
+	for piece in re.split(r'([{}])', text):
+		if piece == '{':
+			depth += 1
+		elif piece == '}':
+			depth = max(0, depth - 1)
+		elif not depth:
+			res.append(piece)
+	return ''.join(res)
+
+def _tokenize(text, where):
+	toks = []
+	pos = 0
+	text = text.rstrip()
+	while pos < len(text):
+		m = _TOKENS.match(text, pos)
+		if not m or m.end() == pos:
+			raise Error('Syntax error in %s near "%s"'
+					% (where, text[pos:pos+20].strip()))
+		toks.append((m.lastgroup, m.group(m.lastgroup)))
+		pos = m.end()
+	return toks
+
+
+class _Parser(object):
+	'''Recursive descent parser, producing nested tuples:
+	('num', v), ('name', n), ('call', n, [args]), ('neg', e),
+	('op', o, a, b).'''
+	def __init__(self, toks, where):
+		self.toks = toks
+		self.pos = 0
+		self.where = where
+
+	def peek(self):
+		if self.pos < len(self.toks):
+			return self.toks[self.pos][1]
+		return None
+
+	def take(self, expect=None):
+		if self.pos >= len(self.toks):
+			raise Error('Unexpected end of %s' % self.where)
+		kind, val = self.toks[self.pos]
+		if expect is not None and val != expect:
+			raise Error('Expected "%s" in %s, found "%s"'
+					% (expect, self.where, val))
+		self.pos += 1
+		return kind, val
+
+	def definitions(self):
+		'''Yield (name, params, const, expr) for each statement.'''
+		while self.pos < len(self.toks):
+			if self.peek() == ';':
+				self.pos += 1
+				continue
+			kind, name = self.take()
+			if kind != 'name':
+				raise Error('Expected a name in %s, found "%s"'
+						% (self.where, name))
+			params = None
+			if self.peek() == '(':
+				self.take('(')
+				params = []
+				while self.peek() != ')':
+					kind, p = self.take()
+					if kind != 'name':
+						raise Error('Bad parameter "%s" of %s in %s'
+								% (p, name, self.where))
+					params.append(p)
+					if self.peek() == ',':
+						self.take()
+				self.take(')')
+			kind, op = self.take()
+			if op not in ('=', ':'):
+				raise Error('Expected "=" or ":" after %s in %s'
+						% (name, self.where))
+			expr = self.expr()
+			if self.pos < len(self.toks):
+				self.take(';')
+			yield name, params, op == ':', expr
+
+	def expr(self):
+		e = self.term()
+		while self.peek() in ('+', '-'):
+			op = self.take()[1]
+			e = ('op', op, e, self.term())
+		return e
+
+	def term(self):
+		e = self.power()
+		while self.peek() in ('*', '/'):
+			op = self.take()[1]
+			e = ('op', op, e, self.power())
+		return e
+
+	def power(self):
+		# right associative, with unary minus binding tighter than in
+		# Python: calcomp reads -x^2 as (-x)^2
+		e = self.unary()
+		if self.peek() == '^':
+			self.take()
+			e = ('op', '^', e, self.power())
+		return e
+
+	def unary(self):
+		if self.peek() == '-':
+			self.take()
+			return ('neg', self.unary())
+		if self.peek() == '+':
+			self.take()
+			return self.unary()
+		return self.primary()
+
+	def primary(self):
+		kind, val = self.take()
+		if kind == 'num':
+			return ('num', float(val))
+		if kind == 'name':
+			if self.peek() == '(':
+				self.take('(')
+				args = []
+				while self.peek() != ')':
+					args.append(self.expr())
+					if self.peek() == ',':
+						self.take()
+					elif self.peek() != ')':
+						raise Error('Expected "," or ")" in %s' % self.where)
+				self.take(')')
+				return ('call', val, args)
+			return ('name', val)
+		if val == '(':
+			e = self.expr()
+			self.take(')')
+			return e
+		raise Error('Unexpected "%s" in %s' % (val, self.where))
+
+
+class RayState(object):
+	'''The ray variables and real arguments a material is evaluated with.
+	The ray hits a surface with normal (0,0,1) at the origin, from the
+	front if rdot > 0, with an incidence angle of acos(abs(rdot)).'''
+	def __init__(self, rdot=1.0, args=()):
+		self.args = [float(a) for a in args]
+		self.set_rdot(rdot)
+		self.Px = self.Py = self.Pz = 0.0
+		self.Nx = self.Ny = 0.0
+		self.Nz = 1.0
+		self.NxP, self.NyP, self.NzP = self.Nx, self.Ny, self.Nz
+		self.Ux, self.Uy, self.Uz = 1.0, 0.0, 0.0
+		self.Vx, self.Vy, self.Vz = 0.0, 1.0, 0.0
+		self.T = self.Ts = self.S = 1.0
+		self.Lu = self.Lv = 0.0
+
+	def set_rdot(self, rdot):
+		self.Rdot = self.RdotP = rdot
+		# Rdot is the cosine between the reversed ray and the normal
+		self.Dx = math.sqrt(max(0.0, 1 - rdot * rdot))
+		self.Dy = 0.0
+		self.Dz = -rdot
+
+	def arg(self, n):
+		n = int(n)
+		if n == 0:
+			return float(len(self.args))
+		try: return self.args[n - 1]
+		except IndexError:
+			raise Error('Missing real argument %d' % n)
+
+
+def _select(n, *vals):
+	n = int(n)
+	if n == 0:
+		return float(len(vals))
+	return vals[n - 1]
+
+def _pow(a, b):
+	try: return math.pow(a, b)
+	except (ValueError, OverflowError):
+		raise Error('Illegal power %g^%g' % (a, b))
+
+def _div(a, b):
+	if b == 0:
+		raise Error('Division by zero')
+	return a / b
+
+
+class Calc(object):
+	'''A set of definitions from function files and strings.'''
+	def __init__(self, rayinit=True):
+		self.defs = {} # name -> (params, const, expr)
+		self._ns = None
+		self.files = []
+		if rayinit:
+			fn = find_calfile('rayinit.cal')
+			if fn: self.load(fn)
+			else: self.load_string(RAYINIT_FALLBACK, 'rayinit fallback')
+
+	def load(self, fn):
+		'''Add the definitions of a function file (found on RAYPATH).'''
+		path = find_calfile(fn)
+		if not path:
+			raise Error('Function file "%s" not found on RAYPATH' % fn)
+		try:
+			with open(path) as f:
+				text = f.read()
+		except (IOError, OSError) as e:
+			raise Error('Unable to read function file "%s" - %s'
+					% (path, getattr(e, 'strerror', e)))
+		self.load_string(text, '"%s"' % path)
+		self.files.append(path)
+
+	def load_string(self, text, where='definitions'):
+		p = _Parser(_tokenize(_strip_comments(text), where), where)
+		for name, params, const, expr in p.definitions():
+			self.defs[name] = (params, const, expr)
+		self._ns = None
+
+	def compile_expr(self, text, where=None):
+		'''Return a function of a RayState that evaluates text.'''
+		where = where or 'expression "%s"' % text
+		p = _Parser(_tokenize(_strip_comments(text), where), where)
+		expr = p.expr()
+		if p.pos != len(p.toks):
+			raise Error('Trailing input in %s' % where)
+		ns = self._namespace()
+		return eval('lambda r: ' + self._code(expr, {}), ns)
+
+	def _namespace(self):
+		if self._ns is not None:
+			return self._ns
+		ns = {'math': math, '_select': _select, '_pow': _pow,
+				'_div': _div, '_rand': random.random, 'V': {}, 'F': {}}
+		for name, (params, const, expr) in self.defs.items():
+			if params is None:
+				src = 'lambda r: ' + self._code(expr, {})
+				func = eval(src, ns)
+				if const:
+					func = self._const(func)
+				ns['V'][name] = func
+			else:
+				pmap = dict([(p, 'p%d' % i) for i, p in enumerate(params)])
+				src = 'lambda r%s: %s' % (
+						''.join([', p%d' % i for i in range(len(params))]),
+						self._code(expr, pmap))
+				ns['F'][name] = eval(src, ns)
+		self._ns = ns
+		return ns
+
+	def _const(self, func):
+		cache = []
+		def const(r):
+			if not cache:
+				cache.append(func(r))
+			return cache[0]
+		return const
+
+	def _code(self, e, pmap):
+		kind = e[0]
+		if kind == 'num':
+			return repr(e[1])
+		if kind == 'neg':
+			return '(-%s)' % self._code(e[1], pmap)
+		if kind == 'op':
+			a = self._code(e[2], pmap)
+			b = self._code(e[3], pmap)
+			if e[1] == '^':
+				return '_pow(%s, %s)' % (a, b)
+			if e[1] == '/':
+				return '_div(%s, %s)' % (a, b)
+			return '(%s %s %s)' % (a, e[1], b)
+		if kind == 'name':
+			name = e[1]
+			if name in pmap:
+				return pmap[name]
+			if name in self.defs:
+				if self.defs[name][0] is not None:
+					raise Error('Function %s used as a variable' % name)
+				return 'V[%r](r)' % name
+			if name in RAYVARS:
+				return 'r.%s' % name
+			raise Error('Undefined variable %s' % name)
+		# call
+		name, args = e[1], [self._code(a, pmap) for a in e[2]]
+		if name in self.defs:
+			params = self.defs[name][0]
+			if params is None or len(params) != len(args):
+				raise Error('Bad call of %s with %d arguments'
+						% (name, len(args)))
+			return 'F[%r](r%s)' % (name, ''.join([', ' + a for a in args]))
+		if name == 'if':
+			if len(args) != 3:
+				raise Error('if() needs 3 arguments')
+			return '(%s if %s > 0 else %s)' % (args[1], args[0], args[2])
+		if name == 'select':
+			return '_select(%s)' % ', '.join(args)
+		if name == 'arg':
+			return 'r.arg(%s)' % args[0]
+		if name == 'rand':
+			return '_rand()'
+		if name in _MATHFUNCS:
+			return 'math.%s(%s)' % (name, ', '.join(args))
+		raise Error('Undefined function %s' % name)
+
+
+### end of pyrad_cal.py
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+''' pyrad_cost.py - Predict time, memory and temp disk use of commands
+
+Use as:
+	from pyradlib.pyrad_cost import CostModel
+
+	model = CostModel()
+	est = model.estimate(['pfilt', '-x', '/2', '-y', '/2', 'big.hdr'])
+	print(est.seconds, est.memory, est.disk, est.npixels)
+
+	model.record(est.key, est.basis, est.size, seconds, memory, disk)
+	model.save()
+
+A command is measured by the number of pixels it reads and writes (from
+the resolution in the headers of its input pictures and its -x/-y options),
+or else by the total size of its input files (eg. octrees and scene files).
+For each tool, or chain of tools connected by pipes, time, peak memory and
+the size of the output are predicted as a linear function of that measure.
+The functions are fitted to previous runs, recorded in a calibration table
+in the state directory of the cache, with older runs gradually losing
+weight. Tools that were never recorded get a rough built-in guess, marked
+as such. Once a tool is calibrated, runs that match the prediction are not
+recorded, so that the table is only rewritten when something changed.
+
+Environment variables:
+	PYRAD_CACHE  the cache root directory (see pyrad_cache.py), with the
+	             calibration table in state/calibration.json
+'''
+from __future__ import division, print_function, unicode_literals
+
+import os
+import json
+
+from pyradlib.pyrad_proc import Error
+from pyradlib.pyrad_cache import state_file, write_state
+from pyradlib.pyrad_header import read_header
+
+CALIBRATION = 'calibration.json'
+# weight of the recorded runs relative to a new one, so that a table
+# reflects the last few dozen runs of each tool
+DECAY = 0.95
+METRICS = ('seconds', 'memory', 'disk')
+MB = 1024 * 1024
+# A run isn't recorded if the table has this (decayed) number of runs
+# for it, and all measured values are within TOLERANCE of the prediction,
+# or within the absolute SLACK for small values.
+CALIBRATED_RUNS = 10
+TOLERANCE = 0.25
+SLACK = {'seconds': 0.1, 'memory': MB, 'disk': 64 * 1024}
+
+# Rough guesses (base, per unit) for uncalibrated tools
+GUESSES = {
+	'pixels': {'seconds': (0.01, 1e-6), 'memory': (2*MB, 4),
+			'disk': (0, 4)},
+	'bytes': {'seconds': (0.01, 1e-7), 'memory': (2*MB, 2),
+			'disk': (0, 1)},
+}
+GUESS_SECONDS_PER_PIXEL = {
+	'rpict': 1e-3,
+	'rtrace': 1e-3,
+	'mkillum': 1e-3,
+	'pfilt': 2e-7,
+}
+# tools keeping a whole picture in memory
+_FULL_PICTURE = ('pcompos', 'pfilt', 'pextrem', 'ximage', 'pcond')
+
+
+class Estimate(object):
+	'''Predicted cost of a command or chain.'''
+	def __init__(self, key, basis, size, npixels):
+		self.key = key
+		self.basis = basis
+		self.size = size # pixels or bytes, as given by basis
+		self.npixels = npixels # output resolution, if known
+		self.seconds = 0.0
+		self.memory = 0.0
+		self.disk = 0.0
+		self.calibrated = False
+
+	def __str__(self):
+		return '%.3g s, %.1f MB, %.1f MB out%s' % (self.seconds,
+				self.memory / MB, self.disk / MB,
+				'' if self.calibrated else ' (guess)')
+
+
+def picture_resolution(fn):
+	'''Return (xres, yres) from a Radiance picture header, or None.'''
+	try: return read_header(fn).resolution
+	except Error:
+		return None
+
+def file_size(fn):
+	try: return os.path.getsize(fn)
+	except (OSError, TypeError):
+		return 0
+
+
+def _option(cmd, opt):
+	for i, a in enumerate(cmd[:-1]):
+		if a == opt:
+			return cmd[i+1]
+	return None
+
+def output_pixels(cmd, inpixels, data=None):
+	'''Predict the number of pixels a picture tool writes, or None.'''
+	tool = _toolname(cmd[0])
+	if tool == 'psign':
+		height = _option(cmd, '-h')
+		try: height = int(height) if height else 32
+		except ValueError:
+			return None
+		lines = data or [cmd[-1]]
+		width = max([len(l) for l in lines] + [1]) * height // 2
+		return width * height * len(lines)
+	xs, ys = _option(cmd, '-x'), _option(cmd, '-y')
+	if xs and ys:
+		if xs.startswith('/') and ys.startswith('/') and inpixels:
+			try: return int(inpixels[0] / float(xs[1:]) / float(ys[1:]))
+			except (ValueError, ZeroDivisionError):
+				return None
+		try: return int(xs) * int(ys)
+		except ValueError:
+			return None
+	if tool == 'pcompos':
+		return sum(inpixels) or None
+	if inpixels and tool in ('pcomb', 'pfilt', 'pcond', 'psign', 'pflip',
+			'protate', 'pcompos'):
+		return inpixels[0]
+	return None
+
+def _toolname(path):
+	return os.path.splitext(os.path.basename(path))[0]
+
+def _fit(stats):
+	'''Return (base, slope) of a least squares fit to decayed sums.'''
+	n, sx, sxx, sy, sxy = stats
+	if n <= 0:
+		return None
+	denom = n * sxx - sx * sx
+	if n >= 1.5 and denom > 1e-9 * max(n * sxx, 1):
+		slope = (n * sxy - sx * sy) / denom
+		if slope >= 0:
+			return (sy - slope * sx) / n, slope
+	# single run or constant size: proportional, or the mean
+	if sx > 0:
+		return 0.0, sy / sx
+	return sy / n, 0.0
+
+
+class CostModel(object):
+	def __init__(self):
+		self.path = state_file(CALIBRATION)
+		self.table = self._load(self.path)
+		self.recorded = {}
+
+	def _load(self, path):
+		try:
+			with open(path) as f:
+				table = json.load(f)
+		except (IOError, OSError, ValueError):
+			return {}
+		return table if isinstance(table, dict) else {}
+
+	def measure(self, cmdlines, inputs=(), known=None, data=None):
+		'''Return an Estimate (without the predicted values) for a chain of
+		command lines. inputs are additional input files (eg. stdin),
+		known maps file names to predicted pixel counts of files that
+		don't exist yet.'''
+		known = known or {}
+		tools = [_toolname(cmdl[0]) for cmdl in cmdlines]
+		pixels = 0
+		nbytes = 0
+		npixels = None
+		for i, cmdl in enumerate(cmdlines):
+			inpixels = []
+			files = list(cmdl[1:])
+			if i == 0:
+				files.extend([fn for fn in inputs if fn])
+			elif npixels:
+				inpixels.append(npixels)
+			for a in files:
+				if a in known:
+					if known[a]:
+						inpixels.append(known[a])
+					continue
+				if not os.path.isfile(a):
+					continue
+				res = picture_resolution(a)
+				if res:
+					inpixels.append(res[0] * res[1])
+				else: nbytes += file_size(a)
+			npixels = output_pixels(cmdl, inpixels,
+					data if i == 0 else None)
+			pixels += sum(inpixels) + (npixels or 0)
+		basis = 'pixels' if pixels else 'bytes'
+		return Estimate('|'.join(tools), basis, pixels or nbytes, npixels)
+
+	def estimate(self, cmdlines, inputs=(), known=None, data=None):
+		'''Return the Estimate for a command line or a chain of them.'''
+		if cmdlines and not isinstance(cmdlines[0], (list, tuple)):
+			cmdlines = [cmdlines]
+		est = self.measure(cmdlines, inputs, known, data)
+		entry = self.table.get('%s:%s' % (est.key, est.basis))
+		est.calibrated = bool(entry)
+		for metric in METRICS:
+			fit = entry and entry.get(metric) and _fit(entry[metric])
+			if not fit:
+				fit = self._guess(est, metric)
+			setattr(est, metric, max(0.0, fit[0] + fit[1] * est.size))
+		if not est.calibrated and est.basis == 'pixels':
+			# an upper bound for picture output, with no run length coding
+			est.disk = 4.0 * (est.npixels or 0)
+		return est
+
+	def _guess(self, est, metric):
+		base, slope = GUESSES[est.basis][metric]
+		tools = est.key.split('|')
+		if metric == 'seconds' and est.basis == 'pixels':
+			slope = max([GUESS_SECONDS_PER_PIXEL.get(t, slope) for t in tools])
+		if metric == 'memory' and not any(t in _FULL_PICTURE for t in tools):
+			# scanline based
+			slope = 0
+		return base, slope
+
+	def _expected(self, entry, metric, size, y):
+		'''Whether a calibrated entry already predicts y well enough.'''
+		stats = entry.get(metric)
+		if not stats or stats[0] < CALIBRATED_RUNS:
+			return False
+		base, slope = _fit(stats)
+		pred = max(0.0, base + slope * size)
+		return abs(y - pred) <= max(TOLERANCE * pred, SLACK[metric])
+
+	def record(self, key, basis, size, seconds, memory=None, disk=None):
+		'''Add a timed run to the calibration table, unless it matches the
+		prediction. memory may be None if it couldn't be determined.'''
+		values = list(zip(METRICS, (seconds, memory, disk)))
+		entry = self.table.get('%s:%s' % (key, basis), {})
+		if all(self._expected(entry, metric, size, y)
+				for metric, y in values if y is not None):
+			return
+		entry = self.table.setdefault('%s:%s' % (key, basis), {})
+		new = self.recorded.setdefault('%s:%s' % (key, basis), {})
+		for metric, y in values:
+			if y is None:
+				continue
+			for stats, w in ((entry, DECAY), (new, 1)):
+				old = stats.get(metric, [0, 0, 0, 0, 0])
+				stats[metric] = [w * old[0] + 1, w * old[1] + size,
+						w * old[2] + size * size, w * old[3] + y,
+						w * old[4] + size * y]
+
+	def save(self):
+		'''Merge the recorded runs into the calibration table on disk.
+		Concurrent saves may lose some runs, but never damage the table.'''
+		if not self.recorded:
+			return
+		table = self._load(self.path)
+		for key, new in self.recorded.items():
+			entry = table.setdefault(key, {})
+			for metric, stats in new.items():
+				old = entry.get(metric, [0, 0, 0, 0, 0])
+				w = DECAY ** stats[0]
+				entry[metric] = [w * o + s for o, s in zip(old, stats)]
+		write_state(CALIBRATION, json.dumps(table, sort_keys=True))
+		self.table = table
+		self.recorded = {}
+
+
+### end of pyrad_cost.py
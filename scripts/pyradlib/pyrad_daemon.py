@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+''' pyrad_daemon.py - Protocol between the pyradd server and pyradc client
+
+Use as:
+	from pyradlib.pyrad_daemon import socket_path, send_request, recv_request
+
+	# client
+	sock = connect(socket_path())
+	send_request(sock, {'tool': 'falsecolor', 'args': [...], ...}, [0, 1, 2])
+	status = recv_status(sock)
+
+	# server
+	req, fds = recv_request(conn)
+	...
+	send_status(conn, status)
+
+A request is a length prefixed JSON object, sent with the client's stdin,
+stdout and stderr file descriptors attached (SCM_RIGHTS), so that the
+server can run the script directly on the client's files and pipes.
+The reply is the exit status of the script as a signed 32 bit integer.
+This needs Unix domain sockets with descriptor passing (Python 3.3+).
+
+As the client hands over its environment and its terminal, both sides
+check that the other end of a connection runs as the same user (with
+SO_PEERCRED or LOCAL_PEERCRED), and refuse it otherwise. The default
+socket lives in a directory that only the user can access, either
+$XDG_RUNTIME_DIR, or pyradd-<uid> in the temp directory, which must be
+owned by the user and not accessible by others.
+
+Environment variables:
+	PYRAD_SOCKET  the socket path
+	              (default: pyradd.sock in $XDG_RUNTIME_DIR,
+	              or in pyradd-<uid> in the temp directory)
+'''
+from __future__ import division, print_function, unicode_literals
+
+import os
+import sys
+import json
+import stat
+import socket
+import struct
+import tempfile
+from array import array
+
+from pyradlib.pyrad_proc import Error
+
+# Scripts that the server runs; the others are always run locally.
+SERVED = ('falsecolor', 'phisto', 'pveil', 'rlux')
+MAXREQUEST = 1 << 20
+_LEN = struct.Struct('>I')
+_STATUS = struct.Struct('>i')
+_SOCKNAME = 'pyradd.sock'
+# getsockopt() on BSD and macOS, from <sys/un.h>
+_SOL_LOCAL = 0
+_LOCAL_PEERCRED = 1
+
+
+def available():
+	'''True if this platform and Python version can pass descriptors.'''
+	return (hasattr(socket, 'AF_UNIX') and hasattr(socket, 'SCM_RIGHTS')
+			and hasattr(socket.socket, 'sendmsg'))
+
+def _private_dir(path, create):
+	'''Check (and possibly create) a directory that only this user can
+	access. Return False if it doesn't exist, raise Error if it isn't
+	private.'''
+	if create:
+		try: os.mkdir(path, 0o700)
+		except OSError:
+			pass
+	try: st = os.lstat(path)
+	except OSError:
+		if create:
+			raise Error('Unable to create socket directory "%s"' % path)
+		return False
+	if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid()
+			or st.st_mode & 0o077):
+		raise Error('Socket directory "%s" is not private to this user'
+				' (set PYRAD_SOCKET to use another path)' % path)
+	return True
+
+def socket_path(create=False):
+	'''Return the socket path. Without PYRAD_SOCKET, its directory is
+	checked to be private, and created by the server (with create).'''
+	path = os.environ.get('PYRAD_SOCKET')
+	if path:
+		return path
+	rundir = os.environ.get('XDG_RUNTIME_DIR')
+	if not rundir:
+		rundir = os.path.join(tempfile.gettempdir(),
+				'pyradd-%d' % os.getuid())
+	if not _private_dir(rundir, create):
+		return None
+	return os.path.join(rundir, _SOCKNAME)
+
+def peer_uid(sock):
+	'''Return the user id of the process at the other end, or None if
+	this platform can't tell.'''
+	if hasattr(socket, 'SO_PEERCRED'): # Linux
+		creds = struct.Struct(str('3i'))
+		data = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+				creds.size)
+		return creds.unpack(data)[1]
+	if sys.platform == 'darwin' or 'bsd' in sys.platform:
+		# struct xucred: version, uid, ...
+		xucred = struct.Struct(str('Ii'))
+		try:
+			data = sock.getsockopt(_SOL_LOCAL, _LOCAL_PEERCRED, 76)
+		except socket.error:
+			return None
+		return xucred.unpack(data[:xucred.size])[1]
+	return None
+
+def check_peer(sock):
+	'''Raise Error unless the other end runs as this user.'''
+	uid = peer_uid(sock)
+	if uid != os.getuid():
+		raise Error('Refusing connection from %s' % ('unknown user'
+				if uid is None else 'user id %d' % uid))
+
+def connect(path):
+	'''Return a socket connected to the server, or None if there is none.
+	Raises Error if the server runs as another user.'''
+	if not available() or not path:
+		return None
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.connect(path)
+	except socket.error:
+		sock.close()
+		return None
+	try: check_peer(sock)
+	except Error:
+		sock.close()
+		raise
+	return sock
+
+def _recv_exact(sock, n):
+	buf = b''
+	while len(buf) < n:
+		data = sock.recv(n - len(buf))
+		if not data:
+			raise Error('Connection closed by peer')
+		buf += data
+	return buf
+
+def send_request(sock, req, fds):
+	data = json.dumps(req).encode('utf-8')
+	sock.sendmsg([_LEN.pack(len(data)) + data],
+			[(socket.SOL_SOCKET, socket.SCM_RIGHTS, array('i', fds))])
+
+def recv_request(conn, maxfds=3):
+	'''Return the request and the list of descriptors received with it.'''
+	fds = array('i')
+	msg, ancdata, flags, addr = conn.recvmsg(_LEN.size,
+			socket.CMSG_LEN(maxfds * fds.itemsize))
+	for level, ctype, cdata in ancdata:
+		if level == socket.SOL_SOCKET and ctype == socket.SCM_RIGHTS:
+			fds.frombytes(cdata[:len(cdata) - (len(cdata) % fds.itemsize)])
+	if len(msg) < _LEN.size:
+		msg += _recv_exact(conn, _LEN.size - len(msg))
+	n = _LEN.unpack(msg)[0]
+	if n > MAXREQUEST:
+		raise Error('Request too large (%d bytes)' % n)
+	req = json.loads(_recv_exact(conn, n).decode('utf-8'))
+	return req, list(fds)
+
+def send_status(conn, status):
+	conn.sendall(_STATUS.pack(status))
+
+def recv_status(sock):
+	return _STATUS.unpack(_recv_exact(sock, _STATUS.size))[0]
+
+
+### end of pyrad_daemon.py
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+''' pyrad_dedup.py - Replace repeated geometry in Radiance scenes by instances
+
+Use as:
+	from pyradlib.pyrad_dedup import dedup_scene
+
+	res = dedup_scene(radfiles, tempdir)
+	for grpfile, octfile in res.groups:
+		... oconv -f res.materials grpfile > octfile ...
+	... oconv res.scene > scene.oct ...
+	print(res.report(octsize, instsize, origsize))
+
+Surfaces are grouped by their identifier stem (everything before the last
+"."), as long as consecutive surfaces share the same stem. This matches
+the naming of most converters, which derive face names from the name of
+the object. Each group is moved to the position of its first vertex, and
+its coordinates are hashed after rounding them to a multiple of tol.
+Groups that occur at least MINCOUNT times and contain at least MINPRIMS
+surfaces are written once into a group file, and each occurrence is
+replaced by a "void instance" with a translation.
+Only translated copies are detected, not rotated or scaled ones.
+
+All other content (materials, sources, instances, meshes and unrepeated
+surfaces) is copied into the new scene file unchanged. All materials are
+also collected into a separate file, which has to be given to oconv before
+each group file, so that the instance octrees are complete ("oconv -f").
+Scenes with "!command" lines raise UnsupportedScene, as the output of the
+commands may define materials that the group files need.
+The input files are read twice, once to find the repetitions and once
+to write the result, so they are never held in memory as a whole.
+'''
+from __future__ import division, print_function, unicode_literals
+
+import os
+import hashlib
+
+from pyradlib.pyrad_proc import Error
+from pyradlib.pyrad_scene import SceneReader, Command, UnsupportedScene
+
+MINCOUNT = 2
+MINPRIMS = 8
+DEFAULT_TOL = 1e-6
+
+# Number of leading points in the real arguments of each surface type that
+# move with a translation. None means all of them.
+TRANSLATED = {
+	'polygon': None,
+	'sphere': 1,
+	'bubble': 1,
+	'cone': 2,
+	'cup': 2,
+	'cylinder': 2,
+	'tube': 2,
+	'ring': 1,
+}
+# Surfaces that are always copied unchanged.
+_OTHER_SURFACES = ('source', 'instance', 'mesh')
+
+
+def format_primitive(prim):
+	'''Return a primitive (or command) in Radiance scene syntax.'''
+	if isinstance(prim, Command):
+		return '!%s\n' % prim.command
+	def q(s):
+		if not s or ' ' in s or '\t' in s:
+			return '"%s"' % s
+		return s
+	if prim.otype == 'alias':
+		return '%s alias %s %s\n\n' % (prim.modifier, prim.ident,
+				q(prim.sargs[0]))
+	lines = ['%s %s %s' % (prim.modifier, prim.otype, prim.ident)]
+	for args in ([q(s) for s in prim.sargs], prim.iargs, prim.rargs):
+		lines.append(' '.join(['%d' % len(args)] + args))
+	return '\n'.join(lines) + '\n\n'
+
+
+class DedupResult(object):
+	def __init__(self, scene, materials):
+		self.scene = scene
+		self.materials = materials
+		self.groups = [] # (group file, octree file)
+		self.nprims = 0 # surfaces in the input
+		self.nkept = 0 # surfaces copied unchanged
+		self.nshared = 0 # surfaces in the group files
+		self.ninstances = 0
+
+	def report(self, octsize=None, instsize=None, origsize=None):
+		'''Return a one line summary of the reduction, with the sizes of
+		the new scene octree and instance octrees, and of the octree
+		of the original scene, if known.'''
+		nout = self.nkept + self.nshared + self.ninstances
+		s = ('%d surfaces -> %d (%d groups of %d surfaces, in %d instances)'
+				% (self.nprims, nout, len(self.groups), self.nshared,
+					self.ninstances))
+		if octsize is not None:
+			s += '; octree '
+			if origsize is not None:
+				s += '%s -> ' % _fmt_size(origsize)
+			s += _fmt_size(octsize)
+			if instsize:
+				s += ' + %s in instance octrees' % _fmt_size(instsize)
+		return s
+
+
+def _fmt_size(n):
+	for unit in ('bytes', 'kB', 'MB'):
+		if n < 1024:
+			return '%.4g %s' % (n, unit)
+		n /= 1024
+	return '%.4g GB' % n
+
+
+def _groups(files):
+	'''Yield ("prim", primitive) for content to copy, and ("group", stem,
+	[primitives]) for runs of translatable surfaces with the same stem.'''
+	for fn in files:
+		run = []
+		stem = None
+		for prim in SceneReader(fn):
+			if isinstance(prim, Command):
+				raise UnsupportedScene('"%s" contains a command: !%s'
+						% (fn, prim.command))
+			if prim.otype in TRANSLATED:
+				pstem = prim.ident.rsplit('.', 1)[0]
+				if run and pstem != stem:
+					yield ('group', stem, run)
+					run = []
+				stem = pstem
+				run.append(prim)
+				continue
+			if run:
+				yield ('group', stem, run)
+				run = []
+			yield ('prim', prim)
+		if run:
+			yield ('group', stem, run)
+
+def _floats(prim):
+	try: return [float(v) for v in prim.rargs]
+	except ValueError:
+		raise Error('Bad real argument for %s "%s"' % (prim.otype, prim.ident))
+
+def _translate(prims, tol):
+	'''Return the origin of a group (its first point), its signature and
+	the real arguments of each primitive, moved to the origin.'''
+	first = _floats(prims[0])
+	if len(first) < 3:
+		raise Error('Missing coordinates for %s "%s"'
+				% (prims[0].otype, prims[0].ident))
+	origin = first[:3]
+	h = hashlib.sha1()
+	moved = []
+	for prim in prims:
+		vals = first if prim is prims[0] else _floats(prim)
+		npts = TRANSLATED[prim.otype]
+		n = len(vals) if npts is None else min(len(vals), 3 * npts)
+		for i in range(0, n - n % 3, 3):
+			vals[i] -= origin[0]
+			vals[i+1] -= origin[1]
+			vals[i+2] -= origin[2]
+		moved.append(vals)
+		h.update(('%s %s %s %s %s\0' % (prim.modifier, prim.otype,
+				' '.join(prim.sargs), ' '.join(prim.iargs),
+				' '.join(['%d' % round(v / tol) for v in vals]))
+				).encode('utf-8'))
+	return origin, h.hexdigest(), moved
+
+
+def dedup_scene(files, outdir, tol=DEFAULT_TOL, mincount=MINCOUNT,
+		minprims=MINPRIMS):
+	'''Write a new scene with instances for repeated geometry to outdir.
+	Returns a DedupResult with the names of the scene file, the materials
+	file and the group files, with the octrees they need to be compiled to.
+	Raises UnsupportedScene for files with command lines.
+	'''
+	# pass 1: count the repetitions
+	counts = {}
+	for item in _groups(files):
+		if item[0] == 'group' and len(item[2]) >= minprims:
+			sig = _translate(item[2], tol)[1]
+			counts[sig] = counts.get(sig, 0) + 1
+
+	res = DedupResult(os.path.join(outdir, 'dedup.rad'),
+			os.path.join(outdir, 'materials.rad'))
+	octrees = {}
+	try:
+		with open(res.scene, 'w') as scene, \
+				open(res.materials, 'w') as mats:
+			# pass 2: write the result
+			for item in _groups(files):
+				if item[0] == 'prim':
+					prim = item[1]
+					text = format_primitive(prim)
+					scene.write(text)
+					if prim.otype in _OTHER_SURFACES:
+						res.nprims += 1
+						res.nkept += 1
+					else:
+						mats.write(text)
+					continue
+				stem, prims = item[1], item[2]
+				res.nprims += len(prims)
+				if len(prims) < minprims:
+					for prim in prims:
+						scene.write(format_primitive(prim))
+					res.nkept += len(prims)
+					continue
+				origin, sig, moved = _translate(prims, tol)
+				if counts[sig] < mincount:
+					for prim in prims:
+						scene.write(format_primitive(prim))
+					res.nkept += len(prims)
+					continue
+				octfile = octrees.get(sig)
+				if octfile is None:
+					n = len(res.groups)
+					grpfile = os.path.join(outdir, 'group%d.rad' % n)
+					octfile = os.path.join(outdir, 'group%d.oct' % n)
+					with open(grpfile, 'w') as grp:
+						for prim, vals in zip(prims, moved):
+							grp.write(format_primitive(prim._replace(
+									rargs=['%.12g' % v for v in vals])))
+					octrees[sig] = octfile
+					res.groups.append((grpfile, octfile))
+					res.nshared += len(prims)
+				res.ninstances += 1
+				scene.write('void instance %s.inst%d\n5 %s -t %s\n0\n0\n\n'
+						% (stem, res.ninstances,
+							octfile.replace('\\', '/'),
+							' '.join(['%.12g' % v for v in origin])))
+	except (IOError, OSError) as e:
+		raise Error('Unable to write deduplicated scene to "%s" - %s'
+				% (outdir, getattr(e, 'strerror', e)))
+	return res
+
+
+### end of pyrad_dedup.py
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+''' pyrad_header.py - Read and rewrite Radiance file headers without getinfo
+
+Use as:
+	from pyradlib.pyrad_header import read_header, splice
+
+	hdr = read_header('scene.hdr')
+	print(hdr.xres, hdr.yres, hdr.exposure, hdr.view, hdr.commands)
+	lines = hdr.select(re.compile('^(VIEW|EXPOSURE)='))
+
+	# a new header followed by the unchanged pixel data
+	with open('out.hdr', 'wb') as f:
+		hdr.write(f, extra=['EXPOSURE=2'])
+
+	# the whole file to stdout
+	splice('scene.hdr', sys.stdout)
+
+Only the header is read, with a single read of HEADER_CHUNK bytes for all
+but unusually long headers, so that header queries over many files never
+touch the pixel data. Pictures get their resolution line parsed as well.
+The same applies to octrees, ambient files and other Radiance files with
+an information header, which just have no resolution.
+
+Writing copies the pixel data with sendfile() where the platform has it,
+so that it never passes through Python, and with a plain copy loop
+otherwise (eg. on Windows and Python 2).
+'''
+from __future__ import division, print_function, unicode_literals
+
+import io
+import os
+import re
+import errno
+
+from pyradlib.pyrad_proc import Error
+
+HEADER_CHUNK = 8192
+HEADER_MAX = 1 << 20
+COPY_CHUNK = 1 << 16
+
+_VARPAT = re.compile(r'^\s*([A-Za-z_][A-Za-z0-9_-]*)=(.*)$')
+_RESPAT = re.compile(br'([-+])([XY]) (\d+) ([-+])([XY]) (\d+)\r?\n')
+
+
+def _product(values, n=1):
+	prod = [1.0] * n
+	for v in values:
+		try: vals = [float(w) for w in v.split()]
+		except ValueError: continue
+		if len(vals) == n:
+			prod = [p * x for p, x in zip(prod, vals)]
+	return prod
+
+
+class Header(object):
+	'''The information header of a Radiance file.
+	- lines
+	  The header lines after the "#?" line (as text, without newlines).
+	- magic
+	  The "#?" line, eg. "#?RADIANCE".
+	- headerend
+	  The file offset after the empty line that ends the header.
+	- resline, xres, yres
+	  The resolution line (without newline) and the picture size,
+	  or None if the file is no picture.
+	- datastart
+	  The file offset of the data (after the resolution line, if any).
+	'''
+	def __init__(self, fn, magic, lines, headerend,
+			resline=None, xres=None, yres=None, datastart=None):
+		self.fn = fn
+		self.magic = magic
+		self.lines = lines
+		self.headerend = headerend
+		self.resline = resline
+		self.xres = xres
+		self.yres = yres
+		self.datastart = headerend if datastart is None else datastart
+
+	def values(self, name):
+		'''Return the values of all "name=value" lines, in file order.'''
+		vals = []
+		for line in self.lines:
+			mo = _VARPAT.match(line)
+			if mo and mo.group(1) == name:
+				vals.append(mo.group(2).strip())
+		return vals
+
+	def get(self, name, default=None):
+		'''Return the value of the last "name=value" line, or default.'''
+		vals = self.values(name)
+		return vals[-1] if vals else default
+
+	@property
+	def format(self):
+		return self.get('FORMAT')
+
+	@property
+	def resolution(self):
+		'''(xres, yres), or None if the file is no picture.'''
+		if self.xres is None:
+			return None
+		return self.xres, self.yres
+
+	@property
+	def exposure(self):
+		'''Product of all EXPOSURE values (1.0 if there are none).'''
+		return _product(self.values('EXPOSURE'))[0]
+
+	@property
+	def colorcorr(self):
+		'''Product of all COLORCORR values, per channel.'''
+		return tuple(_product(self.values('COLORCORR'), 3))
+
+	@property
+	def pixaspect(self):
+		return _product(self.values('PIXASPECT'))[0]
+
+	@property
+	def primaries(self):
+		return self.get('PRIMARIES')
+
+	@property
+	def view(self):
+		'''The view options of all VIEW lines, the later ones overriding
+		the earlier ones when given to a Radiance program.'''
+		return ' '.join(self.values('VIEW'))
+
+	@property
+	def commands(self):
+		'''The lines that aren't variables, usually command lines.'''
+		return [line.strip() for line in self.lines
+				if line.strip() and not _VARPAT.match(line)]
+
+	def select(self, pattern):
+		'''Return the stripped lines matched by a compiled regex.'''
+		return [line.strip() for line in self.lines
+				if pattern.search(line.strip())]
+
+	def tobytes(self, lines=None, extra=()):
+		'''Return a header with lines (default: the original ones) and
+		extra lines, plus the resolution line, if any.'''
+		if lines is None:
+			lines = self.lines
+		parts = [self.magic] + list(lines) + list(extra) + ['']
+		if self.resline is not None:
+			parts.append(self.resline)
+		return ('\n'.join(parts) + '\n').encode('latin-1')
+
+	def write(self, out, lines=None, extra=()):
+		'''Write a header (as with tobytes()) to the binary file object
+		out, followed by the unchanged data of the original file.'''
+		data = self.tobytes(lines, extra)
+		if hasattr(out, 'flush'):
+			out.flush()
+		_write_all(out.fileno(), data)
+		splice(self.fn, out, self.datastart)
+
+
+def read_header(fn):
+	'''Return the Header of a Radiance file.'''
+	try:
+		with io.open(fn, 'rb', buffering=0) as f:
+			data = f.read(HEADER_CHUNK) or b''
+			if not data.startswith(b'#?'):
+				raise Error('Not a Radiance file: "%s"' % fn)
+			end = data.find(b'\n\n')
+			while end < 0 and len(data) < HEADER_MAX:
+				more = f.read(max(len(data), HEADER_CHUNK))
+				if not more:
+					break
+				data += more
+				end = data.find(b'\n\n', max(len(data) - len(more) - 1, 0))
+			if end >= 0 and len(data) < end + 2 + 64:
+				# the resolution line may be in the next chunk
+				data += f.read(64) or b''
+	except (IOError, OSError) as e:
+		raise Error('Unable to read header of "%s" - %s'
+				% (fn, getattr(e, 'strerror', e)))
+	if end < 0:
+		raise Error('Truncated or oversized header in "%s"' % fn)
+	text = data[:end].decode('latin-1').split('\n')
+	lines = [line.rstrip('\r') for line in text[1:]]
+	hdr = Header(fn, text[0].rstrip('\r'), lines, end + 2)
+	mo = _RESPAT.match(data, end + 2)
+	if mo:
+		first, second = int(mo.group(3)), int(mo.group(6))
+		if mo.group(2) == b'Y':
+			first, second = second, first
+		hdr.xres, hdr.yres = first, second
+		hdr.resline = mo.group(0).rstrip().decode('ascii')
+		hdr.datastart = mo.end()
+	return hdr
+
+
+def _write_all(fd, data):
+	view = memoryview(data)
+	while view:
+		n = os.write(fd, view)
+		view = view[n:]
+
+def splice(src, out, offset=0):
+	'''Copy the file src from offset to its end to the file object out.'''
+	if hasattr(out, 'flush'):
+		out.flush()
+	outfd = out.fileno()
+	try:
+		with io.open(src, 'rb', buffering=0) as f:
+			sendfile = getattr(os, 'sendfile', None)
+			if sendfile:
+				size = os.fstat(f.fileno()).st_size
+				try:
+					while offset < size:
+						n = sendfile(outfd, f.fileno(), offset, size - offset)
+						if n == 0:
+							break
+						offset += n
+					return
+				except OSError as e:
+					if e.errno not in (errno.EINVAL, errno.ENOSYS,
+							errno.ENOTSOCK, errno.EOPNOTSUPP):
+						raise
+					# not supported for these files, copy the rest
+			f.seek(offset)
+			while True:
+				data = f.read(COPY_CHUNK)
+				if not data:
+					break
+				_write_all(outfd, data)
+	except (IOError, OSError) as e:
+		raise Error('Unable to copy "%s" - %s'
+				% (src, getattr(e, 'strerror', e)))
+
+
+### end of pyrad_header.py
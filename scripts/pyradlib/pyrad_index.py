@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+''' pyrad_index.py - Index of picture headers and statistics in SQLite
+
+Use as:
+	from pyradlib.pyrad_index import open_index
+
+	index = open_index() # None if PYRAD_INDEX isn't set
+	if index:
+		entry = index.lookup('scene.hdr')
+		print(entry.xres, entry.yres, entry.exposure, entry.view)
+		histo = index.get_stat('scene.hdr', 'phisto')
+		if histo is None:
+			histo = ... compute it ...
+			index.set_stat('scene.hdr', 'phisto', histo)
+
+Each file is known by its absolute path, and an entry is valid as long as
+the size and modification time of the file are unchanged. With
+PYRAD_INDEX_HASH set, a file whose time has changed (eg. after copying
+it back from an archive) is hashed, and its entry stays valid if the
+contents are the same.
+
+An entry has the parsed header fields (see pyrad_header.py) and any number
+of statistics, which the scripts store under the name of the computation
+that produced them (eg. "phisto", "pextrem -o" or "findglare -r 400 -c -p").
+The statistics of a file are dropped when it changes. Header queries over
+many files only read the index, and the headers of new or changed files.
+
+The index is a single SQLite database file, which may be shared by
+concurrent processes. Without the sqlite3 module, there is no index.
+
+Environment variables:
+	PYRAD_INDEX       the index database file
+	PYRAD_INDEX_HASH  if set, revalidate changed files by their contents
+'''
+from __future__ import division, print_function, unicode_literals
+
+import os
+import hashlib
+
+try: import sqlite3
+except ImportError: sqlite3 = None
+
+from pyradlib.pyrad_proc import Error
+from pyradlib.pyrad_cache import hash_file
+from pyradlib.pyrad_header import read_header
+
+# statistics used by several scripts or for queries
+HISTO_STAT = 'phisto' # phisto output
+GLARE_STAT = 'glare sources' # number of glare sources found by pveil
+
+SCHEMA_VERSION = 1
+BUSY_TIMEOUT = 30 # seconds
+_FIELDS = ('path', 'size', 'mtime', 'hash', 'format', 'xres', 'yres',
+		'exposure', 'view', 'command', 'header')
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+	path TEXT PRIMARY KEY,
+	size INTEGER, mtime REAL, hash TEXT,
+	format TEXT, xres INTEGER, yres INTEGER,
+	exposure REAL, view TEXT, command TEXT, header TEXT);
+CREATE TABLE IF NOT EXISTS stats (
+	path TEXT, name TEXT, value,
+	PRIMARY KEY (path, name));
+'''
+
+
+def open_index(path=None):
+	'''Return the PictureIndex named by PYRAD_INDEX, or None.'''
+	path = path or os.environ.get('PYRAD_INDEX')
+	if not path or sqlite3 is None:
+		return None
+	return PictureIndex(path,
+			use_hash=bool(os.environ.get('PYRAD_INDEX_HASH')))
+
+
+class Entry(object):
+	'''The indexed header fields of a file, as attributes named after
+	_FIELDS. command holds the command lines of the header, one per line.
+	'''
+	def __init__(self, row):
+		for name, value in zip(_FIELDS, row):
+			setattr(self, name, value)
+
+	@property
+	def resolution(self):
+		if self.xres is None:
+			return None
+		return self.xres, self.yres
+
+
+class PictureIndex(object):
+	def __init__(self, path, use_hash=False):
+		self.path = path
+		self.use_hash = use_hash
+		try:
+			self.db = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+			version = self.db.execute('PRAGMA user_version').fetchone()[0]
+			if version != SCHEMA_VERSION:
+				with self.db:
+					self.db.execute('DROP TABLE IF EXISTS files')
+					self.db.execute('DROP TABLE IF EXISTS stats')
+					self.db.executescript(_SCHEMA)
+					self.db.execute('PRAGMA user_version = %d'
+							% SCHEMA_VERSION)
+		except sqlite3.Error as e:
+			raise Error('Unable to open index "%s" - %s' % (path, e))
+
+	def close(self):
+		self.db.close()
+
+	def _hash(self, fn):
+		h = hashlib.sha1()
+		hash_file(h, fn)
+		return h.hexdigest()
+
+	def _current(self, fn):
+		'''Return the valid Entry of fn, updating the index if the file is
+		new or changed, or None if it doesn't exist or isn't a Radiance
+		file.'''
+		key = os.path.abspath(fn)
+		try: st = os.stat(fn)
+		except OSError:
+			return None
+		size, mtime = st.st_size, st.st_mtime
+		try:
+			row = self.db.execute('SELECT %s FROM files WHERE path = ?'
+					% ', '.join(_FIELDS), (key,)).fetchone()
+			if row:
+				entry = Entry(row)
+				if entry.size == size and entry.mtime == mtime:
+					return entry
+				if (self.use_hash and entry.hash and entry.size == size
+						and entry.hash == self._hash(fn)):
+					with self.db:
+						self.db.execute('UPDATE files SET mtime = ? '
+								'WHERE path = ?', (mtime, key))
+					entry.mtime = mtime
+					return entry
+			try: hdr = read_header(fn)
+			except Error:
+				hdr = None
+			with self.db:
+				self.db.execute('DELETE FROM stats WHERE path = ?', (key,))
+				self.db.execute('DELETE FROM files WHERE path = ?', (key,))
+				if hdr is None:
+					return None
+				row = (key, size, mtime,
+						self._hash(fn) if self.use_hash else None,
+						hdr.format, hdr.xres, hdr.yres, hdr.exposure,
+						hdr.view, '\n'.join(hdr.commands),
+						'\n'.join([hdr.magic] + hdr.lines))
+				self.db.execute('INSERT INTO files (%s) VALUES (%s)'
+						% (', '.join(_FIELDS), ', '.join('?' * len(_FIELDS))),
+						row)
+			return Entry(row)
+		except sqlite3.Error as e:
+			raise Error('Unable to update index "%s" - %s' % (self.path, e))
+
+	def lookup(self, fn):
+		'''Return the Entry of fn, or None if it isn't a Radiance file.'''
+		return self._current(fn)
+
+	def get_stat(self, fn, name):
+		'''Return a statistic of the unchanged file fn, or None.'''
+		entry = self._current(fn)
+		if entry is None:
+			return None
+		try:
+			row = self.db.execute('SELECT value FROM stats '
+					'WHERE path = ? AND name = ?', (entry.path, name)).fetchone()
+		except sqlite3.Error as e:
+			raise Error('Unable to read index "%s" - %s' % (self.path, e))
+		if row is None:
+			return None
+		value = row[0]
+		if not isinstance(value, (bytes, type(''))):
+			value = bytes(value) # buffer on Py2
+		return value
+
+	def set_stat(self, fn, name, value):
+		'''Store a statistic (text or bytes) of the file fn.'''
+		entry = self._current(fn)
+		if entry is None:
+			return
+		if isinstance(value, bytes):
+			value = sqlite3.Binary(value) # a BLOB, not text
+		try:
+			with self.db:
+				self.db.execute('INSERT OR REPLACE INTO stats '
+						'(path, name, value) VALUES (?, ?, ?)',
+						(entry.path, name, value))
+		except sqlite3.Error as e:
+			raise Error('Unable to update index "%s" - %s' % (self.path, e))
+
+
+### end of pyrad_index.py
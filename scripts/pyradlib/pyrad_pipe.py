@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+''' pyrad_pipe.py - Declarative processing pipelines for Radiance scripts
+
+Use as:
+	from pyradlib.pyrad_pipe import Pipeline, PICTURE
+
+	pl = Pipeline(self) # a ProcMixin instance
+	sign = pl.temp(os.path.join(tmpdir, 'sign.hdr'), PICTURE)
+	pl.stage(['psign', '-h', '20'], 'create label', data=['Text'], out=sign)
+	pl.stage(['pcomb', '-e', 'lo=1-gi(1)', sign], 'invert label', out=outfn)
+	pl.run()
+
+Stages are declared with their command lines, where the pictures or
+records they read and write are given as Data objects instead of file
+names. Nothing is executed before run(). The optimiser then
+ - removes stages whose temporary output is never read,
+ - passes a temporary result through a pipe instead of a file, when it
+   has a single consumer directly following its producer.
+Stages connected by pipes are run together with call_one(), call_two()
+or call_many() of the ProcMixin. With -V (verbose) and -N (do nothing),
+the changes of the optimiser are reported before the commands, and -N
+adds the predicted cost of each step (see pyrad_cost.py). Real runs are
+timed and their peak memory taken as the sum over the processes of each
+step, and recorded in the calibration table for later predictions
+unless they match the current ones.
+'''
+from __future__ import division, print_function, unicode_literals
+
+import os
+import sys
+import time
+
+from pyradlib.pyrad_proc import PIPE, Error
+from pyradlib.pyrad_cost import CostModel, file_size, MB
+from pyradlib.pyrad_trace import span
+
+# Data types
+PICTURE = 'picture'
+RECORDS = 'records'
+TEXT = 'text'
+
+# tool: (input type, output type, stdin argument)
+# stdin argument: '-' replaces the file name, '' omits it,
+# None: no input file that can be read from stdin instead.
+TOOLS = {
+	'pcomb':   (PICTURE, PICTURE, '-'),
+	'pcompos': (PICTURE, PICTURE, '-'),
+	'pfilt':   (PICTURE, PICTURE, ''),
+	'pvalue':  (PICTURE, RECORDS, ''),
+	'pextrem': (PICTURE, TEXT, ''),
+	'psign':   (TEXT, PICTURE, None),
+	'rcalc':   (RECORDS, RECORDS, ''),
+	'histo':   (RECORDS, RECORDS, ''),
+	'total':   (RECORDS, RECORDS, ''),
+}
+
+
+class Data(object):
+	'''A picture, record stream or text, written by one stage and read
+	by others. Temporary data may be dropped or passed through a pipe.'''
+	def __init__(self, path, kind, temp=True):
+		self.path = path
+		self.kind = kind
+		self.temp = temp
+
+	def __repr__(self):
+		return 'Data(%r, %r)' % (self.path, self.kind)
+
+
+class Stage(object):
+	'''One command of a pipeline.'''
+	def __init__(self, cmd, actstr, out=None, _in=None, data=None):
+		self.cmd = list(cmd)
+		self.actstr = actstr
+		self.out = out
+		self._in = _in
+		self.data = data
+		self.pipe_in = None # the Data arriving through stdin
+		self.pipe_out = False
+
+	@property
+	def tool(self):
+		return os.path.splitext(os.path.basename(self.cmd[0]))[0]
+
+	def inputs(self):
+		res = [a for a in self.cmd if isinstance(a, Data)]
+		if isinstance(self._in, Data):
+			res.append(self._in)
+		return res
+
+	def cmdline(self):
+		args = []
+		for a in self.cmd:
+			if not isinstance(a, Data):
+				args.append(a)
+			elif a is self.pipe_in:
+				if TOOLS[self.tool][2]:
+					args.append(TOOLS[self.tool][2])
+			else: args.append(a.path)
+		return args
+
+	def stdin(self):
+		if self.data is not None:
+			return PIPE
+		if self.pipe_in is not None:
+			return None
+		if isinstance(self._in, Data):
+			return self._in.path
+		return self._in
+
+	def stdout(self):
+		if self.pipe_out:
+			return None
+		if isinstance(self.out, Data):
+			return self.out.path
+		return self.out
+
+
+def _memory(procs):
+	'''Peak memory of a chain in bytes, as the sum over its concurrent
+	processes, or None if not known for all of them.'''
+	rss = [getattr(p, 'pyrad_maxrss', None) for p in procs or ()]
+	if not rss or None in rss:
+		return None
+	return sum(rss)
+
+
+class Pipeline(object):
+	'''A sequence of stages, optimised and run as a whole.'''
+	def __init__(self, proc, limits=None):
+		self.proc = proc
+		self.limits = limits # for all stages, see pyrad_proc.Limits
+		self.stages = []
+		self.notes = []
+
+	def temp(self, path, kind):
+		'''Declare an intermediate result, which may never be written.'''
+		return Data(path, kind, temp=True)
+
+	def file(self, path, kind):
+		'''Declare a result that is kept.'''
+		return Data(path, kind, temp=False)
+
+	def stage(self, cmd, actstr, out=None, _in=None, data=None):
+		'''Add a stage. Data objects in cmd are its inputs, out is a Data,
+		a file name or None (stdout). _in is the same for the input, data
+		is a list of lines to write to stdin.'''
+		st = Stage(cmd, actstr, out=out, _in=_in, data=data)
+		types = TOOLS.get(st.tool)
+		if types:
+			for d in st.inputs():
+				if d.kind != types[0]:
+					raise Error('Unable to %s - %s input expected, got %s "%s"'
+							% (actstr, types[0], d.kind, d.path))
+			if isinstance(out, Data) and out.kind != types[1]:
+				raise Error('Unable to %s - %s output expected for "%s"'
+						% (actstr, types[1], out.path))
+		self.stages.append(st)
+		return st
+
+	def consumers(self, d):
+		return [st for st in self.stages if d in st.inputs()]
+
+	def producer(self, d):
+		for st in self.stages:
+			if st.out is d:
+				return st
+		return None
+
+	def optimize(self):
+		self.drop_unused()
+		self.make_pipes()
+
+	def drop_unused(self):
+		changed = True
+		while changed:
+			changed = False
+			for st in self.stages:
+				d = st.out
+				if isinstance(d, Data) and d.temp and not self.consumers(d):
+					self.stages.remove(st)
+					self.notes.append('dropped "%s", "%s" is never read'
+							% (st.actstr, d.path))
+					changed = True
+					break
+
+	def make_pipes(self):
+		for a, b in zip(self.stages, self.stages[1:]):
+			d = a.out
+			if (not isinstance(d, Data) or not d.temp
+					or TOOLS.get(b.tool, (0, 0, None))[2] is None
+					or b.data is not None or b._in not in (None, d)
+					or self.consumers(d) != [b]):
+				continue
+			if b._in is not d:
+				if b.cmd.count(d) != 1:
+					continue
+				if not TOOLS[b.tool][2] and (b.cmd[-1] is not d
+						or len(b.inputs()) != 1):
+					continue
+			a.pipe_out = True
+			b.pipe_in = d
+			self.notes.append('piped "%s" instead of a file' % d.path)
+
+	def chains(self):
+		'''Group the stages into chains connected by pipes.'''
+		chains = []
+		for st in self.stages:
+			if st.pipe_in is not None and chains:
+				chains[-1].append(st)
+			else: chains.append([st])
+		return chains
+
+	def _measure(self, model, chain, known=None):
+		first = chain[0]
+		_in = first.stdin()
+		return model.estimate([st.cmdline() for st in chain],
+				inputs=[_in] if _in not in (None, PIPE) else [],
+				known=known, data=first.data)
+
+	def plan(self, model=None):
+		'''Return the changes of the optimiser as text, and the predicted
+		cost of each step if a CostModel is given.'''
+		chains = self.chains()
+		lines = ['### plan: %d stages in %d steps'
+				% (len(self.stages), len(chains))]
+		for note in self.notes:
+			lines.append('### plan: %s' % note)
+		if model is None:
+			return '\n'.join(lines) + '\n'
+		known = {}
+		seconds, peak, disk = 0, 0, 0
+		for chain in chains:
+			est = self._measure(model, chain, known)
+			out = chain[-1].stdout()
+			if out is not None:
+				known[out] = est.npixels
+				disk += est.disk
+			seconds += est.seconds
+			peak = max(peak, est.memory)
+			lines.append('### cost: %s: %s'
+					% (', '.join([st.actstr for st in chain]), est))
+		lines.append('### cost: total %.3g s, peak %.1f MB, temp disk %.1f MB'
+				% (seconds, peak / MB, disk / MB))
+		return '\n'.join(lines) + '\n'
+
+	def run(self):
+		with span('optimize pipeline'):
+			self.optimize()
+		proc = self.proc
+		donothing = getattr(proc, 'donothing', None)
+		model = CostModel()
+		if getattr(proc, 'verbose', None) or donothing:
+			sys.stderr.write(self.plan(model if donothing else None))
+		for chain in self.chains():
+			if donothing:
+				self._run_chain(chain)
+				continue
+			t0 = time.time()
+			procs = self._run_chain(chain)
+			seconds = time.time() - t0
+			est = self._measure(model, chain)
+			out = chain[-1].stdout()
+			model.record(est.key, est.basis, est.size, seconds,
+					_memory(procs),
+					file_size(out) if out is not None else None)
+		# a broken calibration table is no reason to fail
+		try: model.save()
+		except Error: pass
+
+	def _run_chain(self, chain):
+		proc = self.proc
+		first, last = chain[0], chain[-1]
+		cmds = [st.cmdline() for st in chain]
+		_in = first.stdin()
+		out = last.stdout()
+		if len(chain) == 1:
+			procs = proc.call_one(cmds[0], first.actstr, _in=_in, out=out,
+					limits=self.limits)
+			procs = procs and (procs,)
+		elif len(chain) == 2:
+			procs = proc.call_two(cmds[0], cmds[1],
+					first.actstr, last.actstr, _in=_in, out=out,
+					limits=self.limits)
+		else:
+			procs = proc.call_many(cmds,
+					', '.join([st.actstr for st in chain]), _in=_in, out=out,
+					limits=self.limits)
+		if _in != PIPE or not procs:
+			return procs
+		try:
+			with span('write to %s' % first.tool, 'wait'):
+				for line in first.data:
+					# Py3 text is unicode, convert to ASCII
+					procs[0].stdin.write((line + '\n').encode())
+		finally:
+			procs[0].stdin.close()
+		proc.wait_chain(procs, [st.actstr for st in chain],
+				[proc.qjoin(cmdl) for cmdl in cmds], self.limits)
+		return procs
+
+
+### end of pyrad_pipe.py
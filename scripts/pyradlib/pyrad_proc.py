@@ -7,17 +7,307 @@ Use as:
 
 For a single-file installation, include the contents of this file
 at the same place (minus the __future__ import below).
+
+Resource limits for the spawned processes (Unix only) can be given per
+call (limits=Limits(...)), per instance (self.limits), or for all calls
+in the environment, eg.:
+	PYRAD_LIMITS="cpus=0-7,16 nice=10 memory=4G io=idle"
+They are applied in the child process before the program starts, which
+takes a preexec_fn for subprocess.Popen(). That isn't safe while other
+threads run (eg. those reading stderr, see below), so it is only used
+when there are limits, or on Python before 3.11 for the process groups.
+Failures to apply them, and processes failing under a memory limit or
+killed with SIGKILL (eg. by the out-of-memory killer) raise a
+ResourceError, which the scripts report with the exit status
+RESOURCE_EXIT, so that a batch system can run them again elsewhere.
+
+Each chain of processes runs in a process group of its own (Unix, unless
+it reads from a terminal). When one of its processes fails, the whole
+group is killed at once, and the error names the first failing stage.
+Time limits in seconds can be set per instance (self.timeout for all
+processes started by it, self.stage_timeout for each process), or in
+the environment:
+	PYRAD_TIMEOUT        overall deadline, counted from the first process
+	PYRAD_STAGE_TIMEOUT  maximum run time of each process
+Exceeding them also kills the group and raises a ResourceError.
+This applies to all calls that wait for their processes themselves,
+ie. with neither _in nor out being PIPE.
+
+The processes are reaped with os.wait4() where available, which leaves
+the peak memory of each one in its p.pyrad_maxrss attribute (in bytes,
+None if unknown).
+
+With PYRAD_TRACE set, the processes and the waits for them are
+recorded for a timeline (see pyrad_trace.py).
+
+The stderr output of each process is read by a thread of its own, which
+keeps the last lines (self.stderr_lines or PYRAD_STDERR_LINES, default
+20, 0 for no capture) and passes them on to our stderr if there is one,
+prefixed with the action string of the process in verbose mode. The
+kept lines are attached to the Error for a failing process, as its
+stderr_tail attribute, and also to its message if they weren't shown.
+Processes reading from a terminal write to stderr directly.
 '''
 from __future__ import division, print_function, unicode_literals
 
+import os
 import sys
+import time
+import atexit
+import signal
+import threading
 import subprocess
+from collections import deque
+try: import resource
+except ImportError: resource = None # Windows
 PIPE = subprocess.PIPE
 
+from pyradlib.pyrad_trace import get_tracer
+
+# EX_TEMPFAIL from sysexits.h
+RESOURCE_EXIT = 75
+
+# ioprio_set() system call numbers
+_IOPRIO_SYSCALLS = {
+	'x86_64': 251, 'amd64': 251, 'i386': 289, 'i686': 289,
+	'aarch64': 30, 'arm64': 30, 'riscv64': 30, 'armv7l': 314,
+	'ppc64': 273, 'ppc64le': 273, 's390x': 282,
+}
+_IOPRIO_CLASSES = {'rt': 1, 'be': 2, 'idle': 3}
+_SIZE_UNITS = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+# seconds between SIGTERM and SIGKILL when tearing down a chain
+KILL_GRACE = 2.0
+_POLL_MAX = 0.05
+DEFAULT_STDERR_LINES = 20
+# longer lines are cut in the kept tail
+_STDERR_LINELEN = 1000
+_stderr_lock = threading.Lock()
+# Popen(process_group=...) sets the group without a preexec_fn
+_POPEN_PROCESS_GROUP = sys.version_info >= (3, 11)
+
 
 class Error(Exception): pass
 
 
+class ResourceError(Error):
+	'''A process couldn't be started with its resource limits,
+	or probably failed because of them.'''
+
+
+def _parse_cpus(s):
+	cpus = set()
+	for part in s.split(','):
+		lo, sep, hi = part.partition('-')
+		cpus.update(range(int(lo), int(hi if sep else lo) + 1))
+	return cpus
+
+def _parse_size(s):
+	s = s.strip().lower().rstrip('b')
+	if s and s[-1] in _SIZE_UNITS:
+		return int(float(s[:-1]) * _SIZE_UNITS[s[-1]])
+	return int(s)
+
+
+class Limits(object):
+	'''Resource limits for spawned processes (Unix only):
+	- cpus
+	  A collection of CPU numbers to run on (Linux only).
+	- nice
+	  The nice level (negative values need privileges).
+	- memory
+	  The maximum address space in bytes (RLIMIT_AS).
+	- io
+	  The I/O scheduling class "rt", "be" or "idle", optionally
+	  with a level of 0-7 as in "be/7" (Linux only).
+	'''
+	def __init__(self, cpus=None, nice=None, memory=None, io=None):
+		self.cpus = set(cpus) if cpus is not None else None
+		self.nice = nice
+		self.memory = memory
+		self.io = io
+		self._ioprio = None
+		self._ioprio_set = None
+		self.check()
+
+	@classmethod
+	def from_string(cls, s):
+		'''Parse "key=value" items separated by whitespace, with the keys
+		cpus (eg. "0-7,16"), nice, memory (eg. "4G") and io.'''
+		kw = {}
+		try:
+			for item in s.split():
+				key, sep, val = item.partition('=')
+				if key == 'cpus': kw['cpus'] = _parse_cpus(val)
+				elif key == 'nice': kw['nice'] = int(val)
+				elif key in ('memory', 'mem'): kw['memory'] = _parse_size(val)
+				elif key == 'io': kw['io'] = val
+				else: raise ValueError(item)
+		except ValueError as e:
+			raise ResourceError('Invalid resource limits "%s" - %s' % (s, e))
+		return cls(**kw)
+
+	def __bool__(self):
+		return any(v is not None
+				for v in (self.cpus, self.nice, self.memory, self.io))
+	__nonzero__ = __bool__
+
+	def __str__(self):
+		items = []
+		if self.cpus is not None:
+			items.append('cpus=%s' % ','.join([str(c)
+				for c in sorted(self.cpus)]))
+		if self.nice is not None: items.append('nice=%d' % self.nice)
+		if self.memory is not None:
+			items.append('memory=%dM' % (self.memory >> 20))
+		if self.io is not None: items.append('io=%s' % self.io)
+		return ' '.join(items)
+
+	def check(self):
+		'''Fail early in the parent for limits that the child can't apply.'''
+		if not self:
+			return
+		if os.name != 'posix':
+			raise ResourceError('Resource limits are not supported on this'
+					' platform')
+		if self.cpus is not None:
+			if not hasattr(os, 'sched_setaffinity'):
+				raise ResourceError('CPU affinity is not supported on this'
+						' platform')
+			avail = os.sched_getaffinity(0)
+			if not self.cpus or not self.cpus.issubset(avail):
+				raise ResourceError('CPUs %s not available (have %s)'
+						% (sorted(self.cpus), sorted(avail)))
+		if self.nice is not None and self.nice < os.nice(0):
+			if os.geteuid() != 0:
+				raise ResourceError('Lowering the nice level to %d needs'
+						' privileges' % self.nice)
+		if self.memory is not None:
+			hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+			if self.memory <= 0 or (hard != resource.RLIM_INFINITY
+					and self.memory > hard):
+				raise ResourceError('Invalid memory limit %d (hard limit %d)'
+						% (self.memory, hard))
+		if self.io is not None:
+			self._setup_ioprio()
+
+	def _setup_ioprio(self):
+		import ctypes
+		import platform
+		cls, sep, level = self.io.partition('/')
+		nr = _IOPRIO_SYSCALLS.get(platform.machine().lower())
+		if cls not in _IOPRIO_CLASSES:
+			raise ResourceError('Unknown I/O class "%s"' % cls)
+		if not sys.platform.startswith('linux') or nr is None:
+			raise ResourceError('I/O priorities are not supported on this'
+					' platform')
+		try: level = int(level) if sep else 4
+		except ValueError: level = -1
+		if not 0 <= level <= 7:
+			raise ResourceError('Invalid I/O priority level in "%s"' % self.io)
+		if cls == 'idle': level = 0
+		libc = ctypes.CDLL(None, use_errno=True)
+		# resolved in the parent, so the child doesn't need to load anything
+		syscall = libc.syscall
+		self._ioprio_set = lambda: syscall(nr, 1, 0, # IOPRIO_WHO_PROCESS
+				(_IOPRIO_CLASSES[cls] << 13) | level)
+
+	def apply(self):
+		'''Apply the limits to the current process (the child, before exec).
+		'''
+		if self.cpus is not None:
+			os.sched_setaffinity(0, self.cpus)
+		if self.nice is not None:
+			os.nice(self.nice - os.nice(0))
+		if self.memory is not None:
+			resource.setrlimit(resource.RLIMIT_AS, (self.memory, self.memory))
+		if self._ioprio_set is not None:
+			if self._ioprio_set() != 0:
+				raise OSError('ioprio_set() failed')
+
+_env_limits = []
+# process groups that may still be running: {pgid: [Popen, ...]}
+_groups = {}
+
+def _kill_groups():
+	'''Kill what is left of the process groups when exiting, eg. after
+	an exception or a chain that the caller didn't wait for.'''
+	for pgid, procs in list(_groups.items()):
+		if any(p.poll() is None for p in procs):
+			try: os.killpg(pgid, signal.SIGTERM)
+			except OSError: pass
+	_groups.clear()
+atexit.register(_kill_groups)
+
+class _StderrTail(object):
+	'''Drains the stderr pipe of a process, keeping the last lines.'''
+	def __init__(self, stream, maxlines, forward, prefix):
+		self.lines = deque(maxlen=maxlines)
+		self.forward = forward
+		self.prefix = prefix
+		self.thread = threading.Thread(target=self.drain, args=(stream,))
+		self.thread.daemon = True
+		self.thread.start()
+
+	def drain(self, stream):
+		try:
+			while True:
+				line = stream.readline()
+				if not line:
+					break
+				if isinstance(line, bytes):
+					line = line.decode('utf-8', 'replace')
+				if self.forward:
+					with _stderr_lock:
+						try:
+							self.forward.write(self.prefix + line)
+							self.forward.flush()
+						except (IOError, OSError, ValueError): pass
+				self.lines.append(line.rstrip('\r\n')[:_STDERR_LINELEN])
+		finally:
+			stream.close()
+
+	def tail(self, timeout=1.0):
+		'''Return the kept lines, after waiting for the end of the output
+		(which may take longer if other processes inherited the pipe).'''
+		self.thread.join(timeout)
+		return list(self.lines)
+
+
+def _reap(p, block=True):
+	'''p.wait() (or p.poll() if not block), keeping the peak memory of the
+	process from os.wait4() in p.pyrad_maxrss.'''
+	if p.returncode is None and hasattr(os, 'wait4'):
+		try: pid, status, ru = os.wait4(p.pid, 0 if block else os.WNOHANG)
+		except OSError: pass # eg. EINTR in Py2, let Popen handle it
+		else:
+			if pid == 0:
+				return None
+			# kilobytes, except on macOS
+			p.pyrad_maxrss = ru.ru_maxrss * (
+					1 if sys.platform == 'darwin' else 1024)
+			if os.WIFSIGNALED(status):
+				p.returncode = -os.WTERMSIG(status)
+			else: p.returncode = os.WEXITSTATUS(status)
+			return p.returncode
+	return p.wait() if block else p.poll()
+
+
+def _env_number(name):
+	s = os.environ.get(name)
+	if not s:
+		return None
+	try: return float(s)
+	except ValueError:
+		raise Error('Invalid value for %s: "%s"' % (name, s))
+
+def env_limits():
+	'''Return the Limits from PYRAD_LIMITS (parsed once), or None.'''
+	if not _env_limits:
+		s = os.environ.get('PYRAD_LIMITS', '').strip()
+		_env_limits.append(Limits.from_string(s) if s else None)
+	return _env_limits[0]
+
+
 class ProcMixin():
 	'''Process and pipeline management for Python Radiance scripts
 	'''
@@ -72,6 +362,237 @@ class ProcMixin():
 			return s
 		return  ' '.join([_q(s) for s in sl])
 
+	def __limits(self, limits):
+		if limits is None:
+			limits = getattr(self, 'limits', None)
+		if limits is None:
+			limits = env_limits()
+		return limits or None
+
+	def __timeouts(self):
+		'''Return the deadline (absolute) and the stage timeout.'''
+		timeout = getattr(self, 'timeout', None)
+		if timeout is None:
+			timeout = _env_number('PYRAD_TIMEOUT')
+		stage_timeout = getattr(self, 'stage_timeout', None)
+		if stage_timeout is None:
+			stage_timeout = _env_number('PYRAD_STAGE_TIMEOUT')
+		deadline = None
+		if timeout:
+			try: started = self.__started
+			except AttributeError:
+				started = self.__started = time.time()
+			deadline = started + timeout
+		return deadline, stage_timeout
+
+	def __group(self, stdin, procs):
+		'''Return the process group id for the next process of a chain:
+		0 for a new group, or None to stay in ours.'''
+		if os.name != 'posix':
+			return None
+		if procs:
+			return procs[0].pid if procs[0].pyrad_pgid is not None else None
+		if self.__interactive(stdin):
+			# a terminal needs the process in the foreground group
+			return None
+		return 0
+
+	def __interactive(self, stdin):
+		'''True if stdin is our own and a terminal.'''
+		if stdin is not self._stdin or stdin == PIPE:
+			return False
+		try: return os.isatty(sys.stdin.fileno())
+		except (AttributeError, ValueError, OSError):
+			return True
+
+	def __popen(self, cmdl, actstr, limits, procs=(), **kwargs):
+		'''Start a process of a chain (procs are those already started),
+		in the process group of the chain and with resource limits applied
+		in the child.'''
+		limits = self.__limits(limits)
+		deadline = self.__timeouts()[0]
+		if deadline and time.time() > deadline:
+			self.__kill(procs)
+			raise ResourceError('Unable to %s - deadline of %g s exceeded'
+					% (actstr, deadline - self.__started))
+		pgid = self.__group(kwargs.get('stdin'), procs)
+		setpgid = pgid
+		if pgid is not None and _POPEN_PROCESS_GROUP:
+			kwargs['process_group'] = pgid
+			setpgid = None
+		if setpgid is not None or limits:
+			def preexec():
+				if setpgid is not None:
+					os.setpgid(0, setpgid)
+				if limits:
+					limits.apply()
+			kwargs['preexec_fn'] = preexec
+		nlines = getattr(self, 'stderr_lines', None)
+		if nlines is None:
+			nlines = _env_number('PYRAD_STDERR_LINES')
+		if nlines is None:
+			nlines = DEFAULT_STDERR_LINES
+		nlines = int(nlines)
+		stderr = self._stderr
+		if nlines > 0 and not self.__interactive(kwargs.get('stdin')):
+			stderr = PIPE
+		try:
+			p = subprocess.Popen(cmdl, stderr=stderr,
+					**dict(self._pipeargs, **kwargs))
+		except Exception as e:
+			self.__kill(procs)
+			if limits and not isinstance(e, EnvironmentError):
+				# a failure in preexec_fn, Py3 doesn't tell us more
+				raise ResourceError('Unable to %s - cannot apply resource'
+						' limits (%s)' % (actstr, limits))
+			self.raise_on_error(actstr, e)
+		p.pyrad_start = time.time()
+		p.pyrad_pgid = None
+		p.pyrad_stderr = None
+		p.pyrad_maxrss = None
+		if stderr == PIPE:
+			forward = self._stderr if self._stderr != PIPE else None
+			prefix = ''
+			if getattr(self, 'verbose', None):
+				prefix = '[%s: %s] ' % (actstr,
+						os.path.basename(cmdl[0]))
+			p.pyrad_stderr = _StderrTail(p.stderr, nlines, forward, prefix)
+		if pgid is not None:
+			p.pyrad_pgid = pgid or p.pid
+			# also from here, as the shells do, against the race with exec
+			try: os.setpgid(p.pid, p.pyrad_pgid)
+			except OSError: pass
+			_groups.setdefault(p.pyrad_pgid, []).append(p)
+		tracer = get_tracer()
+		if tracer:
+			tracer.process(p, cmdl, actstr, p.pyrad_start)
+		return p
+
+	def __kill(self, procs, sig=signal.SIGTERM):
+		'''Kill a chain, by its process group if it has one.'''
+		if not procs:
+			return
+		pgid = getattr(procs[0], 'pyrad_pgid', None)
+		if pgid is not None:
+			try: os.killpg(pgid, sig)
+			except OSError: pass
+			return
+		for p in procs:
+			if p.poll() is None:
+				try:
+					if sig == signal.SIGTERM: p.terminate()
+					else: p.kill()
+				except OSError: pass
+
+	def wait_chain(self, procs, actstrs, cmdstrs, limits=None):
+		'''Wait for a chain of processes started by call_one(), call_two()
+		or call_many(), with one action string and displayed command for
+		each. As soon as one of them fails or exceeds a timeout, kill all
+		of them, and raise an Error for the first failing stage.'''
+		tracer = get_tracer()
+		if not tracer:
+			return self.__wait_chain(procs, actstrs, cmdstrs, limits)
+		start = time.time()
+		try: self.__wait_chain(procs, actstrs, cmdstrs, limits)
+		finally:
+			for p in procs:
+				tracer.finished(p)
+			tracer.complete('wait for %s' % actstrs[-1], 'wait', start,
+					time.time())
+
+	def __wait_chain(self, procs, actstrs, cmdstrs, limits):
+		deadline, stage_timeout = self.__timeouts()
+		if len(procs) == 1 and not deadline and not stage_timeout:
+			try: res = _reap(procs[0])
+			except BaseException:
+				self.__kill(procs)
+				raise
+			finally: _groups.pop(procs[0].pyrad_pgid, None)
+			self.check_exit(actstrs[0], res, cmdstrs[0], limits,
+					stderr=procs[0].pyrad_stderr)
+			return
+		sigpipe = -getattr(signal, 'SIGPIPE', 13)
+		failed = None # (index, exit status or None, timeout or None)
+		killed = None
+		delay = 0.001
+		try:
+			while True:
+				running = []
+				for i, p in enumerate(procs):
+					res = _reap(p, False)
+					if res is None:
+						running.append(i)
+					elif res != 0 and (failed is None or (not killed
+							and failed[1] == sigpipe and res != sigpipe)):
+						# a stage dying of a broken pipe is a consequence
+						# of one further down failing
+						failed = (i, res, None)
+				if not running:
+					break
+				now = time.time()
+				if failed is None:
+					for i in running:
+						if (stage_timeout
+								and now - procs[i].pyrad_start > stage_timeout):
+							failed = (i, None, stage_timeout)
+							break
+					else:
+						if deadline and now > deadline:
+							failed = (running[0], None,
+									deadline - self.__started)
+				if failed is not None:
+					if killed is None:
+						self.__kill(procs)
+						killed = now
+					elif now - killed > KILL_GRACE:
+						self.__kill(procs, getattr(signal, 'SIGKILL',
+								signal.SIGTERM))
+				time.sleep(delay)
+				delay = min(delay * 2, _POLL_MAX)
+		except BaseException:
+			self.__kill(procs)
+			raise
+		finally:
+			_groups.pop(procs[0].pyrad_pgid, None)
+		if failed is None:
+			return
+		i, res, timeout = failed
+		note = ''
+		if len(procs) > 1:
+			note = ' (first failing stage %d of %d)' % (i + 1, len(procs))
+		if timeout is not None:
+			raise ResourceError('Unable to %s - timed out after %g s'
+					' in command [%s]%s.' % (actstrs[i], timeout,
+						cmdstrs[i].rstrip(), note))
+		self.check_exit(actstrs[i], res, cmdstrs[i], limits, note,
+				stderr=procs[i].pyrad_stderr)
+
+	def check_exit(self, actstr, res, cmdstr, limits=None, note='',
+			stderr=None):
+		'''Raise an Error if res is a nonzero exit status of the command
+		(displayed as cmdstr), or a ResourceError if it was killed or ran
+		out of memory with a limit. stderr is the captured output of the
+		process (p.pyrad_stderr), if any.'''
+		if res == 0:
+			return
+		msg = 'Nonzero exit (%d) from command [%s]%s.' % (res, cmdstr, note)
+		limits = self.__limits(limits)
+		tail = stderr.tail() if stderr else []
+		if tail and not stderr.forward:
+			msg += ''.join(['\n  ' + line for line in tail])
+		if res == -getattr(signal, 'SIGKILL', 9):
+			err = ResourceError('Unable to %s - %s Killed, possibly by'
+					' the out-of-memory killer.' % (actstr, msg))
+		elif limits and limits.memory is not None:
+			err = ResourceError('Unable to %s - %s Possibly out of memory'
+					' (limits: %s).' % (actstr, msg, limits))
+		else:
+			try: self.raise_on_error(actstr, msg)
+			except Error as e:
+				err = e
+		err.stderr_tail = tail
+		raise err
+
 	def __parse_args(self, _in, out):
 		try: self._strtypes
 		except AttributeError: self.__configure_subprocess()
@@ -102,7 +623,7 @@ class ProcMixin():
 		return stdin, stdout, instr, outstr
 
 	def call_one(self, cmdl, actstr, _in=None, out=None,
-			universal_newlines=False):
+			universal_newlines=False, limits=None):
 		'''Create a single subprocess, possibly with an incoming and outgoing
 		pipe at each end.
 		- cmdl
@@ -122,6 +643,9 @@ class ProcMixin():
 		    Pipe will be available in returned object for reading/writing.
 		  * None (default)
 		    System stdin/stdout will be used if available
+		- limits
+		  Resource limits (a Limits instance) instead of the defaults from
+		  self.limits or the environment.
 		If _in or out is a PIPE, the caller should call p.wait() on the
 		returned Popen instance after writing to and closing it.
 		'''
@@ -130,22 +654,17 @@ class ProcMixin():
 			sys.stderr.write('### %s \n' % actstr)
 			sys.stderr.write(self.qjoin(cmdl) + instr + outstr + '\n')
 		if not getattr(self, 'donothing', None):
-			try: p = subprocess.Popen(cmdl,
-					stdin=stdin, stdout=stdout, stderr=self._stderr,
-					universal_newlines=universal_newlines, **self._pipeargs)
-			except Exception as e:
-				self.raise_on_error(actstr, e)
+			p = self.__popen(cmdl, actstr, limits,
+					stdin=stdin, stdout=stdout,
+					universal_newlines=universal_newlines)
 			if stdin != PIPE and stdout != PIPE:
 				# caller needs to wait after reading or writing (else deadlock)
-				res = p.wait()
-				if res != 0:
-					self.raise_on_error(actstr,
-							'Nonzero exit (%d) from command [%s].'
-							% (res, self.qjoin(cmdl)+instr+outstr+'\n'))
+				self.wait_chain([p], [actstr],
+						[self.qjoin(cmdl)+instr+outstr+'\n'], limits)
 			return p
 
 	def call_two(self, cmdl_1, cmdl_2, actstr_1, actstr_2, _in=None, out=None,
-			universal_newlines=False):
+			universal_newlines=False, limits=None):
 		'''Create two processes, chained via a pipe, possibly with an incoming
 		and outgoing pipe at each end.
 		Returns a tuple of two Popen instances.
@@ -156,41 +675,27 @@ class ProcMixin():
 		'''
 		stdin, stdout, instr, outstr = self.__parse_args(_in, out)
 		if getattr(self, 'verbose', None):
-			sys.stderr.write('### %s \n' % actstr_1)
-			sys.stderr.write('### %s \n' % actstr_2)
-			sys.stderr.write(self.qjoin(cmdl_1) + instr + ' | ')
-		if not getattr(self, 'donothing', None):
-			try: p1 = subprocess.Popen(cmdl_1,
-					stdin=stdin, stdout=PIPE, stderr=self._stderr,
-					**self._pipeargs)
-			except Exception as e:
-				self.raise_on_error(actstr_1, e)
-		if getattr(self, 'verbose', None):
-			sys.stderr.write(self.qjoin(cmdl_2) + outstr + '\n')
+			# in one piece, before the processes can write to stderr
+			with _stderr_lock:
+				sys.stderr.write('### %s \n' % actstr_1)
+				sys.stderr.write('### %s \n' % actstr_2)
+				sys.stderr.write(self.qjoin(cmdl_1) + instr + ' | '
+						+ self.qjoin(cmdl_2) + outstr + '\n')
 		if not getattr(self, 'donothing', None):
-			try:
-				p2 = subprocess.Popen(cmdl_2,
-						stdin=p1.stdout, stdout=stdout, stderr=self._stderr, 
-						universal_newlines=universal_newlines, **self._pipeargs)
-				p1.stdout.close()
-			except Exception as e:
-				self.raise_on_error(actstr_2, e)
+			p1 = self.__popen(cmdl_1, actstr_1, limits,
+					stdin=stdin, stdout=PIPE)
+			p2 = self.__popen(cmdl_2, actstr_2, limits, procs=[p1],
+					stdin=p1.stdout, stdout=stdout,
+					universal_newlines=universal_newlines)
+			p1.stdout.close()
 			if stdin != PIPE and stdout != PIPE:
 				# caller needs to wait after reading or writing (else deadlock)
-				res = p1.wait()
-				if res != 0:
-					self.raise_on_error(actstr_1,
-							'Nonzero exit (%d) from command [%s].'
-							% (res, self.qjoin(cmdl_1)))
-				res = p2.wait()
-				if res != 0:
-					self.raise_on_error(actstr_2,
-							'Nonzero exit (%d) from command [%s].'
-							% (res, self.qjoin(cmdl_2)))
+				self.wait_chain([p1, p2], [actstr_1, actstr_2],
+						[self.qjoin(cmdl_1), self.qjoin(cmdl_2)], limits)
 			return p1, p2
 
 	def call_many(self, cmdlines, actstr, _in=None, out=None,
-			universal_newlines=False):
+			universal_newlines=False, limits=None):
 		'''Create a series of N processes, chained via pipes, possibly with an
 		incoming and outgoing pipe at each end.
 		Returns a tuple of N subprocess.Popen instances.
@@ -207,54 +712,41 @@ class ProcMixin():
 		if len(cmdlines) == 1:
 			# other than direct call_one(), this returns a one-item tuple!
 			return (self.call_one(cmdlines[0], actstr, _in=_in, out=out,
-					universal_newlines=universal_newlines),)
+					universal_newlines=universal_newlines, limits=limits),)
 		stdin, stdout, instr, outstr = self.__parse_args(_in, out)
 		procs = []
 		if getattr(self, 'verbose', None):
-			sys.stderr.write('### %s \n' % actstr)
-			sys.stderr.write(self.qjoin(cmdlines[0]) + instr + ' | ')
+			# in one piece, before the processes can write to stderr
+			with _stderr_lock:
+				sys.stderr.write('### %s \n' % actstr)
+				sys.stderr.write(self.qjoin(cmdlines[0]) + instr + ' | '
+						+ ''.join([self.qjoin(cmdl) + ' | '
+							for cmdl in cmdlines[1:-1]])
+						+ self.qjoin(cmdlines[-1]) + outstr + '\n')
 		if not getattr(self, 'donothing', None):
-			try:
-				prevproc = subprocess.Popen(cmdlines[0], stdin=stdin,
-						stdout=PIPE, stderr=self._stderr, **self._pipeargs)
-				procs.append(prevproc)
-			except Exception as e:
-				self.raise_on_error(actstr, e)
+			prevproc = self.__popen(cmdlines[0], actstr, limits,
+					stdin=stdin, stdout=PIPE)
+			procs.append(prevproc)
 
 		for cmdl in cmdlines[1:-1]:
-			if getattr(self, 'verbose', None):
-				sys.stderr.write(self.qjoin(cmdl) + ' | ')
 			if not getattr(self, 'donothing', None):
-				try:
-					nextproc = subprocess.Popen(cmdl, stdin=prevproc.stdout,
-							stdout=PIPE, stderr=self._stderr, **self._pipeargs)
-					procs.append(nextproc)
-					prevproc.stdout.close()
-					prevproc = nextproc
-				except Exception as e:
-					self.raise_on_error(actstr, e)
+				nextproc = self.__popen(cmdl, actstr, limits, procs=procs,
+						stdin=prevproc.stdout, stdout=PIPE)
+				procs.append(nextproc)
+				prevproc.stdout.close()
+				prevproc = nextproc
 
-		if getattr(self, 'verbose', None):
-			sys.stderr.write(self.qjoin(cmdlines[-1]) + outstr + '\n')
 		if not getattr(self, 'donothing', None):
-			try:
-				lastproc = subprocess.Popen(cmdlines[-1], stdin=prevproc.stdout,
-						stdout=stdout, stderr=self._stderr,
-						universal_newlines=universal_newlines, **self._pipeargs)
-				prevproc.stdout.close()
-				procs.append(lastproc)
-				prevproc.stdout.close()
-			except Exception as e:
-				self.raise_on_error(actstr, e)
+			lastproc = self.__popen(cmdlines[-1], actstr, limits, procs=procs,
+					stdin=prevproc.stdout, stdout=stdout,
+					universal_newlines=universal_newlines)
+			prevproc.stdout.close()
+			procs.append(lastproc)
 
 			if stdin != PIPE and stdout!= PIPE:
 				# caller needs to wait after reading or writing (else deadlock)
-				for proc, cmdl in zip(procs, cmdlines):
-					res = proc.wait()
-					if res != 0:
-						self.raise_on_error(actstr,
-								'Nonzero exit (%d) from command [%s].'
-								% (res, self.qjoin(cmdl)))
+				self.wait_chain(procs, [actstr] * len(procs),
+						[self.qjoin(cmdl) for cmdl in cmdlines], limits)
 			return procs
 
 
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+''' pyrad_scene.py - Read Radiance scene files and compute their extents
+
+Use as:
+	from pyradlib.pyrad_scene import SceneReader, scene_bbox
+
+	for prim in SceneReader('scene.rad'):
+		if isinstance(prim, Command): ...
+		else: print(prim.otype, prim.ident, len(prim.rargs))
+
+	xmin, xmax, ymin, ymax, zmin, zmax = scene_bbox(files, fallback=func)
+
+The files are tokenized as a stream, one line at a time, and only the
+real arguments of surfaces are converted to numbers. The extents of each
+surface are reduced per axis with the builtin min()/max() over slices of
+its coordinate list, so that the per-vertex work is never a Python loop.
+
+Scene content that can't be evaluated in-process ("!command" lines,
+instance and mesh surfaces referencing external files) raises
+UnsupportedScene. scene_bbox() hands such files to fallback(fn) instead,
+which is expected to return the six values of "getbbox -h" for it.
+Sources are ignored, as getbbox does.
+'''
+from __future__ import division, print_function, unicode_literals
+
+import re
+import math
+from collections import namedtuple
+
+from pyradlib.pyrad_proc import Error
+
+# Arguments are kept as lists of strings.
+Primitive = namedtuple('Primitive',
+		'modifier otype ident sargs iargs rargs')
+Command = namedtuple('Command', 'command')
+
+_QUOTED = re.compile(r'"([^"]*)"|(\S+)')
+
+
+class UnsupportedScene(Error): pass
+
+
+class _CommandLine(type(u'')):
+	'''A "!command" line, passed through the word stream.'''
+
+
+def _split(line):
+	if '"' not in line:
+		return line.split()
+	return [q or w for q, w in _QUOTED.findall(line)]
+
+def _words(f):
+	for line in f:
+		s = line.lstrip()
+		if not s or s[0] == '#':
+			continue
+		if s[0] == '!':
+			yield _CommandLine(s[1:].strip())
+			continue
+		for w in _split(line):
+			yield w
+
+
+class SceneReader(object):
+	'''Iterate over the primitives (and command lines) of a scene file.'''
+	def __init__(self, fn):
+		self.fn = fn
+
+	def __iter__(self):
+		try:
+			with open(self.fn) as f:
+				for prim in self._parse(_words(f)):
+					yield prim
+		except (IOError, OSError) as e:
+			raise Error('Unable to read scene file "%s" - %s'
+					% (self.fn, getattr(e, 'strerror', e)))
+
+	def _parse(self, words):
+		nxt = words.__next__ if hasattr(words, '__next__') else words.next
+		def args():
+			try: n = int(nxt())
+			except ValueError:
+				raise Error('Bad argument count in "%s" (primitive "%s")'
+						% (self.fn, ident))
+			return [nxt() for i in range(n)]
+		for mod in words:
+			if isinstance(mod, _CommandLine):
+				yield Command(type(u'')(mod))
+				continue
+			try:
+				otype = nxt()
+				ident = nxt()
+				if otype == 'alias':
+					yield Primitive(mod, otype, ident, [nxt()], [], [])
+					continue
+				yield Primitive(mod, otype, ident, args(), args(), args())
+			except StopIteration:
+				raise Error('Unexpected end of file in "%s" (modifier "%s")'
+						% (self.fn, mod))
+
+
+def _floats(prim, n=None):
+	try: vals = [float(v) for v in prim.rargs]
+	except ValueError:
+		raise Error('Bad real argument for %s "%s"' % (prim.otype, prim.ident))
+	if n is not None and len(vals) != n:
+		raise Error('Need %d real arguments for %s "%s", found %d'
+				% (n, prim.otype, prim.ident, len(vals)))
+	return vals
+
+def _disc_extent(center, normal, r, bbox):
+	'''Extend bbox by a disc, whose extent along axis i is r*sqrt(1-n_i**2)'''
+	nl = math.sqrt(sum([c * c for c in normal]))
+	if nl == 0:
+		raise Error('Zero length direction in scene')
+	for i in range(3):
+		ni = normal[i] / nl
+		e = abs(r) * math.sqrt(max(0.0, 1 - ni * ni))
+		if center[i] - e < bbox[2*i]: bbox[2*i] = center[i] - e
+		if center[i] + e > bbox[2*i+1]: bbox[2*i+1] = center[i] + e
+
+def _bb_polygon(prim, bbox):
+	v = _floats(prim)
+	if len(v) < 9 or len(v) % 3:
+		raise Error('Bad number of vertex coordinates for polygon "%s"'
+				% prim.ident)
+	for i in range(3):
+		c = v[i::3]
+		lo, hi = min(c), max(c)
+		if lo < bbox[2*i]: bbox[2*i] = lo
+		if hi > bbox[2*i+1]: bbox[2*i+1] = hi
+
+def _bb_sphere(prim, bbox):
+	v = _floats(prim, 4)
+	r = abs(v[3])
+	for i in range(3):
+		if v[i] - r < bbox[2*i]: bbox[2*i] = v[i] - r
+		if v[i] + r > bbox[2*i+1]: bbox[2*i+1] = v[i] + r
+
+def _bb_cone(prim, bbox):
+	v = _floats(prim, 8)
+	p0, p1 = v[0:3], v[3:6]
+	axis = [p1[i] - p0[i] for i in range(3)]
+	_disc_extent(p0, axis, v[6], bbox)
+	_disc_extent(p1, axis, v[7], bbox)
+
+def _bb_cylinder(prim, bbox):
+	v = _floats(prim, 7)
+	p0, p1 = v[0:3], v[3:6]
+	axis = [p1[i] - p0[i] for i in range(3)]
+	_disc_extent(p0, axis, v[6], bbox)
+	_disc_extent(p1, axis, v[6], bbox)
+
+def _bb_ring(prim, bbox):
+	v = _floats(prim, 8)
+	_disc_extent(v[0:3], v[3:6], max(abs(v[6]), abs(v[7])), bbox)
+
+def _bb_external(prim, bbox):
+	raise UnsupportedScene('%s "%s" references an external file'
+			% (prim.otype, prim.ident))
+
+SURFACE_BBOX = {
+	'polygon': _bb_polygon,
+	'sphere': _bb_sphere,
+	'bubble': _bb_sphere,
+	'cone': _bb_cone,
+	'cup': _bb_cone,
+	'cylinder': _bb_cylinder,
+	'tube': _bb_cylinder,
+	'ring': _bb_ring,
+	'instance': _bb_external,
+	'mesh': _bb_external,
+}
+
+
+def file_bbox(fn, bbox=None):
+	'''Extend bbox (a list in the order xmin xmax ymin ymax zmin zmax)
+	by the surfaces in fn, and return it.
+	Raises UnsupportedScene if the file contains command lines or
+	references other geometry files.'''
+	if bbox is None:
+		bbox = empty_bbox()
+	for prim in SceneReader(fn):
+		if isinstance(prim, Command):
+			raise UnsupportedScene('"%s" contains a command: !%s'
+					% (fn, prim.command))
+		func = SURFACE_BBOX.get(prim.otype)
+		if func:
+			func(prim, bbox)
+	return bbox
+
+def empty_bbox():
+	inf = float('inf')
+	return [inf, -inf, inf, -inf, inf, -inf]
+
+def scene_bbox(files, fallback=None):
+	'''Return the combined extents of files as
+	[xmin, xmax, ymin, ymax, zmin, zmax], or None if there are no surfaces.
+	Files that raise UnsupportedScene are passed to fallback(fn) if given,
+	which must return the same six values for that file.'''
+	bbox = empty_bbox()
+	for fn in files:
+		part = empty_bbox()
+		try:
+			file_bbox(fn, part)
+		except UnsupportedScene:
+			if fallback is None:
+				raise
+			part = fallback(fn)
+		for i in range(3):
+			bbox[2*i] = min(bbox[2*i], part[2*i])
+			bbox[2*i+1] = max(bbox[2*i+1], part[2*i+1])
+	if bbox[0] > bbox[1]:
+		return None
+	return bbox
+
+
+### end of pyrad_scene.py
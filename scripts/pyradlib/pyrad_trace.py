@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+''' pyrad_trace.py - Timeline of processes and Python phases for profiling
+
+Use as:
+	from pyradlib.pyrad_trace import traced, span
+
+	class Something(ProcMixin):
+		@traced
+		def create_calfiles(self):
+			...
+		def run(self):
+			with span('read histogram'):
+				...
+
+With PYRAD_TRACE set to a file name, each process started through
+ProcMixin, each traced Python phase and the time spent waiting for
+processes are written to that file at exit, in the Chrome trace event
+format (open it in chrome://tracing or https://ui.perfetto.dev).
+Every process and Python thread gets a track of its own, so that it is
+visible which ones overlapped and which ones waited. If PYRAD_TRACE
+names a directory, each run writes its own file into it, named after
+the script and its process id. Without PYRAD_TRACE, tracing costs a
+dictionary lookup per call.
+
+The first traced process exports PYRAD_TRACE_OWNER, which nested
+scripts (eg. phisto run by falsecolor, or the pyradd worker serving a
+pyradc call) inherit. They all merge their events into the same file,
+under a lock where the platform has fcntl. A file written by another
+owner, eg. by an earlier run, is replaced.
+
+Environment variables:
+	PYRAD_TRACE        trace file or directory
+	PYRAD_TRACE_OWNER  set by the first traced process for nested ones
+'''
+from __future__ import division, print_function, unicode_literals
+
+import os
+import sys
+import json
+import time
+import atexit
+import functools
+import threading
+import contextlib
+try: import fcntl
+except ImportError: fcntl = None # Windows
+
+_tracers = {} # per process id, as pyradd forks
+
+
+def get_tracer():
+	'''Return the Tracer of this process, or None if tracing is off.'''
+	pid = os.getpid()
+	try: return _tracers[pid]
+	except KeyError: pass
+	path = os.environ.get('PYRAD_TRACE')
+	_tracers[pid] = Tracer(path) if path else None
+	return _tracers[pid]
+
+def flush():
+	'''Write the trace now, for processes that exit without atexit
+	handlers (eg. with os._exit()).'''
+	tracer = _tracers.get(os.getpid())
+	if tracer:
+		tracer.write()
+
+
+def _us(t):
+	return int(t * 1000000)
+
+def _exit_status(info):
+	# siginfo of waitid(): exit status, or the signal as a negative value
+	if info is None:
+		return None
+	if info.si_code == os.CLD_EXITED:
+		return info.si_status
+	return -info.si_status
+
+
+class Tracer(object):
+	def __init__(self, path):
+		self.path = path
+		self.pid = os.getpid()
+		self.events = []
+		self.threads = {}
+		self.running = {}
+		self.lock = threading.Lock()
+		self.written = False
+		prog = os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]
+		self.meta('process_name', self.pid, '%s [%d]' % (prog, self.pid))
+		self.prog = prog
+		self.owner = os.environ.get('PYRAD_TRACE_OWNER')
+		if not self.owner:
+			self.owner = '%d:%.6f' % (self.pid, time.time())
+			os.environ['PYRAD_TRACE_OWNER'] = self.owner
+		atexit.register(self.write)
+
+	def meta(self, what, tid, name):
+		self.events.append({'ph': 'M', 'name': what, 'pid': self.pid,
+				'tid': tid, 'args': {'name': name}})
+
+	def thread_track(self):
+		'''The track of the current Python thread (small numbers, unlike
+		the pids of the child processes).'''
+		ident = threading.current_thread().ident
+		with self.lock:
+			tid = self.threads.get(ident)
+			if tid is None:
+				tid = self.threads[ident] = len(self.threads) + 1
+				self.meta('thread_name', tid, 'python' if tid == 1
+						else 'python thread %d' % tid)
+		return tid
+
+	def complete(self, name, cat, start, end, tid=None, args=None):
+		ev = {'ph': 'X', 'name': name, 'cat': cat, 'pid': self.pid,
+				'tid': tid or self.thread_track(),
+				'ts': _us(start), 'dur': max(_us(end) - _us(start), 0)}
+		if args:
+			ev['args'] = args
+		with self.lock:
+			self.events.append(ev)
+
+	def process(self, p, cmdl, actstr, start=None):
+		'''Record a started child process, until finished() or its end
+		is seen by a watcher thread.'''
+		start = start or time.time()
+		name = os.path.basename(cmdl[0])
+		with self.lock:
+			self.meta('thread_name', p.pid, '%s [%d]' % (name, p.pid))
+			self.running[p.pid] = (p, name, start, {'action': actstr,
+				'command': ' '.join(cmdl)})
+		waitid = getattr(os, 'waitid', None)
+		if waitid and hasattr(os, 'WNOWAIT'):
+			def watch():
+				# waits for the end without reaping the child
+				try: info = waitid(os.P_PID, p.pid, os.WEXITED | os.WNOWAIT)
+				except OSError: info = None # already reaped
+				self.finished(p, _exit_status(info), time.time())
+			t = threading.Thread(target=watch)
+			t.daemon = True
+			t.start()
+
+	def finished(self, p, status=None, end=None):
+		end = end or time.time()
+		with self.lock:
+			item = self.running.pop(p.pid, None)
+		if item is None:
+			return
+		p, name, start, args = item
+		if status is None:
+			status = p.returncode
+		if status is not None:
+			args['exit'] = status
+		self.complete(name, 'process', start, end, p.pid, args)
+
+	def write(self):
+		if self.written or os.getpid() != self.pid:
+			return
+		self.written = True
+		for p, name, start, args in list(self.running.values()):
+			if p.poll() is None:
+				args['end'] = 'still running at exit'
+			self.finished(p)
+		path = self.path
+		if os.path.isdir(path):
+			path = os.path.join(path, '%s-%d.json' % (self.prog, self.pid))
+		try:
+			with open(path, 'a+') as f:
+				if fcntl:
+					fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+				f.seek(0)
+				events = self._merged(f.read())
+				f.seek(0)
+				f.truncate()
+				json.dump({'traceEvents': events,
+					'displayTimeUnit': 'ms',
+					'otherData': {'pyrad_owner': self.owner}}, f)
+		except (IOError, OSError) as e:
+			sys.stderr.write('Unable to write trace "%s" - %s\n'
+					% (path, getattr(e, 'strerror', e)))
+
+	def _merged(self, text):
+		'''Our events, after those of other processes of the same owner
+		already in the file.'''
+		try: old = json.loads(text)
+		except ValueError:
+			return self.events
+		if (not isinstance(old, dict) or old.get('otherData', {}).get(
+				'pyrad_owner') != self.owner):
+			return self.events
+		return old.get('traceEvents', []) + self.events
+
+
+@contextlib.contextmanager
+def span(name, cat='python', **args):
+	'''Trace the time spent in a with block.'''
+	tracer = get_tracer()
+	if tracer is None:
+		yield
+		return
+	start = time.time()
+	try: yield
+	finally: tracer.complete(name, cat, start, time.time(), args=args)
+
+def traced(func):
+	'''Decorator tracing each call of a function or method as a phase.'''
+	@functools.wraps(func)
+	def wrapper(*args, **kwargs):
+		tracer = get_tracer()
+		if tracer is None:
+			return func(*args, **kwargs)
+		start = time.time()
+		try: return func(*args, **kwargs)
+		finally: tracer.complete(func.__name__, 'python', start, time.time())
+	return wrapper
+
+
+### end of pyrad_trace.py
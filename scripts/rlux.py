@@ -22,6 +22,7 @@ if __name__ == '__main__' and not getattr(sys, 'frozen', False):
 		print('Support library not found on RAYPATH'); sys.exit(-1)
 
 from pyradlib.pyrad_proc import Error, ProcMixin
+from pyradlib.pyrad_proc import ResourceError, RESOURCE_EXIT
 
 SHORTPROGN = os.path.splitext(os.path.basename(sys.argv[0]))[0]
 
@@ -76,6 +77,9 @@ if __name__ == '__main__':
 	except KeyboardInterrupt:
 		sys.stderr.write('*cancelled*\n')
 		sys.exit(1)
+	except ResourceError as e:
+		sys.stderr.write('%s: %s\n' % (SHORTPROGN, e))
+		sys.exit(RESOURCE_EXIT)
 	except Error as e:
 		sys.stderr.write('%s: %s\n' % (SHORTPROGN, e))
 		sys.exit(-1)
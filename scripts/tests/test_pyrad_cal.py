@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+''' test_pyrad_cal.py - Compare pyrad_cal expressions with calcomp
+
+Run from the scripts directory as:
+	python -m unittest discover tests
+
+Where Radiance is installed, the results are checked against "ev",
+which evaluates its arguments with calcomp. Otherwise they are checked
+against the values calcomp is known to give.
+'''
+from __future__ import division, print_function, unicode_literals
+
+import os
+import sys
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pyradlib.pyrad_cal import Calc, RayState
+
+# expression: result of calcomp
+EXPRESSIONS = {
+	'-2^2': 4.0,
+	'-(2^2)': -4.0,
+	'2^-2': 0.25,
+	'2^3^2': 512.0,
+	'-2^2*3': 12.0,
+	'1-2^2': -3.0,
+	'-x^2': 9.0,
+}
+DEFINITIONS = 'x = 3;'
+
+
+def _evaluate(text):
+	calc = Calc(rayinit=False)
+	calc.load_string(DEFINITIONS)
+	return calc.compile_expr(text)(RayState())
+
+
+class TestPrecedence(unittest.TestCase):
+	def test_known(self):
+		for text, value in EXPRESSIONS.items():
+			self.assertAlmostEqual(_evaluate(text), value, msg=text)
+
+	def test_calcomp(self):
+		texts = sorted(EXPRESSIONS)
+		# ev has no definitions, substitute them
+		try: out = subprocess.check_output(['ev'] +
+				[t.replace('x', '(3)') for t in texts])
+		except OSError:
+			self.skipTest('needs ev from Radiance')
+		for text, value in zip(texts, out.split()):
+			self.assertAlmostEqual(_evaluate(text), float(value), msg=text)
+
+
+if __name__ == '__main__':
+	unittest.main()